@@ -441,6 +441,9 @@ class service:
     def do_getAllVmStats(self, args):
         return self.ExecAndExit(self.s.getAllVmStats())
 
+    def do_getAllVmStatsDelta(self, args):
+        return self.ExecAndExit(self.s.getAllVmStatsDelta(*args))
+
     def desktopLogin(self, args):
         vmId, domain, user, password = tuple(args)
         response = self.s.desktopLogin(vmId, domain, user, password)
@@ -2004,6 +2007,11 @@ if __name__ == '__main__':
                           ('',
                            'Get Statistics info for all existing VMs'
                            )),
+        'getAllVmStatsDelta': (serv.do_getAllVmStatsDelta,
+                               ('[<token>]',
+                                'Get Statistics info for the VMs changed '
+                                'since the request which returned token'
+                                )),
         'getVGList': (serv.getVGList,
                       ('storageType',
                        'List of all VGs.'
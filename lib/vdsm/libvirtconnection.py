@@ -152,13 +152,16 @@ def get(target=None, killOnFailure=True):
                 if callable(method) and name[0] != '_':
                     setattr(conn, name, wrapMethod(method))
             if target is not None:
-                for ev in (libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
-                           libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
-                           libvirt.VIR_DOMAIN_EVENT_ID_RTC_CHANGE,
-                           libvirt.VIR_DOMAIN_EVENT_ID_IO_ERROR_REASON,
-                           libvirt.VIR_DOMAIN_EVENT_ID_GRAPHICS,
-                           libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB,
-                           libvirt.VIR_DOMAIN_EVENT_ID_WATCHDOG):
+                events = [libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                          libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
+                          libvirt.VIR_DOMAIN_EVENT_ID_RTC_CHANGE,
+                          libvirt.VIR_DOMAIN_EVENT_ID_IO_ERROR_REASON,
+                          libvirt.VIR_DOMAIN_EVENT_ID_GRAPHICS,
+                          libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB,
+                          libvirt.VIR_DOMAIN_EVENT_ID_WATCHDOG]
+                if hasattr(libvirt, 'VIR_DOMAIN_EVENT_ID_BLOCK_THRESHOLD'):
+                    events.append(libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_THRESHOLD)
+                for ev in events:
                     conn.domainEventRegisterAny(None,
                                                 ev,
                                                 target.dispatchLibvirtEvents,
@@ -18,6 +18,7 @@
 # Refer to the README and COPYING files for full details of the license
 #
 
+import json
 import re
 
 from . import utils
@@ -156,6 +157,28 @@ def convert(srcImage, dstImage, stop, srcFormat=None, dstFormat=None):
     return (rc, out, err)
 
 
+def map(image, format=None):
+    """
+    Return the list of the extents of image reported by "qemu-img map", as
+    dicts with the start, length, depth, zero and data keys.
+    """
+    cmd = [_qemuimg.cmd, "map", "--output", "json"]
+
+    if format:
+        cmd.extend(("-f", format))
+
+    cmd.append(image)
+    rc, out, err = utils.execCmd(cmd)
+
+    if rc != 0:
+        raise QImgError(rc, out, err)
+
+    try:
+        return json.loads("".join(out))
+    except ValueError:
+        raise QImgError(rc, out, err, "unable to parse qemu-img map output")
+
+
 def resize(image, newSize, format=None):
     cmd = [_qemuimg.cmd, "resize"]
 
@@ -805,6 +805,25 @@ def listJoin(elem, *lists):
     return l
 
 
+def monotonic_time():
+    """
+    Return the amount of time, in secs, elapsed since a fixed
+    arbitrary point in time in the past.
+    This function is useful if the client just
+    needs to use the difference between two given
+    time points.
+
+    With respect to time.time():
+    * The resolution of this function is lower. On Linux,
+      the resolution is 1/_SC_CLK_TCK, which in turn depend on
+      the value of HZ configured in the kernel. A commonly
+      found resolution is 10 (ten) ms.
+    * This functions is resilient with respect to system clock
+      adjustments.
+    """
+    return os.times()[4]
+
+
 def closeOnExec(fd):
     old = fcntl.fcntl(fd, fcntl.F_GETFD, 0)
     fcntl.fcntl(fd, fcntl.F_SETFD, old | fcntl.FD_CLOEXEC)
@@ -0,0 +1,225 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+import logging
+
+from testrunner import VdsmTestCase as TestCaseBase
+
+import vm
+import watermarkMonitor
+
+MiB = 1 << 20
+GiB = 1 << 30
+
+
+def _makeDrive(apparentsize=GiB):
+    conf = {'index': '0', 'iface': 'virtio', 'device': 'disk',
+            'format': 'cow', 'path': '/dev/vg/lv', 'domainID': 'sd',
+            'volumeID': 'vol', 'apparentsize': str(apparentsize)}
+    drive = vm.Drive({}, logging.getLogger("test"), **conf)
+    drive.VOLWM_CHUNK_MB = 1024
+    drive.VOLWM_FREE_PCT = 50
+    drive.VOLWM_CHUNK_MAX_MB = 8192
+    drive.VOLWM_EXTEND_TIME = 10
+    return drive
+
+
+class DriveChunkTests(TestCaseBase):
+    def testIdle(self):
+        drive = _makeDrive()
+        self.assertEquals(drive.volExtensionChunk, 1024)
+        self.assertEquals(drive.watermarkLimit, 512 * MiB)
+        self.assertEquals(drive.getNextVolumeSize(), 2048)
+
+    def testSlowWrites(self):
+        drive = _makeDrive()
+        drive.allocRate = 10 * MiB
+        self.assertEquals(drive.volExtensionChunk, 1024)
+
+    def testFastWrites(self):
+        drive = _makeDrive()
+        # 1000 MiB are written during an extension, the watermark keeps
+        # them free.
+        drive.allocRate = 100 * MiB
+        self.assertEquals(drive.volExtensionChunk, 2000)
+        self.assertEquals(drive.watermarkLimit, 1000 * MiB)
+        self.assertEquals(drive.getNextVolumeSize(), 3024)
+
+    def testMaxChunk(self):
+        drive = _makeDrive()
+        drive.allocRate = GiB
+        self.assertEquals(drive.volExtensionChunk, 8192)
+
+    def testReplication(self):
+        drive = _makeDrive()
+        drive.diskReplicate = {}
+        drive.allocRate = 10 * MiB
+        self.assertEquals(drive.volExtensionChunk, 2048)
+
+
+class FakeClock(object):
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSpm(object):
+    """
+    Extends the volumes latency seconds after each request, one request at
+    a time like the mailbox of the SPM.
+    """
+    def __init__(self, clock, latency):
+        self.clock = clock
+        self.latency = latency
+        self.requests = 0
+        self._busyUntil = 0
+        self._pending = []
+
+    def extend(self, size):
+        self.requests += 1
+        self._busyUntil = max(self.clock(), self._busyUntil) + self.latency
+        self._pending.append((self._busyUntil, size))
+
+    def completed(self):
+        now = self.clock()
+        done = [size for end, size in self._pending if end <= now]
+        self._pending = [(end, size) for end, size in self._pending
+                         if end > now]
+        return done
+
+
+class SimulatedVm(object):
+    """
+    A vm writing to a single thin provisioned drive, extended through the
+    same code of the vms.
+    """
+    onDriveWatermark = vm.Vm.onDriveWatermark.im_func
+    _isImprobableExtension = vm.Vm._isImprobableExtension.im_func
+    _requestDriveExtension = vm.Vm._requestDriveExtension.im_func
+
+    def __init__(self, clock, monitor, spm):
+        self.log = logging.getLogger("test")
+        self.clock = clock
+        self.monitor = monitor
+        self.spm = spm
+        self.drive = _makeDrive()
+        self.alloc = 0
+        self.physical = GiB
+        self.threshold = None
+        self.paused = False
+        self.pauses = 0
+
+    def getChunkedDrives(self):
+        return [self.drive]
+
+    def getDriveBlockInfo(self, drive):
+        return 100 * GiB, self.alloc, self.physical
+
+    def setDriveThreshold(self, drive, threshold):
+        self.threshold = threshold
+
+    def pause(self, pauseCode):
+        raise AssertionError("Improbable extension")
+
+    def extendDriveVolume(self, drive):
+        self.spm.extend(drive.getNextVolumeSize() * MiB)
+
+    def run(self, seconds, rate):
+        for size in self.spm.completed():
+            if size > self.physical:
+                self.physical = self.drive.apparentsize = size
+                self.paused = False
+                self.monitor.notify('vm')
+
+        if self.paused:
+            return
+
+        self.alloc = self.alloc + rate * seconds
+        if self.threshold is not None and self.alloc > self.threshold:
+            self.threshold = None
+            self.monitor.notify('vm', self.drive.name)
+        if self.alloc > self.physical:
+            # ENOSPC
+            self.alloc = self.physical
+            self.paused = True
+            self.pauses += 1
+            self.monitor.notify('vm')
+
+
+class ExtensionSimulationTests(TestCaseBase):
+    """
+    Replay write rate traces against a fake SPM, comparing the extensions
+    sized by the allocation rate with fixed ones.
+    """
+    STEP = 0.1
+    LATENCY = 4
+
+    def _simulate(self, trace, rateAware):
+        clock = FakeClock()
+        monitor = watermarkMonitor.WatermarkMonitor(2, 20, events=True,
+                                                    timefn=clock)
+        monitor._running = True
+        spm = FakeSpm(clock, self.LATENCY)
+        simVm = SimulatedVm(clock, monitor, spm)
+        if not rateAware:
+            simVm.drive.VOLWM_EXTEND_TIME = 0
+        monitor.register('vm', simVm)
+
+        for seconds, rate in trace:
+            for i in xrange(int(seconds / self.STEP)):
+                clock.now += self.STEP
+                simVm.run(self.STEP, rate * MiB)
+                while monitor._queue and monitor._queue[0][0] <= clock.now:
+                    monitor._checkVms(monitor._nextBatch())
+                    # Run the checks queued to the workers by hand
+                    while not monitor._jobs.empty():
+                        monitor._runJob(monitor._jobs.get_nowait())
+
+        return simVm.pauses, spm.requests
+
+    def _compare(self, trace):
+        fixed = self._simulate(trace, rateAware=False)
+        rated = self._simulate(trace, rateAware=True)
+        logging.getLogger("test").info(
+            "pauses, extension requests: fixed %s, rate aware %s",
+            fixed, rated)
+        # Every trace outgrows the drive, a run without extensions did not
+        # replay it.
+        self.assertTrue(fixed[1] > 0)
+        self.assertTrue(rated[1] > 0)
+        return fixed, rated
+
+    def testBurst(self):
+        fixed, rated = self._compare([(60, 300), (60, 0)])
+        self.assertTrue(rated[0] < fixed[0])
+        self.assertTrue(rated[1] < fixed[1])
+
+    def testSteady(self):
+        fixed, rated = self._compare([(120, 100)])
+        self.assertTrue(rated[0] <= fixed[0])
+        self.assertTrue(rated[1] < fixed[1])
+
+    def testSlow(self):
+        # The writes slower than a chunk per extension time are not
+        # affected.
+        fixed, rated = self._compare([(120, 20)])
+        self.assertEquals(rated, fixed)
@@ -135,6 +135,22 @@ class DirectFileTests(TestCaseBase):
             with fileUtils.open_ex(srcPath, "r") as f:
                 self.assertEquals(f.read(len(data)), data)
 
+    def testPreadPwrite(self):
+        data = "a" * 512 + "b" * 512 + "c" * 512
+        with temporaryPath(data=data) as srcPath:
+            with fileUtils.open_ex(srcPath, "r+d") as f:
+                self.assertEquals(f.pwrite(512, "x" * 512), 512)
+                self.assertEquals(f.pread(0, 1024), "a" * 512 + "x" * 512)
+                self.assertEquals(f.pread(1024, 1024), "c" * 512)
+                # The file position is left untouched
+                self.assertEquals(f.tell(), 0)
+
+    def testUnalignedPread(self):
+        with temporaryPath(data="a" * 1024) as srcPath:
+            with fileUtils.open_ex(srcPath, "dr") as f:
+                self.assertRaises(ValueError, f.pread, 100, 512)
+                self.assertRaises(ValueError, f.pread, 0, 100)
+
 
 class ChownTests(TestCaseBase):
     @testValidation.ValidateRunningAsRoot
@@ -21,6 +21,8 @@
 
 
 import os
+import stat
+import time
 from testrunner import VdsmTestCase as TestCaseBase
 
 import storage.blockSD
@@ -54,34 +56,116 @@ class TestBlockGetAllVolumes(TestCaseBase):
         self.assertEqual(len(allVols), 23)
 
 
-class Moop(object):
-    class Modulito(object):
-        def glob(self, volMetaPattern):
-            """ This function returns glob output from a file.
-
-            Input file name: 'glob_<sdName>.out
-            Input file format: str(glob.glob(<imgsDir>))
-            When
-            <imgsDir> = /rhev/data-center/mnt/<mntPoint>/<sdName>/images/*.meta
-            """
-            sdPath, globExp = volMetaPattern.split('/images')
-            sdHead, sdName = os.path.split(sdPath)
-            inp = open(os.path.join(sdHead, "glob_%s.out" % sdName),
-                       "r").read()
-            # Danger Will Robinson! Danger!
-            return eval(inp)
+def _makeLV(name, image, parent):
+    tags = "IU_%s,PU_%s,MD_1" % (image, parent)
+    return storage.lvm.makeLV("uuid-" + name, name, "sd", "-wi-----",
+                              "1024", "0", "/dev/mapper/pv1(0)", tags)
+
+
+class VolumeGraphTests(TestCaseBase):
+    def setUp(self):
+        blank = storage.sd.BLANK_UUID
+        self.lvs = [_makeLV("template", "tmplImg", blank),
+                    _makeLV("base1", "img1", "template"),
+                    _makeLV("top1", "img1", "base1"),
+                    _makeLV("base2", "img2", "template")]
+        self.graph = storage.blockSD.VolumeGraph("sd")
+        self.graph.update(self.lvs)
+
+    def testGetAllVolumes(self):
+        allVols = self.graph.getAllVolumes()
+        self.assertEquals(allVols["template"].imgs,
+                          ("tmplImg", "img1", "img2"))
+        self.assertEquals(allVols["top1"],
+                          storage.sd.ImgsPar(("img1",), "base1"))
+
+    def testLookups(self):
+        self.assertEquals(sorted(self.graph.children("template")),
+                          ["base1", "base2"])
+        self.assertEquals(sorted(self.graph.imageVolumes("img1")),
+                          ["base1", "top1"])
+        self.assertEquals(self.graph.chain("top1"),
+                          ["template", "base1", "top1"])
+
+    def testImageChain(self):
+        self.assertEquals(self.graph.chain("top1", "img1"),
+                          ["base1", "top1"])
+        self.assertEquals(self.graph.chain("template", "tmplImg"),
+                          ["template"])
+
+    def testLeaves(self):
+        self.assertEquals(self.graph.leaves("img1"), ["top1"])
+        self.assertEquals(self.graph.leaves("tmplImg"), ["template"])
+        self.assertEquals(self.graph.leaves("img3"), [])
+
+    def testRemoveVolume(self):
+        self.graph.update(self.lvs[:-1])
+        self.assertEquals(self.graph.getAllVolumes()["template"].imgs,
+                          ("tmplImg", "img1"))
+        self.assertEquals(self.graph.imageVolumes("img2"), [])
+
+    def testChangeParent(self):
+        self.lvs[2] = _makeLV("top1", "img1", "template")
+        self.graph.update(self.lvs)
+        self.assertEquals(self.graph.children("base1"), ())
+        self.assertEquals(self.graph.getAllVolumes()["top1"].parent,
+                          "template")
+
+    def testSameAsFullBuild(self):
+        self.lvs[1] = _makeLV("base1", "img3", "template")
+        self.graph.update(self.lvs)
+        fresh = storage.blockSD.VolumeGraph("sd")
+        fresh.update(self.lvs)
+        self.assertEquals(self.graph.getAllVolumes(), fresh.getAllVolumes())
 
-    class FileUselessUtils(object):
-        def pathExists(metafile):
-            return True
 
-    @property
-    def glob(cls):
-        return cls.Modulito()
-
-    @property
-    def fileutils(cls):
-        return cls.FileUselessUtils()
+class Moop(object):
+    """
+    Fake oop serving the image directories found in the glob file.
+
+    Input file name: 'glob_<sdName>.out
+    Input file format: str(glob.glob(<imgsDir>))
+    When
+    <imgsDir> = /rhev/data-center/mnt/<mntPoint>/<sdName>/images/*.meta
+    """
+    def __init__(self):
+        self.mtimes = {}
+        self.globbed = []
+
+    def _metaPaths(self, imagesDir):
+        sdPath = os.path.dirname(imagesDir)
+        sdHead, sdName = os.path.split(sdPath)
+        inp = open(os.path.join(sdHead, "glob_%s.out" % sdName),
+                   "r").read()
+        # Danger Will Robinson! Danger!
+        return eval(inp)
+
+    def globStat(self, pattern):
+        imagesDir = os.path.dirname(pattern)
+        images = set(os.path.basename(os.path.dirname(path))
+                     for path in self._metaPaths(imagesDir))
+        dirs = [os.path.join(imagesDir, imgUUID) for imgUUID in images]
+        return [(path, _DirStat(self.mtimes.get(path, 0)), None)
+                for path in dirs]
+
+    def globMany(self, patterns):
+        self.globbed.extend(patterns)
+        res = []
+        for pattern in patterns:
+            imagesDir, imgUUID = os.path.split(os.path.dirname(pattern))
+            paths = [path for path in self._metaPaths(imagesDir)
+                     if os.path.basename(os.path.dirname(path)) == imgUUID]
+            res.append((paths, None))
+        return res
+
+
+class _DirStat(object):
+    st_mode = stat.S_IFDIR
+    st_ino = 1
+    st_ctime = st_size = 0
+
+    def __init__(self, mtime):
+        self.st_mtime = mtime
 
 
 class TestFileGetAllVolumes(TestCaseBase):
@@ -92,8 +176,38 @@ class TestFileGetAllVolumes(TestCaseBase):
                 self.oop = Moop()
                 self.stat = None
 
+    def setUp(self):
+        self.sdName = "1c60971a-8647-44ac-ae33-6520887f8843"
+        storage.fileSD._volumeIndexes.pop(self.sdName, None)
+
     def test_getAllVolumes(self):
-        sdName = "1c60971a-8647-44ac-ae33-6520887f8843"
-        dom = self.MStorageDomain(sdName)
+        dom = self.MStorageDomain(self.sdName)
         allVols = dom.getAllVolumes()
         self.assertEqual(len(allVols), 11)
+
+    def testListChangedImages(self):
+        dom = self.MStorageDomain(self.sdName)
+        allVols = dom.getAllVolumes()
+        imgDir = os.path.dirname(dom.oop.globbed[0])
+        dom.oop.mtimes[imgDir] = 1
+        dom.oop.globbed = []
+        self.assertEqual(dom.getAllVolumes(), allVols)
+        self.assertEqual(dom.oop.globbed, [os.path.join(imgDir, "*.meta")])
+
+    def testRecentlyChangedImages(self):
+        dom = self.MStorageDomain(self.sdName)
+        dom.getAllVolumes()
+        imgDir = os.path.dirname(dom.oop.globbed[0])
+        # Changed in the same second of the last listing
+        dom.oop.mtimes[imgDir] = time.time()
+        for i in range(2):
+            dom.oop.globbed = []
+            dom.getAllVolumes()
+            self.assertEqual(dom.oop.globbed,
+                             [os.path.join(imgDir, "*.meta")])
+
+    def testTemplateImages(self):
+        dom = self.MStorageDomain(self.sdName)
+        for volUUID, (imgs, parent) in dom.getAllVolumes().iteritems():
+            if len(imgs) > 1:
+                self.assertEqual(parent, storage.sd.BLANK_UUID)
@@ -0,0 +1,154 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from testrunner import VdsmTestCase as TestCaseBase
+from testrunner import temporaryPath
+from monkeypatch import Patch
+from vdsm import utils
+
+import storage.imageCopy as imageCopy
+
+MiB = 1 << 20
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ThrottleTests(TestCaseBase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def testRate(self):
+        throttle = imageCopy.Throttle(10, self.clock, self.clock.sleep)
+        throttle.consume(5)
+        throttle.consume(5)
+        throttle.consume(10)
+        self.assertEquals(self.clock.sleeps, [0.5, 0.5])
+
+    def testIdle(self):
+        throttle = imageCopy.Throttle(10, self.clock, self.clock.sleep)
+        throttle.consume(10)
+        self.clock.now = 5
+        throttle.consume(10)
+        self.assertEquals(self.clock.sleeps, [])
+
+    def testUnlimited(self):
+        throttle = imageCopy.Throttle(0, self.clock, self.clock.sleep)
+        for i in range(10):
+            throttle.consume(MiB)
+        self.assertEquals(self.clock.sleeps, [])
+
+
+def _failMap(image, format=None):
+    raise imageCopy.qemuImg.QImgError(1, [], ["map is not supported"])
+
+
+class CopyVolumesTests(TestCaseBase):
+    def setUp(self):
+        self.ranges = None
+        self.patch = Patch([
+            (imageCopy, 'EXTENT_SIZE', MiB),
+            (imageCopy.qemuImg, 'map', self._map),
+        ])
+        self.patch.apply()
+
+    def tearDown(self):
+        self.patch.revert()
+
+    def _map(self, image, format=None):
+        if self.ranges is None:
+            return _failMap(image, format)
+        return self.ranges
+
+    def _copy(self, src, dst, skipZeros=False, **kw):
+        size = len(src)
+        with temporaryPath(data=src) as srcPath:
+            with temporaryPath(data=dst) as dstPath:
+                job = imageCopy.CopyJob(srcPath, dstPath, size, skipZeros)
+                imageCopy.copyVolumes([job], **kw)
+                with open(dstPath) as f:
+                    return f.read()
+
+    def testCopy(self):
+        # The unaligned tail of a file is copied too
+        data = "".join(c * MiB for c in "abc") + "d" * 100
+        self.assertEquals(self._copy(data, "", workers=2), data)
+
+    def testSkipZeros(self):
+        self.ranges = [
+            {'start': 0, 'length': MiB, 'zero': True, 'data': False},
+            {'start': MiB, 'length': MiB, 'zero': False, 'data': True},
+        ]
+        # The zero range of the source is not read, neither written to a
+        # destination reading as zeros.
+        data = "a" * 2 * MiB
+        res = self._copy(data, "\0" * 2 * MiB, skipZeros=True)
+        self.assertEquals(res, "\0" * MiB + "a" * MiB)
+
+    def testWriteZeros(self):
+        self.ranges = [
+            {'start': 0, 'length': 2 * MiB, 'zero': True, 'data': False},
+        ]
+        res = self._copy("a" * 2 * MiB, "x" * 2 * MiB)
+        self.assertEquals(res, "\0" * 2 * MiB)
+
+    def testSkipZeroData(self):
+        data = "\0" * MiB + "a" * MiB
+        res = self._copy(data, "x" * 2 * MiB, skipZeros=True)
+        self.assertEquals(res, "x" * MiB + "a" * MiB)
+
+    def testProgress(self):
+        progress = []
+        self._copy("a" * 3 * MiB, "", progress=lambda *a: progress.append(a))
+        self.assertEquals(len(progress), 3)
+        self.assertEquals(sorted(progress)[-1], (3 * MiB, 3 * MiB))
+
+    def testChain(self):
+        with temporaryPath(data="a" * MiB) as src1:
+            with temporaryPath(data="b" * 2 * MiB) as src2:
+                with temporaryPath() as dst1:
+                    with temporaryPath() as dst2:
+                        imageCopy.copyVolumes([
+                            imageCopy.CopyJob(src1, dst1, MiB, False),
+                            imageCopy.CopyJob(src2, dst2, 2 * MiB, False),
+                        ], workers=3)
+                        self.assertEquals(open(dst1).read(), "a" * MiB)
+                        self.assertEquals(open(dst2).read(), "b" * 2 * MiB)
+
+    def testStop(self):
+        self.assertRaises(utils.ActionStopped, self._copy, "a" * 4 * MiB,
+                          "", stop=lambda: True)
+
+    def testShortSource(self):
+        with temporaryPath(data="a" * MiB) as srcPath:
+            with temporaryPath() as dstPath:
+                job = imageCopy.CopyJob(srcPath, dstPath, 2 * MiB, False)
+                self.assertRaises(imageCopy.se.MiscBlockReadIncomplete,
+                                  imageCopy.copyVolumes, [job])
@@ -0,0 +1,48 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from testrunner import VdsmTestCase as TestCaseBase
+
+import storage.lvmHelper as lvmHelper
+
+EXT_ECHO = "/bin/echo"
+
+
+class ReporterTests(TestCaseBase):
+    def setUp(self):
+        # echo prints the final command line instead of running lvm
+        self.reporter = lvmHelper.Reporter(lvm=EXT_ECHO)
+
+    def testReport(self):
+        res = self.reporter.report([(["vgs", "-o", "name"], "conf")])
+        self.assertEquals(res, [(0, ["vgs --config conf -o name"], [])])
+
+    def testReuseConfig(self):
+        res = self.reporter.report([(["pvs"], "conf"),
+                                    (["vgs", "vg1", "vg2"], None),
+                                    (["lvs", "vg1"], "other")])
+        out = [lines for rc, lines, err in res]
+        self.assertEquals(out, [["pvs --config conf"],
+                                ["vgs --config conf vg1 vg2"],
+                                ["lvs --config other vg1"]])
+
+    def testReportOnly(self):
+        self.assertRaises(ValueError, self.reporter.report,
+                          [(["lvremove", "vg1/lv1"], "conf")])
@@ -19,7 +19,12 @@
 # Refer to the README and COPYING files for full details of the license
 #
 
+import threading
+import time
+
 from testrunner import VdsmTestCase as TestCaseBase
+from monkeypatch import MonkeyPatchScope
+from vdsm import utils
 
 import storage.lvm as lvm
 
@@ -37,3 +42,245 @@ class LvmTests(TestCaseBase):
                           "\\\\x22\\\\x28|\', \'r|.*|\' ]"
                           )
         self.assertEqual(expectedFilter, filter)
+
+
+class ReloadCoalescerTests(TestCaseBase):
+    def setUp(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.coalescer = lvm.ReloadCoalescer(self._reload)
+
+    def _reload(self, key, names):
+        self.calls.append((key, names))
+        self.started.set()
+        self.proceed.wait()
+        if names is None:
+            names = ["all"]
+        return dict((name, key) for name in names)
+
+    def _startReload(self, key, names=None):
+        results = []
+        t = threading.Thread(
+            target=lambda: results.append(self.coalescer.reload(key, names)))
+        t.daemon = True
+        t.start()
+        return t, results
+
+    def _waitForPending(self, key, names):
+        pending = lambda: self.coalescer._pending[key].names
+        utils.retry(lambda: self.assertEquals(pending(), set(names)),
+                    (KeyError, AssertionError), timeout=2, sleep=0.01)
+
+    def testSingleReload(self):
+        self.proceed.set()
+        self.assertEquals(self.coalescer.reload("vg", ["lv1"]),
+                          {"lv1": "vg"})
+        self.assertEquals(self.calls, [("vg", ["lv1"])])
+
+    def testJoinRunningReload(self):
+        first = self._startReload("vg")
+        self.started.wait(2)
+        second = self._startReload("vg", ["lv1"])
+        # Give the second thread the time to join the running reload
+        time.sleep(0.1)
+        self.proceed.set()
+        for t, results in (first, second):
+            t.join(2)
+            self.assertEquals(results, [{"all": "vg"}])
+        self.assertEquals(self.calls, [("vg", None)])
+
+    def testMergePendingReloads(self):
+        waiting = []
+        wait = lvm._Reload.wait
+
+        def countingWait(reload):
+            waiting.append(reload)
+            return wait(reload)
+
+        first = self._startReload("vg", ["lv1"])
+        self.started.wait(2)
+        with MonkeyPatchScope([(lvm._Reload, 'wait', countingWait)]):
+            others = [self._startReload("vg", [name])
+                      for name in ("lv3", "lv2", "lv3")]
+            self._waitForPending("vg", ["lv2", "lv3"])
+            # The first of them runs the pending reload, the others wait
+            # for it.
+            utils.retry(lambda: self.assertEquals(len(waiting), 2),
+                        AssertionError, timeout=2, sleep=0.01)
+        self.proceed.set()
+        for t, results in [first] + others:
+            t.join(2)
+        self.assertEquals(self.calls, [("vg", ["lv1"]),
+                                       ("vg", ["lv2", "lv3"])])
+        self.assertEquals(others[0][1],
+                          [{"lv2": "vg", "lv3": "vg"}])
+
+    def testDifferentKeys(self):
+        self.proceed.set()
+        self.coalescer.reload("vg1")
+        self.coalescer.reload("vg2")
+        self.assertEquals(self.calls, [("vg1", None), ("vg2", None)])
+
+    def testInvalidatedWhileRunning(self):
+        generations = {"vg": 0}
+        self.coalescer = lvm.ReloadCoalescer(self._reload,
+                                             generations.__getitem__)
+        first = self._startReload("vg")
+        self.started.wait(2)
+        # An LV created after the reload started is not in its result
+        generations["vg"] += 1
+        second = self._startReload("vg", ["lv1"])
+        self._waitForPending("vg", ["lv1"])
+        self.proceed.set()
+        for t, results in (first, second):
+            t.join(2)
+        self.assertEquals(second[1], [{"lv1": "vg"}])
+        self.assertEquals(self.calls, [("vg", None), ("vg", ["lv1"])])
+
+    def testError(self):
+        def fail(key, names):
+            raise RuntimeError("lvs failed")
+        coalescer = lvm.ReloadCoalescer(fail)
+        self.assertRaises(RuntimeError, coalescer.reload, "vg")
+        self.assertEquals(coalescer._running, {})
+
+
+def _makeStub(namedtuple, **fields):
+    entry = namedtuple(*([""] * len(namedtuple._fields)))
+    return entry._replace(**fields)
+
+
+class DeviceEventsTests(TestCaseBase):
+    def setUp(self):
+        self.cache = lvm.LVMCache()
+        pv1 = "/dev/mapper/pv1"
+        self.cache._pvs[pv1] = _makeStub(lvm.PV, name=pv1)
+        for vgName in ("vg1", "vg2"):
+            self.cache._vgs[vgName] = _makeStub(lvm.VG, name=vgName,
+                                                pv_name=(pv1,))
+            for lvName in ("lv1", "lv2"):
+                self.cache._lvs[(vgName, lvName)] = _makeStub(
+                    lvm.LV, name=lvName, vg_name=vgName)
+
+    def _stale(self, entries):
+        return sorted(key for key, entry in entries.iteritems()
+                      if isinstance(entry, lvm.Stub))
+
+    def testLvChanged(self):
+        self.cache.deviceChanged({"ACTION": "change", "DM_VG_NAME": "vg1",
+                                  "DM_LV_NAME": "lv2"})
+        self.assertEquals(self._stale(self.cache._lvs), [("vg1", "lv2")])
+        self.assertEquals(self._stale(self.cache._vgs), [])
+
+    def testUnknownVg(self):
+        self.cache.deviceChanged({"ACTION": "change", "DM_VG_NAME": "vg3",
+                                  "DM_LV_NAME": "lv1"})
+        self.assertEquals(self._stale(self.cache._lvs), [])
+
+    def testPvChanged(self):
+        self.cache.deviceChanged({"ACTION": "change", "DM_NAME": "pv1",
+                                  "DM_UUID": "mpath-pv1"})
+        self.assertEquals(self._stale(self.cache._pvs), ["/dev/mapper/pv1"])
+        self.assertEquals(self._stale(self.cache._vgs), ["vg1", "vg2"])
+        self.assertEquals(self._stale(self.cache._lvs), [])
+
+    def testNewPv(self):
+        self.cache._stalepv = self.cache._stalevg = False
+        self.cache._filterStale = False
+        self.cache.deviceChanged({"ACTION": "add", "DM_NAME": "pv2",
+                                  "DM_UUID": "mpath-pv2"})
+        self.assertTrue(self.cache._filterStale)
+        self.assertTrue(self.cache._stalepv)
+        self.assertTrue(self.cache._stalevg)
+        # The cached entries are kept
+        self.assertEquals(self._stale(self.cache._pvs), [])
+        self.assertEquals(self._stale(self.cache._vgs), [])
+        self.assertEquals(len(self.cache._lvs), 4)
+
+    def testStaleLvsOfOtherVg(self):
+        # Stale LVs in vg2 do not force a reload of vg1
+        self.cache._stalelv = False
+        self.cache._lvs[("vg2", "lv1")] = lvm.Stub("lv1", True)
+        lvs = self.cache.getLv("vg1")
+        self.assertEquals(sorted(lv.name for lv in lvs), ["lv1", "lv2"])
+
+
+def _lvLine(vgName, lvName, tags=""):
+    return "|".join(("uuid-" + lvName, lvName, vgName, "-wi-a---", "1024",
+                     "0", "/dev/mapper/pv1(0)", tags))
+
+
+class LvGenerationTests(TestCaseBase):
+    def setUp(self):
+        self.cache = lvm.LVMCache()
+        self.cache._stalelv = False
+        self.out = [_lvLine("vg1", "lv1"), _lvLine("vg1", "lv2")]
+        self.cache.report = lambda cmd, devices: (0, self.out, [])
+        self.cache._reloadlvs("vg1")
+        self.generation = self.cache.lvGeneration("vg1")
+
+    def testUnchangedReload(self):
+        self.cache._reloadlvs("vg1")
+        self.assertEquals(self.cache.lvGeneration("vg1"), self.generation)
+
+    def testChangedReload(self):
+        self.out = [_lvLine("vg1", "lv1", "IU_img")]
+        self.cache._reloadlvs("vg1")
+        self.assertNotEquals(self.cache.lvGeneration("vg1"),
+                             self.generation)
+
+    def testInvalidate(self):
+        self.cache._invalidatelvs("vg1", "lv1")
+        generation = self.cache.lvGeneration("vg1")
+        self.assertNotEquals(generation, self.generation)
+        # Reloading the stub does not count as another change
+        self.cache._reloadlvs("vg1")
+        self.assertEquals(self.cache.lvGeneration("vg1"), generation)
+
+    def testOtherVg(self):
+        self.cache._invalidatelvs("vg2", "lv1")
+        self.assertEquals(self.cache.lvGeneration("vg1"), self.generation)
+
+    def testInvalidateAll(self):
+        self.cache._invalidateAllLvs()
+        self.assertNotEquals(self.cache.lvGeneration("vg1"),
+                             self.generation)
+
+
+class FakeHelper(object):
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.requests = []
+
+    def report(self, reports):
+        self.requests.append(reports)
+        return [(0, self.outputs.get(cmd[0], []), [])
+                for cmd, conf in reports]
+
+
+class ReloadAllTests(TestCaseBase):
+    def setUp(self):
+        self.cache = lvm.LVMCache()
+        self.cache._filterStale = False
+        self.cache._extraCfg = "devices { }"
+        self.helper = FakeHelper({"lvs": [_lvLine("vg1", "lv1"),
+                                          _lvLine("vg2", "lv1")]})
+        self.cache._helper = self.helper
+
+    def testSingleRequest(self):
+        self.cache.bootstrap()
+        request, = self.helper.requests
+        self.assertEquals([cmd[0] for cmd, conf in request],
+                          ["pvs", "vgs", "lvs"])
+        self.assertFalse(self.cache._stalepv)
+        self.assertFalse(self.cache._stalelv)
+        self.assertEquals(sorted(self.cache._lvs),
+                          [("vg1", "lv1"), ("vg2", "lv1")])
+
+    def testFlushedCache(self):
+        self.cache.bootstrap()
+        self.cache.flush()
+        self.cache.getAllVgs()
+        self.assertEquals(len(self.helper.requests), 2)
+        self.assertEquals(len(self.helper.requests[1]), 3)
@@ -0,0 +1,155 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+import threading
+import time
+
+from testrunner import VdsmTestCase as TestCaseBase
+
+import migrationScheduler
+
+
+class FakeMigration(object):
+    def __init__(self, scheduler, name, priority=0, memSize=1024):
+        self.scheduler = scheduler
+        self.name = name
+        self.priority = priority
+        self.memSize = memSize
+        self.bandwidths = []
+        self.canceled = False
+        self.acquired = None
+        self._thread = None
+
+    def setMaxBandwidth(self, bandwidth):
+        self.bandwidths.append(bandwidth)
+
+    def start(self, started):
+        def run():
+            acquired = self.scheduler.acquire(
+                self, self.priority, self.memSize, lambda: self.canceled)
+            if acquired:
+                started.append(self.name)
+            self.acquired = acquired
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+
+def _waitFor(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("Timeout waiting for %s" % predicate)
+        time.sleep(0.01)
+
+
+class MigrationSchedulerTests(TestCaseBase):
+    def setUp(self):
+        self.started = []
+
+    def _queue(self, scheduler, migrations):
+        for m in migrations:
+            m.start(self.started)
+        # Every migration is either started or queued
+        _waitFor(lambda: all(m.acquired is not None or
+                             scheduler.queuePosition(m) is not None
+                             for m in migrations))
+
+    def _finish(self, scheduler, migration):
+        migration.join()
+        scheduler.release(migration)
+
+    def testOrder(self):
+        scheduler = migrationScheduler.MigrationScheduler(1)
+        first = FakeMigration(scheduler, 'first')
+        self._queue(scheduler, [first])
+        self.assertEquals(self.started, ['first'])
+
+        small = FakeMigration(scheduler, 'small', memSize=1024)
+        large = FakeMigration(scheduler, 'large', memSize=8192)
+        urgent = FakeMigration(scheduler, 'urgent', priority=1)
+        self._queue(scheduler, [small, large, urgent])
+        self.assertEquals(scheduler.queuePosition(urgent), 1)
+        self.assertEquals(scheduler.queuePosition(large), 2)
+        self.assertEquals(scheduler.queuePosition(small), 3)
+        self.assertEquals(scheduler.queuePosition(first), None)
+
+        for m in (first, urgent, large):
+            self._finish(scheduler, m)
+        small.join()
+        self.assertEquals(self.started, ['first', 'urgent', 'large', 'small'])
+
+    def testMaxActive(self):
+        scheduler = migrationScheduler.MigrationScheduler(2)
+        migrations = [FakeMigration(scheduler, str(i)) for i in range(3)]
+        self._queue(scheduler, migrations)
+        self.assertEquals(len(self.started), 2)
+        scheduler.setMaxActive(3)
+        for m in migrations:
+            m.join()
+        self.assertEquals(len(self.started), 3)
+
+    def testBandwidthBudget(self):
+        scheduler = migrationScheduler.MigrationScheduler(
+            3, hostBandwidth=120, maxBandwidth=32)
+        a = FakeMigration(scheduler, 'a')
+        self._queue(scheduler, [a])
+        self.assertEquals(a.bandwidths, [120])
+
+        b = FakeMigration(scheduler, 'b')
+        c = FakeMigration(scheduler, 'c')
+        self._queue(scheduler, [b, c])
+        self.assertEquals(a.bandwidths[-1], 40)
+        self.assertEquals(b.bandwidths[-1], 40)
+        self.assertEquals(c.bandwidths, [40])
+
+        self._finish(scheduler, a)
+        self._finish(scheduler, b)
+        self.assertEquals(c.bandwidths, [40, 60, 120])
+
+    def testNoBudget(self):
+        scheduler = migrationScheduler.MigrationScheduler(
+            3, hostBandwidth=0, maxBandwidth=32)
+        a = FakeMigration(scheduler, 'a')
+        b = FakeMigration(scheduler, 'b')
+        self._queue(scheduler, [a, b])
+        self._finish(scheduler, a)
+        b.join()
+        self.assertEquals(a.bandwidths, [32])
+        self.assertEquals(b.bandwidths, [32])
+
+    def testCancelQueued(self):
+        scheduler = migrationScheduler.MigrationScheduler(1)
+        a = FakeMigration(scheduler, 'a')
+        b = FakeMigration(scheduler, 'b')
+        self._queue(scheduler, [a, b])
+        b.canceled = True
+        scheduler.wakeup()
+        b.join()
+        self.assertFalse(b.acquired)
+        self.assertEquals(scheduler.queuePosition(b), None)
+        # Not running, nothing to release
+        scheduler.release(b)
+        self.assertEquals(self.started, ['a'])
+        self.assertEquals(len(scheduler._active), 1)
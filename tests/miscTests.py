@@ -537,6 +537,24 @@ class DdWatchCopy(TestCaseBase):
         self.assertRaises(misc.se.MiscBlockWriteException, misc.ddWatchCopy,
                           srcPath, "/tmp/tmp", None, 100)
 
+    def testCreateDestination(self):
+        data = "x" * 1536 + "y" * 100
+        with temporaryPath(data=data) as srcPath:
+            dstPath = srcPath + ".copy"
+            try:
+                misc.ddWatchCopy(srcPath, dstPath, None, len(data))
+                with open(dstPath) as f:
+                    self.assertEquals(f.read(), data)
+            finally:
+                os.unlink(dstPath)
+
+    def testShortSource(self):
+        with temporaryPath(data="x" * 512) as srcPath:
+            with temporaryPath() as dstPath:
+                self.assertRaises(misc.se.MiscBlockWriteIncomplete,
+                                  misc.ddWatchCopy, srcPath, dstPath, None,
+                                  1024)
+
     def testStop(self):
         """
         Test that stop really stops the copying process.
@@ -718,43 +736,6 @@ class AlignData(TestCaseBase):
         self.assertEquals(misc._alignData(1, 1), (1, 1, 1))
 
 
-class ValidateDDBytes(TestCaseBase):
-    def testValidInputTrue(self):
-        """
-        Test that it works when given valid and correct input.
-        """
-        count = 802
-        with tempfile.NamedTemporaryFile() as f:
-            cmd = [EXT_DD, "bs=1", "if=/dev/urandom", 'of=%s' % f.name,
-                   'count=%d' % count]
-            rc, out, err = utils.execCmd(cmd, sudo=False)
-
-        self.assertTrue(misc.validateDDBytes(err, count))
-
-    def testValidInputFalse(self):
-        """
-        Test that is work when given valid but incorrect input.
-        """
-        count = 802
-        with tempfile.NamedTemporaryFile() as f:
-            cmd = [EXT_DD, "bs=1", "if=/dev/urandom", 'of=%s' % f.name,
-                   'count=%d' % count]
-            rc, out, err = utils.execCmd(cmd, sudo=False)
-
-        self.assertFalse(misc.validateDDBytes(err, count + 1))
-
-    def testInvalidInput(self):
-        """
-        Test that the method handles wired input.
-        """
-        self.assertRaises(misc.se.InvalidParameterException,
-                          misc.validateDDBytes,
-                          ["I AM", "PRETENDING TO", "BE DD"], "BE")
-        self.assertRaises(misc.se.InvalidParameterException,
-                          misc.validateDDBytes,
-                          ["I AM", "PRETENDING TO", "BE DD"], 32)
-
-
 class ReadBlock(TestCaseBase):
     def _createTempFile(self, neededFileSize, writeData):
         """
@@ -913,24 +894,77 @@ class ReadFile(TestCaseBase):
 
 
 class ReadSpeed(TestCaseBase):
-    STATS_TEMPLATE = "%s byte%s (%s %sB) copied, %s s, %s %sB/s"
-    STATS_TESTS = (
-        ("1", "", "1", "", "1", "1", ""),
-        ("1024", "s", "1", "k", "1", "1", "k"),
-        ("1572864", "s", "1.5", "M", "1.5", "1", "M"),
-        ("1610612736", "s", "1.5", "G", "1000.5", "1.53", "M"),
-        ("479", "s", "479", "", "5.6832e-05", "8.4", "M"),
-        ("512", "s", "512e-3", "M", "1", "512e-3", "M"),
-        ("524288", "s", "512e3", "", "1", "512e3", ""),
-    )
-
-    def testReadSpeedRegExp(self):
-        for stats in self.STATS_TESTS:
-            m = misc._readspeed_regex.match(self.STATS_TEMPLATE % stats)
-            self.assertNotEqual(m, None)
-
-            self.assertEqual(m.group("bytes"), stats[0])
-            self.assertEqual(m.group("seconds"), stats[4])
+    def testReadSpeed(self):
+        with temporaryPath(data="a" * 8192) as path:
+            stats = misc.readspeed(path, 4096)
+        self.assertEquals(stats['bytes'], 4096)
+        self.assertTrue(stats['seconds'] >= 0)
+
+    def testReadAll(self):
+        with temporaryPath(data="a" * 1000) as path:
+            stats = misc.readspeed(path)
+        self.assertEquals(stats['bytes'], 1000)
+
+    def testMissingFile(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(path)
+        self.assertRaises(misc.se.MiscFileReadException, misc.readspeed,
+                          path, 4096)
+
+
+class IOThreadPoolTests(TestCaseBase):
+    def testResult(self):
+        pool = misc.IOThreadPool(2)
+        self.assertEquals(pool.submit(lambda x: x * 2, 21).wait(), 42)
+
+    def testError(self):
+        pool = misc.IOThreadPool(2)
+        req = pool.submit(os.stat, "/no/such/path")
+        self.assertRaises(OSError, req.wait)
+
+    def testBounded(self):
+        pool = misc.IOThreadPool(2)
+        blocked = threading.Event()
+        reqs = [pool.submit(blocked.wait) for i in range(3)]
+        done = pool.submit(lambda: True)
+        self.assertEquals(pool._threads, 2)
+        self.assertRaises(utils.ActionStopped, done.wait, lambda: True)
+        blocked.set()
+        for req in reqs:
+            req.wait()
+        self.assertTrue(done.wait())
+
+    def testPoolPerDirectory(self):
+        pool = misc._getIOPool('/dom1/metadata')
+        self.assertTrue(misc._getIOPool('/dom1/ids') is pool)
+        self.assertFalse(misc._getIOPool('/dom2/metadata') is pool)
+
+    def _waitIdle(self, pool):
+        utils.retry(lambda: self.assertEquals(pool._idle, pool._threads),
+                    AssertionError, timeout=2, sleep=0.01)
+
+    def testCloseIfIdle(self):
+        pool = misc.IOThreadPool(2)
+        blocked = threading.Event()
+        req = pool.submit(blocked.wait)
+        # A blocked thread is not dropped
+        self.assertFalse(pool.closeIfIdle())
+        blocked.set()
+        req.wait()
+        self._waitIdle(pool)
+        self.assertTrue(pool.closeIfIdle())
+        # Still served once closed
+        self.assertEquals(pool.submit(lambda: 42).wait(), 42)
+
+    def testDropIOPools(self):
+        pool = misc._getIOPool('/dom3/dom_md/metadata')
+        other = misc._getIOPool('/dom4/dom_md/metadata')
+        pool.submit(lambda: None).wait()
+        self._waitIdle(pool)
+        misc.dropIOPools('dom3')
+        self.assertFalse(misc._getIOPool('/dom3/dom_md/metadata') is pool)
+        self.assertTrue(misc._getIOPool('/dom4/dom_md/metadata') is other)
 
 
 class PidExists(TestCaseBase):
@@ -0,0 +1,149 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+import os
+import pickle
+
+from testrunner import VdsmTestCase as TestCaseBase
+from testrunner import namedTemporaryDir
+
+import recoveryStore
+
+INTERVAL = 5
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeVm(object):
+    def __init__(self):
+        self.state = {'vmId': 'vm', 'status': 'Up'}
+        self.calls = 0
+
+    def getState(self):
+        self.calls += 1
+        if self.state is None:
+            return None
+        return self.state.copy()
+
+
+class RecoveryStoreTests(TestCaseBase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = recoveryStore.RecoveryStore(INTERVAL, timefn=self.clock)
+        # Run the flushes of the store thread by hand
+        self.store._running = True
+        self.vm = FakeVm()
+
+    def _update(self, path, sync=False):
+        self.store.update('vm', path, self.vm.getState, sync)
+
+    def _flushDue(self, after=0):
+        self.clock.now += after
+        while (self.store._queue and
+               self.store._queue[0][0] <= self.clock.now):
+            vmId, entry = self.store._nextFlush()
+            if entry is not None and entry.dirty:
+                self.store._flush(vmId, entry)
+
+    def testWriteBehind(self):
+        with namedTemporaryDir() as tmpDir:
+            path = os.path.join(tmpDir, 'vm.recovery')
+            self._update(path)
+            self.assertFalse(os.path.exists(path))
+            self._flushDue()
+            self.assertEquals(recoveryStore.load(path), self.vm.state)
+
+    def testCoalesce(self):
+        with namedTemporaryDir() as tmpDir:
+            path = os.path.join(tmpDir, 'vm.recovery')
+            self._update(path)
+            self._flushDue()
+            for status in ('Paused', 'Up', 'Paused'):
+                self.vm.state['status'] = status
+                self._update(path)
+                self._flushDue(after=1)
+            self.assertEquals(self.vm.calls, 1)
+            self._flushDue(after=INTERVAL)
+            self.assertEquals(self.vm.calls, 2)
+            self.assertEquals(recoveryStore.load(path)['status'], 'Paused')
+
+    def testSync(self):
+        with namedTemporaryDir() as tmpDir:
+            path = os.path.join(tmpDir, 'vm.recovery')
+            self._update(path)
+            self._flushDue()
+            self.vm.state['status'] = 'Migration Source'
+            self._update(path)
+            self._update(path, sync=True)
+            self.assertEquals(recoveryStore.load(path)['status'],
+                              'Migration Source')
+            # The queued write is not needed any more
+            self._flushDue(after=INTERVAL)
+            self.assertEquals(self.vm.calls, 2)
+
+    def testUnchanged(self):
+        with namedTemporaryDir() as tmpDir:
+            path = os.path.join(tmpDir, 'vm.recovery')
+            self._update(path, sync=True)
+            inode = os.stat(path).st_ino
+            self._update(path, sync=True)
+            # Not replaced by a new file
+            self.assertEquals(os.stat(path).st_ino, inode)
+
+    def testRemove(self):
+        with namedTemporaryDir() as tmpDir:
+            path = os.path.join(tmpDir, 'vm.recovery')
+            self._update(path)
+            self.store.remove('vm')
+            self._flushDue()
+            self.assertEquals(self.vm.calls, 0)
+            self.assertFalse(os.path.exists(path))
+
+    def testDestroyed(self):
+        with namedTemporaryDir() as tmpDir:
+            path = os.path.join(tmpDir, 'vm.recovery')
+            self.vm.state = None
+            self._update(path)
+            self._flushDue()
+            self.assertFalse(os.path.exists(path))
+
+    def testStop(self):
+        with namedTemporaryDir() as tmpDir:
+            path = os.path.join(tmpDir, 'vm.recovery')
+            self._update(path)
+            self.store.stop()
+            self.assertEquals(recoveryStore.load(path), self.vm.state)
+            # Written synchronously once stopped
+            self.vm.state['status'] = 'Paused'
+            self._update(path)
+            self.assertEquals(recoveryStore.load(path)['status'], 'Paused')
+
+    def testLoadOldFormat(self):
+        with namedTemporaryDir() as tmpDir:
+            path = os.path.join(tmpDir, 'vm.recovery')
+            with open(path, 'w') as f:
+                pickle.dump(self.vm.state, f)
+            self.assertEquals(recoveryStore.load(path), self.vm.state)
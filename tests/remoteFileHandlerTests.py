@@ -17,9 +17,13 @@
 #
 # Refer to the README and COPYING files for full details of the license
 #
+import errno
 import os
+import shutil
 import string
 import tempfile
+import threading
+import time
 from vdsm import utils
 
 from testrunner import VdsmTestCase as TestCaseBase
@@ -55,6 +59,49 @@ class RemoteFileHandlerTests(TestCaseBase):
             self.testTimeout()
             self.testEcho()
 
+    def testHungCall(self):
+        pool = rhandler.RemoteFileHandlerPool(1, threadsPerHandler=2)
+        try:
+            self.assertRaises(rhandler.Timeout, pool.callCrabRPCFunction,
+                              0.5, "sleep", 2)
+            pid = pool.handlers[0].process.pid
+            # The helper still has a free thread, it is not replaced
+            self.assertEquals(pool.callCrabRPCFunction(5, "echo", 1), 1)
+            self.assertEquals(pool.handlers[0].process.pid, pid)
+        finally:
+            pool.close()
+
+    def testStandbyHandlers(self):
+        pool = rhandler.RemoteFileHandlerPool(2, minHandlers=1)
+        try:
+            utils.retry(lambda: self.assertEquals(
+                pool.getStats()['handlers'], 1),
+                AssertionError, timeout=4, sleep=0.1)
+            pid = pool.handlers[0].process.pid
+            self.assertEquals(pool.callCrabRPCFunction(5, "echo", 1), 1)
+            self.assertEquals(pool.handlers[0].process.pid, pid)
+
+            # A standby handler replaces the one killed
+            self.assertRaises(rhandler.Timeout, pool.callCrabRPCFunction,
+                              0.5, "sleep", 2)
+            utils.retry(lambda: self.assertEquals(
+                pool.getStats()['handlers'], 1),
+                AssertionError, timeout=4, sleep=0.1)
+            stats = pool.getStats()
+            self.assertEquals(stats['handlersKilled'], 1)
+            self.assertEquals(stats['calls'], 2)
+        finally:
+            pool.close()
+
+    def testIdleHandlers(self):
+        pool = rhandler.RemoteFileHandlerPool(2, idleTimeout=0)
+        try:
+            self.assertEquals(pool.callCrabRPCFunction(5, "echo", 1), 1)
+            self.assertEquals(pool.callCrabRPCFunction(5, "echo", 1), 1)
+            self.assertEquals(pool.getStats()['handlers'], 0)
+        finally:
+            pool.close()
+
     def tearDown(self):
         self.pool.close()
 
@@ -73,6 +120,77 @@ class PoolHandlerTests(TestCaseBase):
         utils.retry(test, AssertionError, timeout=4, sleep=0.1)
 
 
+class CrabRPCTests(TestCaseBase):
+    def setUp(self):
+        serverRead, proxyWrite = os.pipe()
+        proxyRead, serverWrite = os.pipe()
+        self.server = rhandler.CrabRPCServer(serverRead, serverWrite,
+                                             threads=2)
+        self.event = threading.Event()
+        self.server.registerFunction(lambda x: x, "echo")
+        self.server.registerFunction(self.event.wait, "wait")
+        self.server.registerFunction(time.sleep, "sleep")
+        serverThread = threading.Thread(target=self.server.serve_forever)
+        serverThread.setDaemon(True)
+        serverThread.start()
+        self.proxy = rhandler.CrabRPCProxy(proxyRead, proxyWrite)
+
+    def tearDown(self):
+        self.event.set()
+        self.proxy.close()
+
+    def testConcurrentCalls(self):
+        results = []
+
+        def call():
+            results.append(self.proxy.callCrabRPCFunction(5, "wait", 5))
+
+        blocked = threading.Thread(target=call)
+        blocked.start()
+        try:
+            # Served while the other call is blocked in the server
+            for i in range(10):
+                self.assertEquals(
+                    self.proxy.callCrabRPCFunction(5, "echo", i), i)
+        finally:
+            self.event.set()
+            blocked.join()
+        self.assertEquals(results, [True])
+
+    def testError(self):
+        self.assertRaises(TypeError, self.proxy.callCrabRPCFunction,
+                          5, "echo")
+        self.assertEquals(self.proxy.callCrabRPCFunction(5, "echo", 1), 1)
+
+    def testLateResponse(self):
+        self.assertRaises(rhandler.Timeout, self.proxy.callCrabRPCFunction,
+                          0.2, "sleep", 0.5)
+        self.assertEquals(self.proxy.abandoned, 1)
+        time.sleep(0.5)
+        # The late response is dropped, not mistaken for this one
+        self.assertEquals(self.proxy.callCrabRPCFunction(5, "echo", 1), 1)
+        self.assertEquals(self.proxy.abandoned, 0)
+        self.assertFalse(self.proxy.broken)
+
+    def testPayloads(self):
+        lines = ["line 1\n", "line 2\n", "last line"]
+        for value in (lines, lines[:2], ["\n"], [], "", "a" * (1024 ** 2),
+                      u"unicode", ["not\nlines"], {"a": 1}):
+            self.assertEquals(self.proxy.callCrabRPCFunction(5, "echo", value),
+                              value)
+
+    def testPickleProtocol(self):
+        self.server.protocols = (rhandler.PROTOCOL_PICKLE,)
+        self.assertEquals(self.proxy.callCrabRPCFunction(5, "echo", "a"), "a")
+        self.assertEquals(self.proxy._protocol, rhandler.PROTOCOL_PICKLE)
+
+    def testNoCommonProtocol(self):
+        # Like a server not knowing about protocols
+        self.server.protocols = ()
+        self.assertEquals(self.proxy.callCrabRPCFunction(5, "echo", "a"), "a")
+        self.assertEquals(self.proxy._protocol, rhandler.PROTOCOL_PICKLE)
+
+
 class RemoteFileHandlerTruncateTests(TestCaseBase):
 
     def setUp(self):
@@ -100,3 +218,42 @@ class RemoteFileHandlerTruncateTests(TestCaseBase):
     def checkData(self, expected):
         actual = open(self.path).read()
         self.assertEquals(expected, actual)
+
+
+class RemoteFileHandlerBatchTests(TestCaseBase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = []
+        for name in ("a", "b"):
+            path = os.path.join(self.dir, name)
+            with open(path, "w") as f:
+                f.write("%s1\n%s2\n" % (name, name))
+            self.paths.append(path)
+        self.missing = os.path.join(self.dir, "missing")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testStatMany(self):
+        res = rhandler.statMany(self.paths + [self.missing])
+        self.assertEquals([st.st_size for st, err in res[:2]], [6, 6])
+        st, err = res[2]
+        self.assertEquals(st, None)
+        self.assertEquals(err.errno, errno.ENOENT)
+
+    def testReadLinesMany(self):
+        res = rhandler.readLinesMany([self.missing] + self.paths)
+        self.assertEquals(res[0][0], None)
+        self.assertEquals(res[1:], [(["a1\n", "a2\n"], None),
+                                    (["b1\n", "b2\n"], None)])
+
+    def testGlobStat(self):
+        res = rhandler.globStat(os.path.join(self.dir, "*"))
+        self.assertEquals(sorted(path for path, st, err in res), self.paths)
+        self.assertTrue(all(err is None for path, st, err in res))
+
+    def testGlobMany(self):
+        res = rhandler.globMany([os.path.join(self.dir, "a*"),
+                                 os.path.join(self.missing, "*")])
+        self.assertEquals(res, [([self.paths[0]], None), ([], None)])
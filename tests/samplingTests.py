@@ -0,0 +1,339 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+import threading
+import time
+
+from testrunner import VdsmTestCase as TestCaseBase
+
+import sampling
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class AdvancedStatsThreadTests(TestCaseBase):
+    def testHyperperiod(self):
+        self.assertEquals(sampling._hyperperiod([2, 60, 15, 60]), 60)
+        self.assertEquals(sampling._hyperperiod([4, 6]), 12)
+        self.assertEquals(sampling._hyperperiod([]), 1)
+
+    def testNextTick(self):
+        thread = sampling.AdvancedStatsThread()
+        thread.addStatsFunction(sampling.AdvancedStatsFunction(None, 4),
+                                sampling.AdvancedStatsFunction(None, 6))
+        ticks = [0]
+        while ticks[-1] < 12:
+            ticks.append(thread._nextTick(ticks[-1]))
+        self.assertEquals(ticks, [0, 4, 6, 8, 12])
+
+    def testCollect(self):
+        done = threading.Event()
+        calls = []
+
+        def sample():
+            calls.append(1)
+            if len(calls) == 2:
+                done.set()
+
+        thread = sampling.AdvancedStatsThread(daemon=True)
+        statsFunction = sampling.AdvancedStatsFunction(sample, 1)
+        thread.addStatsFunction(statsFunction)
+        thread.start()
+        try:
+            done.wait(5)
+        finally:
+            thread.stop()
+        self.assertTrue(done.isSet())
+        self.assertEquals(statsFunction.getTimings()['calls'], 2)
+
+
+class AdvancedStatsFunctionTests(TestCaseBase):
+    def testTimings(self):
+        statsFunction = sampling.AdvancedStatsFunction(lambda: 0, 1)
+        statsFunction()
+        statsFunction.recordJitter(0.5)
+        statsFunction.recordSkipped(2)
+        timings = statsFunction.getTimings()
+        self.assertEquals(timings['calls'], 1)
+        self.assertEquals(timings['maxJitter'], 0.5)
+        self.assertEquals(timings['skipped'], 2)
+
+    def testLatency(self):
+        statsFunction = sampling.AdvancedStatsFunction(
+            lambda: time.sleep(0.001), 1)
+        statsFunction()
+        # Measured below the resolution of utils.monotonic_time
+        latency = statsFunction.getTimings()['latency']
+        self.assertTrue(0.001 <= latency < 0.01, latency)
+
+
+class SampleSchedulerTests(TestCaseBase):
+    def _newScheduler(self, clock):
+        # The dispatcher and workers are not started: the tests drive the
+        # scheduler by hand to get deterministic results.
+        return sampling.SampleScheduler(1, timefn=clock)
+
+    def testScheduledFunctionRuns(self):
+        calls = []
+        clock = FakeClock()
+        scheduler = self._newScheduler(clock)
+        group = sampling.AdvancedStatsGroup(scheduler)
+        func = sampling.AdvancedStatsFunction(lambda: calls.append(1), 10)
+        group.addStatsFunction(func)
+        group.start()
+
+        _, _, call = scheduler._calls[0]
+        scheduler._run(call)
+
+        self.assertEquals(calls, [1])
+        self.assertEquals(call.deadline, 1010.0)
+        self.assertTrue(group.getLastSampleTime() is not None)
+
+    def testLateSampleSkipsMissedDeadlines(self):
+        clock = FakeClock()
+        scheduler = self._newScheduler(clock)
+        group = sampling.AdvancedStatsGroup(scheduler)
+        group.addStatsFunction(sampling.AdvancedStatsFunction(lambda: 0, 10))
+        group.start()
+
+        _, _, call = scheduler._calls[0]
+        clock.now += 25
+        scheduler._run(call)
+
+        self.assertEquals(call.delay, 25.0)
+        self.assertEquals(call.deadline, 1030.0)
+        self.assertEquals(scheduler.getStats()['maxDelay'], 25.0)
+
+    def testPausedGroupDoesNotSample(self):
+        calls = []
+        clock = FakeClock()
+        scheduler = self._newScheduler(clock)
+        group = sampling.AdvancedStatsGroup(scheduler)
+        group.addStatsFunction(
+            sampling.AdvancedStatsFunction(lambda: calls.append(1), 10))
+        group.start()
+        group.pause()
+
+        _, _, call = scheduler._calls[0]
+        scheduler._run(call)
+
+        self.assertEquals(calls, [])
+        self.assertEquals(call.deadline, 1010.0)
+
+    def testStoppedGroupIsNotRescheduled(self):
+        clock = FakeClock()
+        scheduler = self._newScheduler(clock)
+        group = sampling.AdvancedStatsGroup(scheduler)
+        group.addStatsFunction(sampling.AdvancedStatsFunction(lambda: 0, 10))
+        group.start()
+
+        _, _, call = scheduler._calls.pop()
+        group.stop()
+        scheduler._run(call)
+
+        self.assertEquals(scheduler.getStats()['scheduled'], 0)
+
+    def testWorkersRunDueFunctions(self):
+        done = threading.Event()
+        scheduler = sampling.SampleScheduler(2)
+        group = sampling.AdvancedStatsGroup(scheduler)
+        group.addStatsFunction(sampling.AdvancedStatsFunction(done.set, 1))
+        scheduler.start()
+        try:
+            group.start()
+            done.wait(5)
+            self.assertTrue(done.isSet())
+        finally:
+            group.stop()
+            scheduler.stop()
+
+
+class FakeDomain(object):
+    def __init__(self, uuid):
+        self._uuid = uuid
+
+    def UUIDString(self):
+        return self._uuid
+
+
+class FakeConnection(object):
+    def __init__(self, domStats):
+        self.domStats = domStats
+        self.calls = []
+
+    def getAllDomainStats(self, stats, flags):
+        self.calls.append(stats)
+        return [(FakeDomain(uuid), domStats)
+                for uuid, domStats in self.domStats.iteritems()]
+
+
+class FakeCollector(sampling.AdvancedStatsGroup):
+    def __init__(self, scheduler):
+        sampling.AdvancedStatsGroup.__init__(self, scheduler)
+        self.sampleCpu = sampling.AdvancedStatsFunction(self._sampleCpu,
+                                                        15, 2)
+        self.sampleNet = sampling.AdvancedStatsFunction(self._sampleNet,
+                                                        15, 2)
+
+    def _sampleCpu(self, bulkStats=None):
+        return sampling.bulkCpuStats(bulkStats)
+
+    def _sampleNet(self, bulkStats=None):
+        return sampling.bulkNetStats(bulkStats)
+
+
+BULK_STATS = {
+    'cpu.time': 3000, 'cpu.user': 1000, 'cpu.system': 500,
+    'net.count': 1, 'net.0.name': 'vnet0',
+    'net.0.rx.bytes': 10, 'net.0.rx.pkts': 1, 'net.0.rx.errs': 0,
+    'net.0.rx.drop': 0, 'net.0.tx.bytes': 20, 'net.0.tx.pkts': 2,
+    'net.0.tx.errs': 0, 'net.0.tx.drop': 0,
+    'block.count': 1, 'block.0.name': 'vda',
+    'block.0.rd.reqs': 4, 'block.0.rd.bytes': 4096, 'block.0.rd.times': 40,
+    'block.0.wr.reqs': 2, 'block.0.wr.bytes': 1024, 'block.0.wr.times': 30,
+    'block.0.fl.reqs': 1, 'block.0.fl.times': 5,
+}
+
+
+class BulkStatsTests(TestCaseBase):
+    def testCpuStats(self):
+        self.assertEquals(sampling.bulkCpuStats(BULK_STATS),
+                          {'cpu_time': 3000, 'user_time': 1000,
+                           'system_time': 500})
+
+    def testNetStats(self):
+        self.assertEquals(sampling.bulkNetStats(BULK_STATS),
+                          {'vnet0': (10, 1, 0, 0, 20, 2, 0, 0)})
+
+    def testDiskStats(self):
+        self.assertEquals(sampling.bulkDiskStats(BULK_STATS),
+                          {'vda': (4, 4096, 2, 1024, -1)})
+
+    def testDiskLatencyStats(self):
+        latency = sampling.bulkDiskLatencyStats(BULK_STATS)['vda']
+        self.assertEquals(latency['rd_total_times'], 40)
+        self.assertEquals(latency['wr_operations'], 2)
+        self.assertEquals(latency['flush_total_times'], 5)
+
+    def testTimings(self):
+        conn = FakeConnection({'uuid': BULK_STATS})
+        scheduler = sampling.SampleScheduler(1, timefn=FakeClock())
+        sampler = sampling.BulkStatsSampler(scheduler, conn,
+                                            {sampling.BULK_CPU: 15})
+        sampler._statsFunctions[0]()
+        timings = sampler.getTimings()
+        self.assertEquals(timings.keys(), ['sampleBulkStats_cpu'])
+        self.assertEquals(timings['sampleBulkStats_cpu']['calls'], 1)
+
+    def testOneLibvirtCallForAllDomains(self):
+        uuids = ['uuid-%d' % i for i in range(10)]
+        conn = FakeConnection(dict((uuid, BULK_STATS) for uuid in uuids))
+        scheduler = sampling.SampleScheduler(1, timefn=FakeClock())
+        sampler = sampling.BulkStatsSampler(
+            scheduler, conn,
+            {sampling.BULK_CPU: 15, sampling.BULK_NET: 15})
+        collectors = []
+        for uuid in uuids:
+            collector = FakeCollector(scheduler)
+            sampler.register(uuid, collector,
+                             {sampling.BULK_CPU: collector.sampleCpu,
+                              sampling.BULK_NET: collector.sampleNet})
+            collectors.append(collector)
+
+        sampler._sample([sampling.BULK_CPU, sampling.BULK_NET])
+
+        self.assertEquals(len(conn.calls), 1)
+        for collector in collectors:
+            self.assertEquals(collector.sampleCpu.getLastSample()['cpu_time'],
+                              3000)
+            self.assertTrue('vnet0' in collector.sampleNet.getLastSample())
+
+    def testPausedCollectorIsSkipped(self):
+        conn = FakeConnection({'uuid': BULK_STATS})
+        scheduler = sampling.SampleScheduler(1, timefn=FakeClock())
+        sampler = sampling.BulkStatsSampler(scheduler, conn,
+                                            {sampling.BULK_CPU: 15})
+        collector = FakeCollector(scheduler)
+        sampler.register('uuid', collector,
+                         {sampling.BULK_CPU: collector.sampleCpu})
+        collector.pause()
+
+        sampler._sample([sampling.BULK_CPU])
+
+        self.assertEquals(collector.sampleCpu.getLastSample(), None)
+
+
+class SampleWindowTests(TestCaseBase):
+    def testOverwritesOldestSample(self):
+        window = sampling.SampleWindow(3)
+        for i in range(5):
+            window.append(float(i), i * 10)
+        self.assertEquals(len(window), 3)
+        self.assertEquals(window.first(), (2.0, 20))
+        self.assertEquals(window.last(), (4.0, 40))
+        self.assertEquals(list(window),
+                          [(2.0, 20), (3.0, 30), (4.0, 40)])
+
+    def testStats(self):
+        window = sampling.SampleWindow(4)
+        self.assertEquals(window.stats(), (None, None, None))
+        for i in range(6):
+            window.append(i * 15.0, i)
+        self.assertEquals(window.stats(), (2, 5, 45.0))
+
+    def testSubWindowStats(self):
+        window = sampling.SampleWindow(10)
+        for i in range(10):
+            window.append(i * 15.0, i)
+        self.assertEquals(window.stats(15), (8, 9, 15.0))
+        self.assertEquals(window.stats(60), (5, 9, 60.0))
+        self.assertEquals(window.stats(1), (None, None, None))
+
+    def testCounterWindow(self):
+        window = sampling.CounterWindow(2, sampling.CPU_STATS_FIELDS)
+        window.append(1.0, {'cpu_time': 10, 'user_time': 5,
+                            'system_time': 2})
+        window.append(2.0, None)
+        window.append(3.0, {'cpu_time': 30, 'user_time': 15})
+        self.assertEquals(window.first(), (2.0, None))
+        self.assertEquals(window.last(),
+                          (3.0, {'cpu_time': 30, 'user_time': 15,
+                                 'system_time': 0}))
+
+    def testAdvancedStatsFunctionWindow(self):
+        values = iter(range(10))
+        clock = FakeClock(0)
+
+        def tick():
+            clock.now += 15
+            return next(values)
+
+        statsFunction = sampling.AdvancedStatsFunction(tick, 15, 3,
+                                                       timefn=clock)
+        for i in range(5):
+            statsFunction()
+        self.assertEquals(statsFunction.getStats(), (2, 4, 30))
+        self.assertEquals(statsFunction.getStats(15), (3, 4, 15))
+        self.assertEquals(statsFunction.getLastSample(), 4)
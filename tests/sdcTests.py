@@ -0,0 +1,166 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+import threading
+
+from testrunner import VdsmTestCase as TestCaseBase
+import monkeypatch
+
+from storage import sdc
+from storage import storage_exception as se
+
+SD_UUID = "d0d7f2a3-3ed6-4bb1-a5f8-1a0a5bc87fdc"
+
+
+class FakeStorageDomainCache(sdc.StorageDomainCache):
+    def __init__(self, findMethods):
+        sdc.StorageDomainCache.__init__(self, "/rhev/data-center")
+        self.findMethods = findMethods
+
+    def _findMethods(self):
+        return self.findMethods
+
+
+class Lookup(object):
+    def __init__(self, result=None, error=se.StorageDomainDoesNotExist):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.event = None
+
+    def __call__(self, sdUUID):
+        self.calls += 1
+        if self.event is not None:
+            self.event.wait()
+        if self.result is None:
+            raise self.error(sdUUID)
+        return self.result
+
+
+class FakeDomain(object):
+    def __init__(self, sdUUID):
+        self.sdUUID = sdUUID
+
+
+class FindUnfetchedDomainTests(TestCaseBase):
+    def testFirstFound(self):
+        blocked = Lookup()
+        blocked.event = threading.Event()
+        cache = FakeStorageDomainCache([blocked, Lookup("domain")])
+        try:
+            self.assertEquals(cache._findUnfetchedDomain(SD_UUID), "domain")
+        finally:
+            blocked.event.set()
+
+    def testMissing(self):
+        lookups = [Lookup(), Lookup()]
+        cache = FakeStorageDomainCache(lookups)
+        for i in range(2):
+            self.assertRaises(se.StorageDomainDoesNotExist,
+                              cache._findUnfetchedDomain, SD_UUID)
+        self.assertEquals([l.calls for l in lookups], [1, 1])
+
+    def testInvalidateStorage(self):
+        lookups = [Lookup()]
+        cache = FakeStorageDomainCache(lookups)
+        self.assertRaises(se.StorageDomainDoesNotExist,
+                          cache._findUnfetchedDomain, SD_UUID)
+        cache.invalidateStorage()
+        self.assertRaises(se.StorageDomainDoesNotExist,
+                          cache._findUnfetchedDomain, SD_UUID)
+        self.assertEquals(lookups[0].calls, 2)
+
+    def testLookupError(self):
+        lookups = [Lookup(), Lookup(error=RuntimeError)]
+        cache = FakeStorageDomainCache(lookups)
+        for i in range(2):
+            self.assertRaises(se.StorageDomainDoesNotExist,
+                              cache._findUnfetchedDomain, SD_UUID)
+        # A lookup failed, the domain may still exist
+        self.assertEquals([l.calls for l in lookups], [2, 2])
+
+    @monkeypatch.MonkeyPatch(sdc, "MISSING_DOMAIN_TTL", -1)
+    def testExpired(self):
+        lookups = [Lookup()]
+        cache = FakeStorageDomainCache(lookups)
+        for i in range(2):
+            self.assertRaises(se.StorageDomainDoesNotExist,
+                              cache._findUnfetchedDomain, SD_UUID)
+        self.assertEquals(lookups[0].calls, 2)
+
+    @monkeypatch.MonkeyPatch(sdc, "MAX_MISSING_DOMAINS", 1)
+    def testBounded(self):
+        lookups = [Lookup()]
+        cache = FakeStorageDomainCache(lookups)
+        for sdUUID in (SD_UUID, "other", SD_UUID):
+            self.assertRaises(se.StorageDomainDoesNotExist,
+                              cache._findUnfetchedDomain, sdUUID)
+        self.assertEquals(lookups[0].calls, 3)
+
+
+class ProduceTests(TestCaseBase):
+    def setUp(self):
+        self.invalidated = []
+        self.patch = monkeypatch.Patch([
+            (sdc.multipath, "rescan", lambda: None),
+            (sdc.lvm, "invalidateDevices", self.invalidated.append),
+        ])
+        self.patch.apply()
+        self.lookup = Lookup(FakeDomain(SD_UUID))
+        self.cache = FakeStorageDomainCache([self.lookup])
+        self.produced = 0
+        produce = self.cache._produce
+
+        def countingProduce(sdUUID):
+            self.produced += 1
+            return produce(sdUUID)
+
+        self.cache._produce = countingProduce
+
+    def tearDown(self):
+        self.patch.revert()
+
+    def testRefreshDevices(self):
+        self.cache.produce(SD_UUID)
+        # Only the vg of the domain looked up is invalidated
+        self.assertEquals(self.invalidated, [set([SD_UUID])])
+        self.cache.produce(SD_UUID)
+        self.assertEquals(len(self.invalidated), 1)
+
+    def testProxyKeepsDomain(self):
+        dom = self.cache.produce(SD_UUID)
+        produced = self.produced
+        for i in range(3):
+            self.assertEquals(dom.sdUUID, SD_UUID)
+        self.assertEquals(self.produced, produced)
+
+    def testProxyRemovedDomain(self):
+        dom = self.cache.produce(SD_UUID)
+        self.cache.manuallyRemoveDomain(SD_UUID)
+        self.assertEquals(dom.sdUUID, SD_UUID)
+        self.assertEquals(self.lookup.calls, 2)
+
+    def testProxyRefresh(self):
+        dom = self.cache.produce(SD_UUID)
+        with monkeypatch.MonkeyPatchScope([
+                (sdc.lvm, "invalidateCache", lambda: None)]):
+            self.cache.refresh()
+        self.assertEquals(dom.sdUUID, SD_UUID)
+        self.assertEquals(self.lookup.calls, 2)
@@ -56,3 +56,93 @@ class SPM_MailMonitorTests(TestCaseBase):
         mailer.run()
         t = lambda: self.assertEquals(threadCount, len(threading.enumerate()))
         retry(AssertionError, t, timeout=4, sleep=0.1)
+
+    def testSendReply(self):
+        pool = StoragePoolStub()
+        mailer = sm.SPM_MailMonitor(pool, 10)
+        mailer.stop()
+        outbox = os.path.join(pool.storage_repository, pool.spUUID,
+                              "mastersd", DOMAIN_META_DATA, "outbox")
+        # Data written by others in another block of the mailbox
+        with open(outbox, "r+") as f:
+            f.seek(sm.BLOCK_SIZE)
+            f.write("x" * sm.BLOCK_SIZE)
+
+        class Reply(object):
+            payload = "r" * sm.MESSAGE_SIZE
+
+        msgID = 2 * sm.SLOTS_PER_MAILBOX + 1
+        mailer.sendReply(msgID, Reply())
+        with open(outbox) as f:
+            outMail = f.read()
+        msgStart = msgID * sm.MESSAGE_SIZE
+        self.assertEquals(outMail[msgStart:msgStart + sm.MESSAGE_SIZE],
+                          Reply.payload)
+        # Only the block of the reply was written
+        self.assertEquals(outMail[sm.BLOCK_SIZE:2 * sm.BLOCK_SIZE],
+                          "x" * sm.BLOCK_SIZE)
+
+
+class BlockRangesTests(TestCaseBase):
+    def test(self):
+        self.assertEquals(sm._blockRanges([]), [])
+        self.assertEquals(sm._blockRanges([0, 1, 2, 5, 7, 8]),
+                          [[0, 3], [5, 6], [7, 9]])
+
+
+class FakeTime(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class AdaptiveIntervalTests(TestCaseBase):
+    def setUp(self):
+        self.time = FakeTime()
+        self.interval = sm.AdaptiveInterval(0.25, 2, 10, timefn=self.time)
+
+    def testIdle(self):
+        self.assertEquals(self.interval.next(), 2)
+
+    def testBusy(self):
+        self.interval.activity()
+        self.time.now = 9
+        self.assertEquals(self.interval.next(), 0.25)
+
+    def testBackOff(self):
+        self.interval.activity()
+        self.time.now = 10
+        self.assertEquals([self.interval.next() for i in range(5)],
+                          [0.5, 1, 2, 2, 2])
+
+
+class HandleRequestsTests(TestCaseBase):
+    def setUp(self):
+        self.pool = StoragePoolStub()
+        self.mailer = sm.SPM_MailMonitor(self.pool, 4)
+        self.mailer.stop()
+        self.validated = []
+
+        def validate(mailbox, mailboxIndex):
+            self.validated.append(mailboxIndex)
+            return False
+
+        self.mailer._validateMailbox = validate
+
+    def testSkipUnchangedMailboxes(self):
+        message = sm.MESSAGE_VERSION + "x" * (sm.MESSAGE_SIZE - 1)
+        mailbox = message + "\0" * (sm.MAILBOX_SIZE - sm.MESSAGE_SIZE)
+        newMail = (sm.EMPTYMAILBOX + mailbox + mailbox + sm.EMPTYMAILBOX)
+        self.mailer._handleRequests(newMail)
+        self.assertEquals(self.validated, [1, 2])
+
+        # Mailbox 1 was emptied, mailbox 2 did not change
+        newMail = (sm.EMPTYMAILBOX + sm.EMPTYMAILBOX + mailbox +
+                   sm.EMPTYMAILBOX)
+        self.mailer._incomingMail = (sm.EMPTYMAILBOX + mailbox + mailbox +
+                                     sm.EMPTYMAILBOX)
+        del self.validated[:]
+        self.mailer._handleRequests(newMail)
+        self.assertEquals(self.validated, [])
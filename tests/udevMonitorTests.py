@@ -0,0 +1,159 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+
+import threading
+import time
+
+from testrunner import VdsmTestCase as TestCaseBase
+
+import storage.udevMonitor as udevMonitor
+
+MONITOR_OUTPUT = """\
+monitor will print the received events for:
+UDEV - the event which udev sends out after rule processing
+
+UDEV  [5117.376434] change   /devices/virtual/block/dm-3 (block)
+ACTION=change
+DEVNAME=/dev/dm-3
+DM_LV_NAME=lv1
+DM_NAME=vg1-lv1
+DM_VG_NAME=vg1
+SUBSYSTEM=block
+
+UDEV  [5117.384217] remove   /devices/virtual/block/dm-4 (block)
+ACTION=remove
+DEVNAME=/dev/dm-4
+SUBSYSTEM=block
+
+"""
+
+
+class FakeEventSource(object):
+    def __init__(self, events):
+        self._events = events
+        self._closed = threading.Event()
+
+    @property
+    def closed(self):
+        return self._closed.isSet()
+
+    def events(self):
+        for event in self._events:
+            yield event
+        # Like udevadm, wait for more events until closed
+        self._closed.wait()
+
+    def close(self):
+        self._closed.set()
+
+
+class DyingEventSource(FakeEventSource):
+    """
+    Fails on the first runs, then reports its events.
+    """
+    def __init__(self, events, failures):
+        FakeEventSource.__init__(self, events)
+        self.failures = failures
+        self.runs = 0
+
+    def events(self):
+        self.runs += 1
+        if self.runs <= self.failures:
+            raise OSError("udevadm failed")
+        return FakeEventSource.events(self)
+
+
+def _waitFor(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("Timeout waiting for %s" % predicate)
+        time.sleep(0.01)
+
+
+class ParseEventsTests(TestCaseBase):
+    def testParse(self):
+        lines = MONITOR_OUTPUT.splitlines(True)
+        events = list(udevMonitor.parseEvents(lines))
+        self.assertEquals(events, [
+            {"ACTION": "change", "DEVNAME": "/dev/dm-3",
+             "DM_LV_NAME": "lv1", "DM_NAME": "vg1-lv1",
+             "DM_VG_NAME": "vg1", "SUBSYSTEM": "block"},
+            {"ACTION": "remove", "DEVNAME": "/dev/dm-4",
+             "SUBSYSTEM": "block"}])
+
+    def testIncompleteEvent(self):
+        lines = ["ACTION=change\n", "DEVNAME=/dev/dm-3\n"]
+        self.assertEquals(list(udevMonitor.parseEvents(lines)), [])
+
+
+class UdevMonitorTests(TestCaseBase):
+    def testHandleEvents(self):
+        events = [{"ACTION": "add"}, {"ACTION": "change"}]
+        handled = []
+        monitor = udevMonitor.UdevMonitor(handled.append,
+                                          FakeEventSource(events))
+        monitor.start()
+        _waitFor(lambda: len(handled) == 2)
+        self.assertTrue(monitor.connected)
+        monitor.stop()
+        monitor.wait(2)
+        self.assertEquals(handled, events)
+
+    def testHandlerError(self):
+        handled = []
+
+        def handler(event):
+            if event["ACTION"] == "add":
+                raise RuntimeError("bad event")
+            handled.append(event)
+
+        source = FakeEventSource([{"ACTION": "add"}, {"ACTION": "change"}])
+        monitor = udevMonitor.UdevMonitor(handler, source)
+        monitor.start()
+        _waitFor(lambda: handled)
+        monitor.stop()
+        monitor.wait(2)
+        self.assertEquals(handled, [{"ACTION": "change"}])
+
+    def testStop(self):
+        source = FakeEventSource([])
+        monitor = udevMonitor.UdevMonitor(lambda event: None, source)
+        monitor.stop()
+        self.assertTrue(source.closed)
+
+    def testRestart(self):
+        events = [{"ACTION": "change"}]
+        handled = []
+        resynced = []
+        source = DyingEventSource(events, failures=2)
+
+        monitor = udevMonitor.UdevMonitor(
+            handled.append, source, resync=lambda: resynced.append(True))
+        monitor.RESTART_DELAY = 0.01
+        monitor.start()
+        _waitFor(lambda: handled)
+        monitor.stop()
+        monitor.wait(2)
+        self.assertEquals(source.runs, 3)
+        self.assertEquals(resynced, [True, True])
+        self.assertEquals(handled, events)
+        self.assertFalse(monitor.connected)
@@ -0,0 +1,201 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+import threading
+import time
+
+from testrunner import VdsmTestCase as TestCaseBase
+
+import vm
+import vmRecovery
+
+
+def _vdsmDrive(imageID, volumeID):
+    return {'device': 'disk', 'domainID': 'sd', 'poolID': 'sp',
+            'imageID': imageID, 'volumeID': volumeID}
+
+
+class FakeDomain(object):
+    def __init__(self, vmId, vdsm=True):
+        self.vmId = vmId
+        self.vdsm = vdsm
+        self.destroyed = False
+
+    def UUIDString(self):
+        return self.vmId
+
+    def destroy(self):
+        self.destroyed = True
+
+
+class FakeVm(object):
+    def __init__(self, cif, vmId, drives):
+        self.cif = cif
+        self.id = vmId
+        self.drives = drives
+        self.lastStatus = 'WaitForLaunch'
+        self.failOn = None
+        self.prepared = None
+
+    def buildConfDevices(self):
+        return {vm.DISK_DEVICES: self.drives}
+
+    def prepareDrivePath(self, drive):
+        key = (drive.get('domainID'), drive.get('imageID'))
+        with self.cif.lock:
+            if key in self.cif.preparing:
+                self.cif.overlaps.append(key)
+            self.cif.preparing.add(key)
+        try:
+            time.sleep(0.01)
+            if drive is self.failOn:
+                raise RuntimeError("prepare failed")
+        finally:
+            with self.cif.lock:
+                self.cif.preparing.discard(key)
+        return True
+
+    def pathsPrepared(self, drives):
+        self.prepared = drives
+
+
+class FakeClientIF(object):
+    def __init__(self):
+        self._enabled = True
+        self.vmContainer = {}
+        self.recoveryDrives = {}
+        self.poolConnected = threading.Event()
+        self.poolConnected.set()
+        self.lock = threading.Lock()
+        self.preparing = set()
+        self.overlaps = []
+
+    def isVDSMVm(self, dom):
+        return dom.vdsm
+
+    def _recoverVm(self, vmId):
+        if vmId not in self.recoveryDrives:
+            return None
+        vmObj = FakeVm(self, vmId, self.recoveryDrives[vmId])
+        vmObj.lastStatus = 'Up'
+        self.vmContainer[vmId] = vmObj
+        return {'status': {'code': 0}}
+
+    def _waitForStoragePool(self):
+        self.poolConnected.wait()
+
+
+class VmRecoveryTests(TestCaseBase):
+    def setUp(self):
+        self.cif = FakeClientIF()
+        self.created = []
+
+    def _run(self, domains, workers=4):
+        recovery = vmRecovery.VmRecovery(self.cif, workers)
+        recovery.CREATION_POLL_INTERVAL = 0.01
+        recovery.run(domains, lambda: self.created.append(True))
+        return recovery.progress.getStats()
+
+    def testRecover(self):
+        domains = []
+        for i in range(10):
+            vmId = 'vm%d' % i
+            self.cif.recoveryDrives[vmId] = [
+                _vdsmDrive('img%d' % i, 'vol'),
+                {'device': 'cdrom', 'path': ''}]
+            domains.append(FakeDomain(vmId))
+        stats = self._run(domains)
+        self.assertEquals(stats, {'total': 10, 'skipped': 0, 'created': 10,
+                                  'prepared': 10, 'failed': 0})
+        self.assertEquals(self.created, [True])
+        for vmId, vmObj in self.cif.vmContainer.items():
+            self.assertEquals(vmObj.prepared,
+                              self.cif.recoveryDrives[vmId])
+
+    def testSharedImage(self):
+        domains = []
+        for i in range(6):
+            vmId = 'vm%d' % i
+            self.cif.recoveryDrives[vmId] = [_vdsmDrive('shared', vmId),
+                                             _vdsmDrive('img%d' % i, 'vol')]
+            domains.append(FakeDomain(vmId))
+        stats = self._run(domains)
+        self.assertEquals(stats['prepared'], 6)
+        self.assertEquals(self.cif.overlaps, [])
+
+    def testNotVdsmDomain(self):
+        dom = FakeDomain('other', vdsm=False)
+        stats = self._run([dom])
+        self.assertEquals(stats['skipped'], 1)
+        self.assertFalse(dom.destroyed)
+
+    def testLooseQemu(self):
+        dom = FakeDomain('loose')
+        stats = self._run([dom])
+        self.assertEquals(stats['failed'], 1)
+        self.assertTrue(dom.destroyed)
+
+    def testPrepareFailure(self):
+        drives = [_vdsmDrive('img1', 'vol'), _vdsmDrive('img2', 'vol')]
+        self.cif.recoveryDrives['bad'] = drives
+        self.cif.recoveryDrives['good'] = [_vdsmDrive('img3', 'vol')]
+
+        origRecoverVm = self.cif._recoverVm
+
+        def recoverVm(vmId):
+            res = origRecoverVm(vmId)
+            if vmId == 'bad':
+                self.cif.vmContainer[vmId].failOn = drives[0]
+            return res
+
+        self.cif._recoverVm = recoverVm
+        stats = self._run([FakeDomain('bad'), FakeDomain('good')])
+        self.assertEquals(stats['failed'], 1)
+        self.assertEquals(stats['prepared'], 1)
+        self.assertEquals(self.cif.vmContainer['bad'].prepared, None)
+        self.assertNotEquals(self.cif.vmContainer['good'].prepared, None)
+
+    def testReadyBeforePrepared(self):
+        # The vms are created while the storage pool is not connected yet
+        self.cif.poolConnected.clear()
+        self.cif.recoveryDrives['vm'] = [_vdsmDrive('img', 'vol')]
+        recovery = vmRecovery.VmRecovery(self.cif, 2)
+        recovery.CREATION_POLL_INTERVAL = 0.01
+        recovery.run([FakeDomain('vm')], self.cif.poolConnected.set)
+        self.assertNotEquals(self.cif.vmContainer['vm'].prepared, None)
+
+    def testCreatedBeforeRecoveryDone(self):
+        self.cif.recoveryDrives['vm1'] = [_vdsmDrive('img1', 'vol')]
+        self.cif.recoveryDrives['vm2'] = [_vdsmDrive('img2', 'vol')]
+        recovery = vmRecovery.VmRecovery(self.cif, 1)
+        recovery.CREATION_POLL_INTERVAL = 0.01
+        created = []
+        origRecoverVm = self.cif._recoverVm
+
+        def recoverVm(vmId):
+            created.append((recovery.isCreated('vm1'),
+                            recovery.isCreated('vm2')))
+            return origRecoverVm(vmId)
+
+        self.cif._recoverVm = recoverVm
+        recovery.run([FakeDomain('vm1'), FakeDomain('vm2')], lambda: None)
+        # vm1 can be used while vm2 is recovered
+        self.assertEquals(created, [(False, False), (True, False)])
+        self.assertTrue(recovery.isCreated('vm2'))
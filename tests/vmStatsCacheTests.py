@@ -0,0 +1,140 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+import xmlrpclib
+
+from testrunner import VdsmTestCase as TestCaseBase
+
+import vmStatsCache
+
+
+def _stats(status='Up', elapsedTime='10', rxRate='0.0'):
+    return {'status': status, 'elapsedTime': elapsedTime,
+            'network': {'vnet0': {'rxRate': rxRate, 'state': 'unknown'}}}
+
+
+class FakeVms(object):
+    """
+    The statistics of the vms, as polled by getAllVmStats.
+    """
+    def __init__(self, statsByVm):
+        self.statsByVm = statsByVm
+        self.calls = []
+
+    def getStats(self, vmId):
+        self.calls.append(vmId)
+        return self.statsByVm.get(vmId)
+
+    def refresh(self, cache):
+        volatileByVm = dict(
+            (vmId, {'status': stats['status'],
+                    'elapsedTime': stats['elapsedTime']})
+            for vmId, stats in self.statsByVm.iteritems())
+        return cache.refresh(volatileByVm, self.getStats)
+
+
+class VmStatsCacheTests(TestCaseBase):
+    def testFullResponseWithoutToken(self):
+        cache = vmStatsCache.VmStatsCache()
+        FakeVms({'vm1': _stats(), 'vm2': _stats()}).refresh(cache)
+        full, changed, removed, token = cache.getChangedSince(None)
+        self.assertTrue(full)
+        self.assertEquals(len(changed), 2)
+        self.assertEquals(removed, [])
+
+    def testOnlyChangedVms(self):
+        cache = vmStatsCache.VmStatsCache()
+        FakeVms({'vm1': _stats(), 'vm2': _stats()}).refresh(cache)
+        token = cache.getChangedSince(None)[3]
+
+        FakeVms({'vm1': _stats(elapsedTime='12'),
+                 'vm2': _stats(status='Paused')}).refresh(cache)
+        full, changed, removed, token = cache.getChangedSince(token)
+
+        self.assertFalse(full)
+        self.assertEquals([s['status'] for s in changed], ['Paused'])
+
+        full, changed, removed, token = cache.getChangedSince(token)
+        self.assertEquals(changed, [])
+
+    def testStatsFetchedOnlyWhenStale(self):
+        cache = vmStatsCache.VmStatsCache()
+        vms = FakeVms({'vm1': _stats(), 'vm2': _stats()})
+        vms.refresh(cache)
+        self.assertEquals(sorted(vms.calls), ['vm1', 'vm2'])
+
+        vms = FakeVms({'vm1': _stats(elapsedTime='12'),
+                       'vm2': _stats(status='Paused')})
+        vms.refresh(cache)
+        self.assertEquals(vms.calls, ['vm2'])
+
+    def testSampledRatesAreNotChanges(self):
+        cache = vmStatsCache.VmStatsCache()
+        FakeVms({'vm1': _stats()}).refresh(cache)
+        token = cache.getChangedSince(None)[3]
+
+        cache.update('vm1', _stats(rxRate='12.5'))
+        full, changed, removed, token = cache.getChangedSince(token)
+        self.assertEquals(changed, [])
+        entries = FakeVms({'vm1': _stats()}).refresh(cache)
+        self.assertEquals(entries[0]['network']['vnet0']['rxRate'], '12.5')
+
+        stats = _stats()
+        stats['network']['vnet0']['state'] = 'up'
+        cache.update('vm1', stats)
+        full, changed, removed, token = cache.getChangedSince(token)
+        self.assertEquals(len(changed), 1)
+
+    def testRemovedVms(self):
+        cache = vmStatsCache.VmStatsCache()
+        FakeVms({'vm1': _stats(), 'vm2': _stats()}).refresh(cache)
+        token = cache.getChangedSince(None)[3]
+
+        FakeVms({'vm1': _stats()}).refresh(cache)
+        full, changed, removed, token = cache.getChangedSince(token)
+
+        self.assertFalse(full)
+        self.assertEquals(changed, [])
+        self.assertEquals(removed, ['vm2'])
+
+    def testTokenOfAnotherCache(self):
+        cache = vmStatsCache.VmStatsCache()
+        FakeVms({'vm1': _stats()}).refresh(cache)
+        token = vmStatsCache.VmStatsCache().getChangedSince(None)[3]
+        self.assertTrue(cache.getChangedSince(token)[0])
+
+    def testInvalidToken(self):
+        cache = vmStatsCache.VmStatsCache()
+        self.assertTrue(cache.getChangedSince('garbage')[0])
+
+    def testVolatileValuesAreRefreshed(self):
+        cache = vmStatsCache.VmStatsCache()
+        FakeVms({'vm1': _stats()}).refresh(cache)
+        entries = FakeVms({'vm1': _stats(elapsedTime='20')}).refresh(cache)
+        self.assertEquals(entries[0]['elapsedTime'], '20')
+
+    def testXmlrpcEncoding(self):
+        cache = vmStatsCache.VmStatsCache()
+        FakeVms({'vm1': _stats()}).refresh(cache)
+        entries = FakeVms({'vm1': _stats(elapsedTime='20')}).refresh(cache)
+        entry = entries[0]
+        encoded = ''.join(('<params>\n<param>\n', entry.xmlrpc(),
+                           '</param>\n</params>\n'))
+        (decoded,), _ = xmlrpclib.loads(encoded)
+        self.assertEquals(decoded, _stats(elapsedTime='20'))
@@ -26,6 +26,7 @@ import vm
 from vdsm import constants
 from testrunner import VdsmTestCase as TestCaseBase
 import caps
+import recoveryStore
 from vdsm import utils
 from vdsm import libvirtconnection
 from monkeypatch import MonkeyPatch
@@ -51,6 +52,9 @@ class TestVm(TestCaseBase):
                      'vmId': '9ffe28b6-6134-4b1e-8804-1185f49c436f',
                      'smp': '8', 'maxVCpus': '160',
                      'memSize': '1024', 'memGuaranteedSize': '512'}
+        # The test is the cif of the vms, its store is not started and
+        # writes the recovery files synchronously.
+        self.recoveryStore = recoveryStore.RecoveryStore(0)
 
     def assertXML(self, element, expectedXML, path=None):
         if path is None:
@@ -0,0 +1,271 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+import libvirt
+
+from testrunner import VdsmTestCase as TestCaseBase
+
+import watermarkMonitor
+
+MiB = 1 << 20
+GiB = 1 << 30
+
+MIN_INTERVAL = 2
+MAX_INTERVAL = 20
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeLibvirtError(libvirt.libvirtError):
+    def __init__(self, code):
+        Exception.__init__(self, "error %s" % code)
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+
+class FakeDrive(object):
+    watermarkLimit = 512 * MiB
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeVm(object):
+    def __init__(self, *names):
+        self.drives = [FakeDrive(name) for name in names]
+        self.enabled = True
+        # name: (capacity, alloc, physical)
+        self.blockInfo = dict((name, (10 * GiB, 0, GiB)) for name in names)
+        self.sampled = []
+        self.extended = []
+        self.thresholds = {}
+        self.rates = {}
+        self.thresholdError = None
+
+    def getChunkedDrives(self):
+        if not self.enabled:
+            return None
+        return self.drives
+
+    def getDriveBlockInfo(self, drive):
+        self.sampled.append(drive.name)
+        return self.blockInfo[drive.name]
+
+    def onDriveWatermark(self, drive, capacity, alloc, physical, rate):
+        self.rates[drive.name] = rate
+        if physical - alloc < drive.watermarkLimit:
+            self.extended.append(drive.name)
+            return True
+        return False
+
+    def setDriveThreshold(self, drive, threshold):
+        if self.thresholdError is not None:
+            raise FakeLibvirtError(self.thresholdError)
+        self.thresholds[drive.name] = threshold
+
+    def write(self, name, nbytes):
+        capacity, alloc, physical = self.blockInfo[name]
+        self.blockInfo[name] = (capacity, alloc + nbytes, physical)
+
+
+class WatermarkMonitorTests(TestCaseBase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def _monitor(self, events):
+        monitor = watermarkMonitor.WatermarkMonitor(
+            MIN_INTERVAL, MAX_INTERVAL, events=events, timefn=self.clock)
+        # Run the passes of the monitor thread by hand
+        monitor._running = True
+        return monitor
+
+    def _pass(self, monitor, after=0, run=True):
+        self.clock.now += after
+        batch = monitor._nextBatch()
+        monitor._checkVms(batch)
+        if run:
+            self._runJobs(monitor)
+
+    def _runJobs(self, monitor):
+        # Run the jobs of the workers by hand
+        while not monitor._jobs.empty():
+            monitor._runJob(monitor._jobs.get_nowait())
+
+    def _deadline(self, monitor, uuid, name):
+        return monitor._vms[uuid].drives[name].deadline - self.clock.now
+
+    def testArmThreshold(self):
+        monitor = self._monitor(events=True)
+        vm = FakeVm('vda')
+        monitor.register('vm', vm)
+        self._pass(monitor)
+        self.assertEquals(vm.sampled, ['vda'])
+        self.assertEquals(vm.thresholds, {'vda': GiB - 512 * MiB})
+        # Armed drives are polled only as a safety net
+        self.assertEquals(self._deadline(monitor, 'vm', 'vda'), MAX_INTERVAL)
+
+    def testThresholdEvent(self):
+        monitor = self._monitor(events=True)
+        vm = FakeVm('vda', 'vdb')
+        monitor.register('vm', vm)
+        self._pass(monitor)
+        vm.sampled = []
+        vm.write('vda', 600 * MiB)
+        monitor.notify('vm', 'vda[1]')
+        self._pass(monitor, after=1)
+        self.assertEquals(vm.sampled, ['vda'])
+        self.assertEquals(vm.extended, ['vda'])
+        self.assertEquals(self._deadline(monitor, 'vm', 'vda'), MIN_INTERVAL)
+
+    def testNotifyAll(self):
+        monitor = self._monitor(events=True)
+        vm = FakeVm('vda', 'vdb')
+        monitor.register('vm', vm)
+        self._pass(monitor)
+        vm.sampled = []
+        monitor.notify('vm')
+        self._pass(monitor, after=1)
+        self.assertEquals(sorted(vm.sampled), ['vda', 'vdb'])
+
+    def testPollByRate(self):
+        monitor = self._monitor(events=False)
+        vm = FakeVm('vda', 'vdb')
+        monitor.register('vm', vm)
+        self._pass(monitor)
+        vm.write('vda', 16 * MiB)
+        self._pass(monitor, after=MAX_INTERVAL)
+        # 496 MiB left before the watermark at 0.8 MiB/s
+        self.assertEquals(self._deadline(monitor, 'vm', 'vda'), MAX_INTERVAL)
+        vm.write('vda', 400 * MiB)
+        self._pass(monitor, after=MAX_INTERVAL)
+        # 96 MiB left at 20 MiB/s, checked again half way
+        self.assertAlmostEqual(self._deadline(monitor, 'vm', 'vda'), 2.4)
+        self.assertEquals(self._deadline(monitor, 'vm', 'vdb'), MAX_INTERVAL)
+        vm.write('vda', 90 * MiB)
+        self._pass(monitor, after=2.4)
+        # 6 MiB left at 37.5 MiB/s
+        self.assertEquals(self._deadline(monitor, 'vm', 'vda'), MIN_INTERVAL)
+
+    def testRateWindow(self):
+        monitor = self._monitor(events=False)
+        vm = FakeVm('vda')
+        monitor.register('vm', vm)
+        self._pass(monitor)
+        self.assertEquals(vm.rates, {'vda': 0})
+        vm.write('vda', 40 * MiB)
+        self._pass(monitor, after=MAX_INTERVAL)
+        self.assertEquals(vm.rates, {'vda': 2 * MiB})
+        # The rate over the window is higher than the rate since the
+        # previous check.
+        vm.write('vda', 20 * MiB)
+        self._pass(monitor, after=MAX_INTERVAL)
+        self.assertEquals(vm.rates, {'vda': 1.5 * MiB})
+        # Once the burst leaves the window only the slower writes count
+        for i in range(3):
+            vm.write('vda', 20 * MiB)
+            self._pass(monitor, after=MAX_INTERVAL)
+        self.assertEquals(vm.rates, {'vda': MiB})
+
+    def testNewVolume(self):
+        monitor = self._monitor(events=False)
+        vm = FakeVm('vda')
+        monitor.register('vm', vm)
+        self._pass(monitor)
+        vm.write('vda', 40 * MiB)
+        self._pass(monitor, after=MAX_INTERVAL)
+        vm.blockInfo['vda'] = (10 * GiB, 0, GiB)
+        self._pass(monitor, after=MAX_INTERVAL)
+        self.assertEquals(vm.rates, {'vda': 0})
+
+    def testFastestFirst(self):
+        monitor = self._monitor(events=False)
+        vm1 = FakeVm('vda')
+        vm2 = FakeVm('vda')
+        monitor.register('vm1', vm1)
+        monitor.register('vm2', vm2)
+        self._pass(monitor)
+        order = []
+        vm1.getDriveBlockInfo = lambda drive: (order.append('vm1') or
+                                               vm1.blockInfo['vda'])
+        vm2.getDriveBlockInfo = lambda drive: (order.append('vm2') or
+                                               vm2.blockInfo['vda'])
+        monitor._vms['vm1'].drives['vda'].rate = 1
+        monitor._vms['vm2'].drives['vda'].rate = 10
+        self._pass(monitor, after=MAX_INTERVAL)
+        self.assertEquals(order, ['vm2', 'vm1'])
+
+    def testEventsNotSupported(self):
+        monitor = self._monitor(events=True)
+        vm = FakeVm('vda')
+        vm.thresholdError = libvirt.VIR_ERR_NO_SUPPORT
+        monitor.register('vm', vm)
+        self._pass(monitor)
+        self.assertFalse(monitor._events)
+        self.assertEquals(vm.thresholds, {})
+
+    def testDisabled(self):
+        monitor = self._monitor(events=True)
+        vm = FakeVm('vda')
+        vm.enabled = False
+        monitor.register('vm', vm)
+        self._pass(monitor)
+        self.assertEquals(vm.sampled, [])
+        vm.enabled = True
+        self._pass(monitor, after=MIN_INTERVAL)
+        self.assertEquals(vm.sampled, ['vda'])
+
+    def testUnregister(self):
+        monitor = self._monitor(events=True)
+        vm = FakeVm('vda')
+        monitor.register('vm', vm)
+        monitor.unregister('vm')
+        self._pass(monitor)
+        self.assertEquals(vm.sampled, [])
+
+    def testSkipBusyVm(self):
+        monitor = self._monitor(events=False)
+        vm1 = FakeVm('vda')
+        vm2 = FakeVm('vda')
+        monitor.register('vm1', vm1)
+        monitor.register('vm2', vm2)
+        self._pass(monitor)
+        # The check of vm1 does not return
+        monitor.notify('vm1')
+        self._pass(monitor, after=1, run=False)
+        stuck = monitor._jobs.get_nowait()
+        vm1.sampled = []
+        vm2.sampled = []
+        monitor.notify('vm1')
+        self._pass(monitor, after=MAX_INTERVAL)
+        self.assertEquals(vm1.sampled, [])
+        self.assertEquals(vm2.sampled, ['vda'])
+        # Checked again once the stuck check returns, since notified
+        monitor._runJob(stuck)
+        vm1.sampled = []
+        self._pass(monitor)
+        self.assertEquals(vm1.sampled, ['vda'])
@@ -43,6 +43,7 @@ import storage.clusterlock
 import storage.volume
 import storage.sd
 import storage.image
+import storage.outOfProcess
 import vm
 from vdsm.define import doneCode, errCode, Kbytes, Mbytes
 import caps
@@ -355,14 +356,18 @@ class VM(APIBase):
             return errCode['noVM']
         return v.migrateStatus()
 
-    def getStats(self):
+    def getStats(self, averagingWindow=None):
         """
         Obtain statistics of the specified VM
+
+        :param averagingWindow: The period (in seconds) over which the rates
+                                are averaged, the whole sampling window if
+                                not specified.
         """
         v = self._cif.vmContainer.get(self._UUID)
         if not v:
             return errCode['noVM']
-        stats = v.getStats().copy()
+        stats = v.getStats(averagingWindow).copy()
         stats['vmId'] = self._UUID
         return {'status': doneCode, 'statsList': [stats]}
 
@@ -491,6 +496,7 @@ class VM(APIBase):
             *method* - ``online``
             *downtime* - allowed down time during online migration
             *dstqemu* - remote host address dedicated for migration
+            *priority* - the higher priority migrations are started first
         """
         params['vmId'] = self._UUID
         self.log.debug(params)
@@ -1207,14 +1213,36 @@ class Global(APIBase):
         """
         Get statistics of all running VMs.
         """
-        vms = self.getVMList()
-        statsList = []
-        for s in vms['vmList']:
-            response = VM(s['vmId']).getStats()
-            if response:
-                statsList.append(response['statsList'][0])
+        statsList = self._refreshVmStatsCache()
         return {'status': doneCode, 'statsList': statsList}
 
+    def getAllVmStatsDelta(self, token=None):
+        """
+        Get statistics of the VMs changed since a previous call.
+
+        :param token: The token returned by the previous call. If it's
+                      missing or no longer valid the statistics of all the
+                      VMs are returned and 'full' is set.
+        """
+        self._refreshVmStatsCache()
+        full, statsList, removed, newToken = \
+            self._cif.vmStatsCache.getChangedSince(token)
+        return {'status': doneCode, 'statsList': statsList,
+                'removedVms': removed, 'full': full, 'token': newToken}
+
+    def _refreshVmStatsCache(self):
+        def getStats(vmId):
+            response = VM(vmId).getStats()
+            if response['status']['code'] != 0:
+                return None
+            return response['statsList'][0]
+
+        _updateTimestamp()  # required for editNetwork flow
+
+        volatileByVm = dict((v.id, v.getVolatileStats())
+                            for v in self._cif.vmContainer.values())
+        return self._cif.vmStatsCache.refresh(volatileByVm, getStats)
+
     def getStats(self):
         """
         Report host statistics.
@@ -1259,6 +1287,15 @@ class Global(APIBase):
         stats['netConfigDirty'] = str(self._cif._netConfigDirty)
         stats['generationID'] = self._cif._generationID
 
+        stats['sampling'] = self._cif.statsScheduler.getStats()
+        stats['sampleTimings'] = self._cif.bulkSampler.getTimings()
+        if self._cif.irs:
+            stats['processPools'] = storage.outOfProcess.getPoolsStats()
+
+        recoveryStats = self._cif.getRecoveryStats()
+        if recoveryStats is not None:
+            stats['vmRecovery'] = recoveryStats
+
         if haClient:
             try:
                 stats['haScore'] = haClient.HAClient().get_local_host_score()
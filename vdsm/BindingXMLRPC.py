@@ -24,12 +24,14 @@ from vdsm import SecureXMLRPCServer
 import logging
 import libvirt
 import threading
+import xmlrpclib
 
 from vdsm import utils
 from vdsm.define import doneCode, errCode
 from vdsm.netinfo import getDeviceByIP
 import API
 from vdsm.exception import VdsmException
+from vmStatsCache import CachedVmStats
 try:
     from gluster.api import getGlusterMethods
     _glusterEnabled = True
@@ -37,6 +39,14 @@ except ImportError:
     _glusterEnabled = False
 
 
+def _dumpCachedVmStats(marshaller, value, write):
+    write(value.xmlrpc(marshaller.encoding, marshaller.allow_none))
+
+
+# Send the cached encoding of the vm statistics
+xmlrpclib.Marshaller.dispatch[CachedVmStats] = _dumpCachedVmStats
+
+
 class BindingXMLRPC(object):
     def __init__(self, cif, log, ip, port, ssl, vds_resp_timeout,
                  trust_store_path, default_bridge):
@@ -301,14 +311,18 @@ class BindingXMLRPC(object):
         api = API.Global()
         return api.getStats()
 
-    def vmGetStats(self, vmId):
+    def vmGetStats(self, vmId, averagingWindow=None):
         vm = API.VM(vmId)
-        return vm.getStats()
+        return vm.getStats(averagingWindow)
 
     def getAllVmStats(self):
         api = API.Global()
         return api.getAllVmStats()
 
+    def getAllVmStatsDelta(self, token=None):
+        api = API.Global()
+        return api.getAllVmStatsDelta(token)
+
     def vmMigrationCreate(self, params):
         vm = API.VM(params['vmId'])
         return vm.migrationCreate(params)
@@ -806,6 +820,7 @@ class BindingXMLRPC(object):
                 (self.getStats, 'getVdsStats'),
                 (self.vmGetStats, 'getVmStats'),
                 (self.getAllVmStats, 'getAllVmStats'),
+                (self.getAllVmStatsDelta, 'getAllVmStatsDelta'),
                 (self.vmMigrationCreate, 'migrationCreate'),
                 (self.vmDesktopLogin, 'desktopLogin'),
                 (self.vmDesktopLogoff, 'desktopLogoff'),
@@ -923,12 +938,25 @@ class BindingXMLRPC(object):
                  'storageServer_ConnectionRefs_statuses'),)
 
 
+def _vmVerbId(f, args, kwargs):
+    """
+    Return the id of the vm of the verb f of a single vm, taking the vmId
+    as its first argument, None for the other verbs.
+    """
+    code = f.im_func.func_code
+    if code.co_argcount < 2 or code.co_varnames[1] != 'vmId':
+        return None
+    if args:
+        return args[0]
+    return kwargs.get('vmId')
+
+
 def wrapApiMethod(f):
     def wrapper(*args, **kwargs):
         try:
             logLevel = logging.DEBUG
-            if f.__name__ in ('getVMList', 'getAllVmStats', 'getStats',
-                              'fenceNode'):
+            if f.__name__ in ('getVMList', 'getAllVmStats',
+                              'getAllVmStatsDelta', 'getStats', 'fenceNode'):
                 logLevel = logging.TRACE
             displayArgs = args
             if f.__name__ == 'vmDesktopLogin':
@@ -948,7 +976,13 @@ def wrapApiMethod(f):
             # Ready to show the log into vdsm.log
             f.im_self.log.log(logLevel, logStr)
 
-            if f.im_self.cif.ready:
+            vmId = _vmVerbId(f, args, kwargs)
+            if vmId is not None:
+                # The vms can be used once recovered, before the others
+                ready = f.im_self.cif.isVmReady(vmId)
+            else:
+                ready = f.im_self.cif.ready
+            if ready:
                 res = f(*args, **kwargs)
             else:
                 res = errCode['recovery']
@@ -21,7 +21,6 @@
 import os
 import time
 import threading
-import pickle
 from xml.dom import minidom
 import uuid
 
@@ -40,13 +39,33 @@ from vmChannels import Listener
 from vm import Vm
 import blkid
 import supervdsm
+import recoveryStore
 import sampling
+import vmRecovery
+import vmStatsCache
+import watermarkMonitor
 try:
     import gluster.api as gapi
     _glusterEnabled = True
 except ImportError:
     _glusterEnabled = False
 
+# Not all the libvirt bindings define the block threshold event
+_VIR_DOMAIN_EVENT_ID_BLOCK_THRESHOLD = getattr(
+    libvirt, 'VIR_DOMAIN_EVENT_ID_BLOCK_THRESHOLD', 24)
+
+
+def _bulkStatsIntervals():
+    return {
+        sampling.BULK_CPU: config.getint('vars', 'vm_sample_cpu_interval'),
+        sampling.BULK_BALLOON: config.getint('vars',
+                                             'vm_sample_cpu_interval'),
+        sampling.BULK_DISK: config.getint('vars', 'vm_sample_disk_interval'),
+        sampling.BULK_DISK_LATENCY: config.getint(
+            'vars', 'vm_sample_disk_latency_interval'),
+        sampling.BULK_NET: config.getint('vars', 'vm_sample_net_interval'),
+    }
+
 
 class clientIF:
     """
@@ -74,6 +93,7 @@ class clientIF:
             self.irs.registerDomainStateChangeCallback(self.contEIOVms)
         self.log = log
         self._recovery = True
+        self._vmRecovery = None
         self.channelListener = Listener(self.log)
         self._generationID = str(uuid.uuid4())
         self.mom = None
@@ -83,8 +103,24 @@ class clientIF:
             self.gluster = None
         try:
             self.vmContainer = {}
+            self.vmStatsCache = vmStatsCache.VmStatsCache()
             self._hostStats = sampling.HostStatsThread(log=log)
             self._hostStats.start()
+            self.statsScheduler = sampling.SampleScheduler(
+                config.getint('vars', 'vm_sample_workers'))
+            self.statsScheduler.start()
+            self.bulkSampler = sampling.BulkStatsSampler(
+                self.statsScheduler, libvirtconnection.get(self),
+                _bulkStatsIntervals())
+            self.bulkSampler.start()
+            self.watermarkMonitor = watermarkMonitor.WatermarkMonitor(
+                config.getint('vars', 'vm_watermark_interval'),
+                config.getint('vars', 'vm_watermark_max_interval'),
+                config.getint('vars', 'vm_watermark_workers'))
+            self.watermarkMonitor.start()
+            self.recoveryStore = recoveryStore.RecoveryStore(
+                config.getint('vars', 'vm_recovery_flush_interval'))
+            self.recoveryStore.start()
             self.lastRemoteAccess = 0
             self._memLock = threading.Lock()
             self._enabled = True
@@ -111,6 +147,18 @@ class clientIF:
     def ready(self):
         return (self.irs is None or self.irs.ready) and not self._recovery
 
+    def isVmReady(self, vmId):
+        """
+        Return True if the verbs of the vm vmId can be served, i.e. once
+        vdsm is ready or, during the recovery, once the vm is created.
+        """
+        if self.ready:
+            return True
+        if self.irs is not None and not self.irs.ready:
+            return False
+        recovery = self._vmRecovery
+        return recovery is not None and recovery.isCreated(vmId)
+
     def contEIOVms(self, sdUUID, isDomainStateValid):
         # This method is called everytime the onDomainStateChange
         # event is emitted, this event is emitted even when a domain goes
@@ -215,6 +263,10 @@ class clientIF:
             self._enabled = False
             self.channelListener.stop()
             self._hostStats.stop()
+            self.watermarkMonitor.stop()
+            self.recoveryStore.stop()
+            self.bulkSampler.stop()
+            self.statsScheduler.stop()
             if self.mom:
                 self.mom.stop()
             if self.irs:
@@ -390,50 +442,39 @@ class clientIF:
                       caps.CpuTopology().cores())
             vm.MigrationSourceThread.setMaxOutgoingMigrations(mog)
 
-            vdsmVms = self._getVDSMVms()
-            #Recover
-            for v in vdsmVms:
-                vmId = v.UUIDString()
-                if not self._recoverVm(vmId):
-                    #RH qemu proc without recovery
-                    self.log.info('loose qemu process with id: '
-                                  '%s found, killing it.', vmId)
-                    try:
-                        v.destroy()
-                    except libvirt.libvirtError:
-                        self.log.error('failed to kill loose qemu '
-                                       'process with id: %s',
-                                       vmId, exc_info=True)
-
-            while (self._enabled and
-                   'WaitForLaunch' in [v.lastStatus for v in
-                                       self.vmContainer.values()]):
-                time.sleep(1)
-            self._cleanOldFiles()
-            self._recovery = False
-
-            # Now if we have VMs to restore we should wait pool connection
-            # and then prepare all volumes.
-            # Actually, we need it just to get the resources for future
-            # volumes manipulations
-            while self._enabled and self.vmContainer and \
-                    not self.irs.getConnectedStoragePoolsList()['poollist']:
-                time.sleep(5)
-
-            for vmId, vmObj in self.vmContainer.items():
-                # Let's recover as much VMs as possible
-                try:
-                    # Do not prepare volumes when system goes down
-                    if self._enabled:
-                        vmObj.preparePaths(
-                            vmObj.buildConfDevices()[vm.DISK_DEVICES])
-                except:
-                    self.log.error("Vm %s recovery failed",
-                                   vmId, exc_info=True)
+            # The vms are created and their paths prepared concurrently,
+            # the verbs of every vm are served once it is created, and vdsm
+            # is ready once all the vms are created while the paths of the
+            # vms are still prepared.
+            self._vmRecovery = vmRecovery.VmRecovery(
+                self, config.getint('vars', 'vm_recovery_workers'))
+            self._vmRecovery.run(self._getDomains(), self._onVmsCreated)
         except:
             self.log.error("Vm's recovery failed", exc_info=True)
             raise
 
+    def _onVmsCreated(self):
+        self._cleanOldFiles()
+        self._recovery = False
+
+    def _waitForStoragePool(self):
+        # Now if we have VMs to restore we should wait pool connection
+        # and then prepare all volumes.
+        # Actually, we need it just to get the resources for future
+        # volumes manipulations
+        while self._enabled and self.vmContainer and \
+                not self.irs.getConnectedStoragePoolsList()['poollist']:
+            time.sleep(5)
+
+    def getRecoveryStats(self):
+        """
+        Return the progress of the recovery of the vms, None if not
+        started.
+        """
+        if self._vmRecovery is None:
+            return None
+        return self._vmRecovery.progress.getStats()
+
     def isVDSMVm(self, vm):
         """
         Return True if vm seems as if it was created by vdsm.
@@ -461,9 +502,9 @@ class clientIF:
                             return True
         return False
 
-    def _getVDSMVms(self):
+    def _getDomains(self):
         """
-        Return a list of vdsm created VM's.
+        Return a list of the running libvirt domains.
         """
         libvirtCon = libvirtconnection.get()
         domIds = libvirtCon.listDomainsID()
@@ -480,12 +521,12 @@ class clientIF:
                     raise
             else:
                 vms.append(vm)
-        return [vm for vm in vms if self.isVDSMVm(vm)]
+        return vms
 
     def _recoverVm(self, vmid):
         try:
             recoveryFile = constants.P_VDSM_RUN + vmid + ".recovery"
-            params = pickle.load(file(recoveryFile))
+            params = recoveryStore.load(recoveryFile)
             now = time.time()
             pt = float(params.pop('startTime', now))
             params['elapsedTimeOffset'] = now - pt
@@ -557,6 +598,9 @@ class clientIF:
             elif eventid == libvirt.VIR_DOMAIN_EVENT_ID_WATCHDOG:
                 action, = args[:-1]
                 v._onWatchdogEvent(action)
+            elif eventid == _VIR_DOMAIN_EVENT_ID_BLOCK_THRESHOLD:
+                dev, path, threshold, excess = args[:-1]
+                v._onBlockThreshold(dev, path, threshold, excess)
             else:
                 v.log.warning('unknown eventid %s args %s', eventid, args)
         except:
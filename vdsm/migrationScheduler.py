@@ -0,0 +1,162 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+"""
+Scheduling of the outgoing migrations of the host.
+
+At most maxActive migrations run at once, the others wait in a queue
+ordered by priority, then by memory size, largest first: when the host is
+evacuated the largest vms, which take the longest to migrate, do not end up
+migrating last while the rest of the host is idle. The bandwidth budget of
+the host is split evenly between the running migrations, and their speed is
+adjusted as migrations start and finish.
+"""
+
+import itertools
+import logging
+import threading
+
+
+class _Entry(object):
+    __slots__ = ('migration', 'key', 'bandwidth')
+
+    def __init__(self, migration, key):
+        self.migration = migration
+        self.key = key
+        # The bandwidth set last, None if not set yet
+        self.bandwidth = None
+
+
+class MigrationScheduler(object):
+    """
+    Queues the outgoing migrations and shares the bandwidth between them.
+
+    The migrations provide setMaxBandwidth(bandwidth), setting the maximum
+    bandwidth of the migration, in MiB per second.
+    """
+    log = logging.getLogger("MigrationScheduler")
+
+    def __init__(self, maxActive, hostBandwidth=0, maxBandwidth=0):
+        """
+        Initialize a MigrationScheduler.
+
+        :param maxActive: The number of migrations running at once.
+        :param hostBandwidth: The bandwidth (in MiB per second) shared by
+                              the running migrations, 0 for no budget.
+        :param maxBandwidth: The bandwidth (in MiB per second) of every
+                             migration when there is no budget.
+        """
+        self._maxActive = maxActive
+        self._hostBandwidth = hostBandwidth
+        self._maxBandwidth = maxBandwidth
+        self._cond = threading.Condition(threading.Lock())
+        # Serializes the changes of the bandwidth of the migrations
+        self._balanceLock = threading.Lock()
+        self._seq = itertools.count()
+        self._queue = []
+        self._active = []
+
+    def setMaxActive(self, n):
+        with self._cond:
+            self._maxActive = n
+            self._cond.notifyAll()
+
+    def acquire(self, migration, priority, memSize, isCanceled):
+        """
+        Queue migration and wait until it can run, or until isCanceled()
+        returns True. Return True if the migration can run, and must be
+        released once done.
+        """
+        # Higher priority first, then larger vms first, then in order
+        key = (-priority, -memSize, next(self._seq))
+        entry = _Entry(migration, key)
+        with self._cond:
+            self._queue.append(entry)
+            self._queue.sort(key=lambda e: e.key)
+            try:
+                while True:
+                    if isCanceled():
+                        return False
+                    if (len(self._active) < self._maxActive and
+                            self._queue[0] is entry):
+                        break
+                    self._cond.wait()
+            finally:
+                self._queue.remove(entry)
+                # The next migration may start now
+                self._cond.notifyAll()
+            self._active.append(entry)
+
+        self.log.debug("Migration started, %d running, %d queued",
+                       len(self._active), len(self._queue))
+        self._balance()
+        return True
+
+    def release(self, migration):
+        with self._cond:
+            for entry in self._active:
+                if entry.migration is migration:
+                    self._active.remove(entry)
+                    break
+            else:
+                return
+            self._cond.notifyAll()
+        self._balance()
+
+    def wakeup(self):
+        """
+        Wake up the waiting migrations, to check if they were canceled.
+        """
+        with self._cond:
+            self._cond.notifyAll()
+
+    def queuePosition(self, migration):
+        """
+        Return the position (from 1) of migration in the queue, or None if
+        it is not queued.
+        """
+        with self._cond:
+            for i, entry in enumerate(self._queue):
+                if entry.migration is migration:
+                    return i + 1
+        return None
+
+    def _share(self, active):
+        if not self._hostBandwidth:
+            return self._maxBandwidth
+        return max(1, self._hostBandwidth // active)
+
+    def _balance(self):
+        with self._balanceLock:
+            with self._cond:
+                if not self._active:
+                    return
+                bandwidth = self._share(len(self._active))
+                changed = [entry for entry in self._active
+                           if entry.bandwidth != bandwidth]
+                for entry in changed:
+                    entry.bandwidth = bandwidth
+
+            for entry in changed:
+                try:
+                    entry.migration.setMaxBandwidth(bandwidth)
+                except Exception:
+                    self.log.warning("Cannot set the migration bandwidth "
+                                     "to %d MiBps", bandwidth, exc_info=True)
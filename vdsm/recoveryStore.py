@@ -0,0 +1,220 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+"""
+Write-behind store of the recovery files of the vms.
+
+A change of the state of a vm only marks its recovery file as dirty, and the
+file is written later by the store thread, at most once per interval for
+each vm, so a burst of changes results in a single write of the latest
+state. The changes that must be on disk before going on are written at once
+by the caller. The state is saved with the binary pickle protocol, which is
+smaller and faster to load than the default text protocol.
+"""
+
+import cPickle
+import heapq
+import itertools
+import logging
+import os
+import tempfile
+import threading
+
+from vdsm import utils
+
+
+def load(path):
+    """
+    Return the state saved in the recovery file at path.
+    """
+    with open(path, "rb") as f:
+        return cPickle.load(f)
+
+
+def _write(path, data):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                     delete=False) as f:
+        f.write(data)
+    os.rename(f.name, path)
+
+
+class _Entry(object):
+    __slots__ = ('path', 'getState', 'dirty', 'lastFlush', 'data', 'lock')
+
+    def __init__(self, path):
+        self.path = path
+        self.getState = None
+        self.dirty = False
+        # The time of the last flush, None if never flushed
+        self.lastFlush = None
+        # The last data written, to skip writing the same state again
+        self.data = None
+        # Held while flushing
+        self.lock = threading.Lock()
+
+
+class RecoveryStore(object):
+    """
+    Keeps the recovery files of the vms up to date.
+    """
+    log = logging.getLogger("RecoveryStore")
+
+    def __init__(self, interval, timefn=utils.monotonic_time):
+        """
+        Initialize a RecoveryStore.
+
+        :param interval: The shortest interval (in seconds) between two
+                         writes of the recovery file of a vm, unless
+                         written synchronously.
+        """
+        self._interval = interval
+        self._timefn = timefn
+        self._cond = threading.Condition(threading.Lock())
+        self._entries = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                raise RuntimeError("RecoveryStore is started")
+            self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name="RecoveryStore")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the store thread and write the pending changes. The changes
+        made afterwards are written synchronously.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        with self._cond:
+            dirty = [(vmId, entry) for vmId, entry in self._entries.items()
+                     if entry.dirty]
+        for vmId, entry in dirty:
+            try:
+                self._flush(vmId, entry)
+            except Exception:
+                self.log.error("Error saving the state of vm %s", vmId,
+                               exc_info=True)
+
+    def update(self, vmId, path, getState, sync=False):
+        """
+        Mark the recovery file of vmId at path as dirty. getState is called
+        when the file is written, returning the state to save or None if the
+        state should not be saved any more.
+
+        If sync is True the file is written before returning, raising the
+        errors of getState or of the write.
+        """
+        with self._cond:
+            entry = self._entries.get(vmId)
+            if entry is None:
+                entry = self._entries[vmId] = _Entry(path)
+            entry.getState = getState
+            sync = sync or not self._running
+            if not sync and not entry.dirty:
+                entry.dirty = True
+                now = self._timefn()
+                due = now
+                if entry.lastFlush is not None:
+                    due = max(now, entry.lastFlush + self._interval)
+                heapq.heappush(self._queue, (due, next(self._seq), vmId))
+                self._cond.notify()
+
+        if sync:
+            self._flush(vmId, entry)
+
+    def remove(self, vmId):
+        """
+        Forget the recovery file of vmId, waiting for a write in progress.
+        The caller removes the file itself.
+        """
+        with self._cond:
+            entry = self._entries.pop(vmId, None)
+        if entry is not None:
+            with entry.lock:
+                pass
+
+    def _run(self):
+        self.log.debug("Recovery store started")
+        while True:
+            item = self._nextFlush()
+            if item is None:
+                break
+            vmId, entry = item
+            # Skip the removed vms and the files written synchronously
+            # since queued.
+            if entry is None or not entry.dirty:
+                continue
+            try:
+                self._flush(vmId, entry)
+            except Exception:
+                self.log.error("Error saving the state of vm %s", vmId,
+                               exc_info=True)
+        self.log.debug("Recovery store finished")
+
+    def _nextFlush(self):
+        """
+        Wait for a recovery file due for a write, return (vmId, entry) or
+        None once stopped. entry is None if the vm was removed.
+        """
+        with self._cond:
+            while self._running:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                wait = self._queue[0][0] - self._timefn()
+                if wait <= 0:
+                    break
+                self._cond.wait(wait)
+            else:
+                return None
+
+            due, _, vmId = heapq.heappop(self._queue)
+            return vmId, self._entries.get(vmId)
+
+    def _flush(self, vmId, entry):
+        with entry.lock:
+            with self._cond:
+                if self._entries.get(vmId) is not entry:
+                    # Removed
+                    return
+                # The changes made from now on need another write
+                entry.dirty = False
+                entry.lastFlush = self._timefn()
+                getState = entry.getState
+
+            state = getState()
+            if state is None:
+                return
+            data = cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)
+            if data == entry.data:
+                return
+            _write(entry.path, data)
+            entry.data = data
@@ -26,12 +26,20 @@ plentifuly around vdsm.
 
     Contains a reverse dictionary pointing from error string to its error code.
 """
+import array
+import bisect
+import fractions
+import heapq
+import itertools
 import threading
 import os
 import time
 import logging
 import errno
 import ethtool
+import Queue
+
+import libvirt
 
 from vdsm import utils
 from vdsm import netinfo
@@ -196,18 +204,174 @@ class HostSample(BaseSample):
             self.thpState = 'never'
 
 
+class SampleWindow(object):
+    """
+    A fixed-capacity ring buffer of (timestamp, value) samples.
+
+    Once the buffer is full every new sample replaces the oldest one, so
+    appending and accessing the first and last samples are O(1). The
+    timestamps are expected to be non decreasing.
+    """
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("capacity must be greater than 0")
+
+        self._capacity = capacity
+        self._timestamps = array.array('d', [0.0]) * capacity
+        self._values = [None] * capacity
+        self._head = 0
+        self._size = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """
+        Iterate over the (timestamp, value) samples, oldest first.
+        """
+        for n in xrange(self._size):
+            slot = self._slot(n)
+            yield self._timestamps[slot], self._load(slot)
+
+    def __getitem__(self, n):
+        """
+        Return the n-th (timestamp, value) sample, the oldest being the
+        0-th. Negative indexes count from the newest sample.
+        """
+        if n < 0:
+            n += self._size
+        if not 0 <= n < self._size:
+            raise IndexError("sample index out of range")
+        slot = self._slot(n)
+        return self._timestamps[slot], self._load(slot)
+
+    def append(self, timestamp, value):
+        if self._size < self._capacity:
+            slot = self._slot(self._size)
+            self._size += 1
+        else:
+            slot = self._head
+            self._head = (self._head + 1) % self._capacity
+        self._timestamps[slot] = timestamp
+        self._store(slot, value)
+
+    def first(self):
+        return self[0]
+
+    def last(self):
+        return self[-1]
+
+    def stats(self, seconds=None):
+        """
+        Return a tuple in the format: (first, last, difftime), containing
+        the first and the last value in the window and their time
+        difference. If seconds is specified only the samples taken in the
+        last 'seconds' seconds (relative to the newest sample) are
+        considered.
+        """
+        if self._size < 2:
+            return None, None, None
+
+        end_time, end_sample = self.last()
+        if seconds is None:
+            bgn_time, bgn_sample = self.first()
+        else:
+            n = self._bisect(end_time - seconds)
+            if n >= self._size - 1:
+                return None, None, None
+            bgn_time, bgn_sample = self[n]
+
+        return bgn_sample, end_sample, (end_time - bgn_time)
+
+    def _bisect(self, timestamp):
+        # Index of the oldest sample taken at or after timestamp
+        return bisect.bisect_left(_WindowTimestamps(self), timestamp)
+
+    def _slot(self, n):
+        return (self._head + n) % self._capacity
+
+    def _store(self, slot, value):
+        self._values[slot] = value
+
+    def _load(self, slot):
+        return self._values[slot]
+
+
+class _WindowTimestamps(object):
+    """
+    A read-only sequence view of the timestamps of a SampleWindow.
+    """
+    def __init__(self, window):
+        self._window = window
+
+    def __len__(self):
+        return len(self._window)
+
+    def __getitem__(self, n):
+        return self._window._timestamps[self._window._slot(n)]
+
+
+class CounterWindow(SampleWindow):
+    """
+    A SampleWindow storing dicts of numeric counters with a fixed set of
+    keys. The counters are kept in a flat typed array instead of one dict
+    of boxed numbers per sample; the dicts are rebuilt when read. Missing
+    counters are stored as 0 and a None sample is preserved.
+    """
+    def __init__(self, capacity, fields, typecode='d'):
+        SampleWindow.__init__(self, capacity)
+        self._fields = tuple(fields)
+        self._width = len(self._fields)
+        self._counters = array.array(typecode, [0]) * (capacity * self._width)
+        self._valid = array.array('b', [0]) * capacity
+
+    def _store(self, slot, value):
+        if value is None:
+            self._valid[slot] = 0
+            return
+        self._valid[slot] = 1
+        offset = slot * self._width
+        for i, field in enumerate(self._fields):
+            self._counters[offset + i] = value.get(field, 0)
+
+    def _load(self, slot):
+        if not self._valid[slot]:
+            return None
+        offset = slot * self._width
+        return dict(zip(self._fields,
+                        self._counters[offset:offset + self._width]))
+
+
 class AdvancedStatsFunction(object):
     """
     A wrapper for functions and methods that will be executed at regular
     intervals storing the return values for statistic purpose.
     It is possible to provide a custom time function 'timefn' that provides
     cached values to reduce system calls.
+    If the function returns dicts of numeric counters with a fixed set of
+    keys, these can be listed in 'fields' to store the samples compactly.
     """
-    def __init__(self, function, interval=1, window=0, timefn=time.time):
+    def __init__(self, function, interval=1, window=0, timefn=time.time,
+                 fields=None):
         self._function = function
         self._window = window
         self._timefn = timefn
-        self._sample = []
+        if fields is None:
+            self._sample = SampleWindow(max(window, 1))
+        else:
+            self._sample = CounterWindow(max(window, 1), fields)
+
+        self._calls = 0
+        self._lastLatency = 0.0
+        self._totalLatency = 0.0
+        self._maxLatency = 0.0
+        self._lastJitter = 0.0
+        self._maxJitter = 0.0
+        self._skipped = 0
 
         if not isinstance(interval, int) or interval < 1:
             raise ValueError("interval must be int and greater than 0")
@@ -218,33 +382,81 @@ class AdvancedStatsFunction(object):
     def interval(self):
         return self._interval
 
+    @property
+    def name(self):
+        return self._function.__name__
+
     def __repr__(self):
         return "<AdvancedStatsFunction %s at 0x%x>" % (
             self._function.__name__, id(self._function.__name__))
 
     def __call__(self, *args, **kwargs):
-        retValue = self._function(*args, **kwargs)
+        # The latency of most samples is well below the 10 milliseconds
+        # resolution of utils.monotonic_time.
+        start = time.time()
+        try:
+            retValue = self._function(*args, **kwargs)
+        finally:
+            latency = max(0.0, time.time() - start)
+            self._calls += 1
+            self._lastLatency = latency
+            self._totalLatency += latency
+            self._maxLatency = max(self._maxLatency, latency)
         retTime = self._timefn()
 
         if self._window > 0:
-            self._sample.append((retTime, retValue))
-            del self._sample[:-self._window]
+            self._sample.append(retTime, retValue)
 
         return retValue
 
-    def getStats(self):
+    def getStats(self, seconds=None):
         """
         Return a tuple in the format: (first, last, difftime), containing
         the first and the last return value in the defined 'window' and the
-        time difference.
+        time difference. If seconds is specified only the samples of the
+        last 'seconds' seconds are considered, allowing the computation of
+        rates over shorter averaging windows.
         """
-        if len(self._sample) < 2:
-            return None, None, None
+        return self._sample.stats(seconds)
 
-        bgn_time, bgn_sample = self._sample[0]
-        end_time, end_sample = self._sample[-1]
+    def recordJitter(self, jitter):
+        """
+        Record how late (in seconds) the function was called with respect
+        to its deadline.
+        """
+        self._lastJitter = jitter
+        self._maxJitter = max(self._maxJitter, jitter)
 
-        return bgn_sample, end_sample, (end_time - bgn_time)
+    def recordSkipped(self, count=1):
+        """
+        Record deadlines that were skipped because the sampling was late.
+        """
+        self._skipped += count
+
+    def getTimings(self):
+        """
+        Return a dict with the execution counters of the function: the
+        number of calls, the last, average and maximum latency, the last
+        and maximum jitter (all in seconds) and the number of skipped
+        deadlines.
+        """
+        return {'calls': self._calls,
+                'latency': self._lastLatency,
+                'avgLatency': (self._totalLatency / self._calls
+                               if self._calls else 0.0),
+                'maxLatency': self._maxLatency,
+                'jitter': self._lastJitter,
+                'maxJitter': self._maxJitter,
+                'skipped': self._skipped}
+
+    def getLastSample(self):
+        """
+        Return the last value stored in the window, or None if no value
+        was sampled yet.
+        """
+        if not self._sample:
+            return None
+        return self._sample.last()[1]
 
 
 class AdvancedStatsThread(threading.Thread):
@@ -330,23 +542,28 @@ class AdvancedStatsThread(threading.Thread):
         return False
 
     def collect(self):
-        # TODO: improve this with lcm
-        _mInt = map(lambda x: x.interval, self._statsFunctions)
-        maxInterval = reduce(lambda x, y: x * y, set(_mInt), 1)
+        if not self._statsFunctions:
+            self._stopEvent.wait()
+            return
 
-        intervalAccum = 0
+        # The sampling schedule repeats every hyperperiod ticks
+        hyperperiod = _hyperperiod(f.interval for f in self._statsFunctions)
+
+        # Ticks are scheduled against absolute deadlines (base + tick) so
+        # that the execution time of the functions doesn't add up as drift.
+        base = utils.monotonic_time()
+        tick = 0
         while not self._stopEvent.isSet():
             self._contEvent.wait()
+            if self._stopEvent.isSet():
+                break
 
             self._statsTime = time.time()
-            waitInterval = maxInterval
+            jitter = max(0.0, utils.monotonic_time() - (base + tick))
 
             for statsFunction in self._statsFunctions:
-                thisInterval = statsFunction.interval - (
-                    intervalAccum % statsFunction.interval)
-                waitInterval = min(waitInterval, thisInterval)
-
-                if intervalAccum % statsFunction.interval == 0:
+                if tick % statsFunction.interval == 0:
+                    statsFunction.recordJitter(jitter)
                     try:
                         statsFunction()
                     except Exception as e:
@@ -354,8 +571,572 @@ class AdvancedStatsThread(threading.Thread):
                             self._log.error("Stats function failed: %s",
                                             statsFunction, exc_info=True)
 
-            self._stopEvent.wait(waitInterval)
-            intervalAccum = (intervalAccum + waitInterval) % maxInterval
+            # Coalesce the ticks that expired while the functions were
+            # running instead of falling further behind.
+            elapsed = utils.monotonic_time() - base
+            tick = self._nextTick(tick)
+            while tick <= elapsed:
+                for statsFunction in self._statsFunctions:
+                    if tick % statsFunction.interval == 0:
+                        statsFunction.recordSkipped()
+                tick = self._nextTick(tick)
+
+            while tick >= hyperperiod:
+                base += hyperperiod
+                tick -= hyperperiod
+
+            self._stopEvent.wait(base + tick - utils.monotonic_time())
+
+    def _nextTick(self, tick):
+        return min(tick + f.interval - tick % f.interval
+                   for f in self._statsFunctions)
+
+
+def _lcm(a, b):
+    return a * b // fractions.gcd(a, b)
+
+
+def _hyperperiod(intervals):
+    """
+    Return the least common multiple of the sampling intervals.
+    """
+    return reduce(_lcm, intervals, 1)
+
+
+class AdvancedStatsGroup(object):
+    """
+    A group of AdvancedStatsFunction objects sampled by a SampleScheduler.
+
+    It offers the same interface of AdvancedStatsThread but it doesn't own
+    a thread: the registered functions are executed by the shared workers
+    of the scheduler.
+    """
+    DEFAULT_LOG = logging.getLogger("AdvancedStatsGroup")
+
+    def __init__(self, scheduler, log=DEFAULT_LOG):
+        self._scheduler = scheduler
+        self._log = log
+        self._lock = threading.Lock()
+        self._started = False
+        self._paused = False
+
+        self._statsTime = None
+        self._statsFunctions = []
+        self._calls = []
+
+    def addStatsFunction(self, *args):
+        """
+        Register the functions listed as arguments
+        """
+        if self._started:
+            raise RuntimeError("AdvancedStatsGroup is started")
+
+        for statsFunction in args:
+            self._statsFunctions.append(statsFunction)
+
+    def start(self):
+        """
+        Schedule the registered functions for execution
+        """
+        self._log.debug("Start statistics collection")
+        with self._lock:
+            if self._started:
+                raise RuntimeError("AdvancedStatsGroup is started")
+            self._started = True
+            self._calls = [self._scheduler.schedule(self, statsFunction)
+                           for statsFunction in self._statsFunctions]
+
+    def stop(self):
+        """
+        Remove the registered functions from the scheduler
+        """
+        self._log.debug("Stop statistics collection")
+        with self._lock:
+            calls, self._calls = self._calls, []
+        for call in calls:
+            self._scheduler.unschedule(call)
+
+    def pause(self):
+        """
+        Pause the execution of the registered functions
+        """
+        self._log.debug("Pause statistics collection")
+        self._paused = True
+
+    def cont(self):
+        """
+        Resume the execution of the registered functions
+        """
+        self._log.debug("Resume statistics collection")
+        self._paused = False
+
+    def isPaused(self):
+        return self._paused
+
+    def getLastSampleTime(self):
+        return self._statsTime
+
+    def getTimings(self):
+        """
+        Return a dict mapping the name of each registered function to its
+        execution counters, see AdvancedStatsFunction.getTimings.
+        """
+        return dict((statsFunction.name, statsFunction.getTimings())
+                    for statsFunction in self._statsFunctions)
+
+    def handleStatsException(self, ex):
+        """
+        Handle the registered function exceptions and eventually stop the
+        sampling if a fatal error occurred.
+        """
+        return False
+
+    def statsSampled(self):
+        """
+        Called after the registered functions took a new sample.
+        """
+        pass
+
+    def runStatsFunction(self, statsFunction):
+        """
+        Called by the scheduler workers when statsFunction is due.
+        """
+        if self._paused:
+            return
+
+        self._statsTime = time.time()
+        try:
+            statsFunction()
+        except Exception as e:
+            if not self.handleStatsException(e):
+                self._log.error("Stats function failed: %s",
+                                statsFunction, exc_info=True)
+            return
+        self._notifySampled(self)
+
+    def _notifySampled(self, group):
+        try:
+            group.statsSampled()
+        except Exception:
+            self._log.error("Error handling the new sample", exc_info=True)
+
+
+class _ScheduledCall(object):
+    """
+    An AdvancedStatsFunction registered in a SampleScheduler.
+    """
+    __slots__ = ('group', 'statsFunction', 'deadline', 'delay', 'cancelled')
+
+    def __init__(self, group, statsFunction, deadline):
+        self.group = group
+        self.statsFunction = statsFunction
+        self.deadline = deadline
+        self.delay = 0.0
+        self.cancelled = False
+
+    def __repr__(self):
+        return "<_ScheduledCall %r deadline=%s delay=%.3f>" % (
+            self.statsFunction, self.deadline, self.delay)
+
+
+class SampleScheduler(object):
+    """
+    A host-wide scheduler executing AdvancedStatsFunction objects on a small
+    fixed pool of worker threads.
+
+    The scheduled functions are kept in a priority queue ordered by their
+    next deadline. A single dispatcher thread wakes up when the earliest
+    deadline expires and hands the whole batch of due functions to the
+    workers, so the number of threads and wake ups doesn't grow with the
+    number of sampled VMs.
+    """
+    DEFAULT_LOG = logging.getLogger("SampleScheduler")
+
+    def __init__(self, workers, log=DEFAULT_LOG, timefn=utils.monotonic_time):
+        if workers < 1:
+            raise ValueError("workers must be greater than 0")
+
+        self._log = log
+        self._timefn = timefn
+        self._numWorkers = workers
+        self._cond = threading.Condition(threading.Lock())
+        self._calls = []
+        self._seq = itertools.count()
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._running = False
+
+        self._samples = 0
+        self._totalDelay = 0.0
+        self._maxDelay = 0.0
+
+    def start(self):
+        """
+        Start the dispatcher and the worker threads
+        """
+        with self._cond:
+            if self._running:
+                raise RuntimeError("SampleScheduler is started")
+            self._running = True
+
+        self._log.debug("Starting sample scheduler with %s workers",
+                        self._numWorkers)
+        self._threads.append(self._startThread(self._dispatch,
+                                               "SampleDispatcher"))
+        for i in range(self._numWorkers):
+            self._threads.append(self._startThread(self._work,
+                                                   "SampleWorker-%d" % i))
+
+    def stop(self):
+        """
+        Stop the dispatcher and the worker threads
+        """
+        self._log.debug("Stopping sample scheduler")
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        for i in range(self._numWorkers):
+            self._queue.put(None)
+
+    def schedule(self, group, statsFunction):
+        """
+        Schedule statsFunction for execution on behalf of group. The
+        function is first run as soon as a worker is available.
+        """
+        with self._cond:
+            call = _ScheduledCall(group, statsFunction, self._timefn())
+            self._push(call)
+            self._cond.notify()
+        return call
+
+    def unschedule(self, call):
+        """
+        Cancel a call returned by schedule. A running call completes but it
+        is not rescheduled.
+        """
+        with self._cond:
+            call.cancelled = True
+
+    def getStats(self):
+        """
+        Return the number of scheduled functions and the average and
+        maximum delay (in seconds) of the samples with respect to their
+        deadlines.
+        """
+        with self._cond:
+            pending = sum(1 for _, _, call in self._calls
+                          if not call.cancelled)
+            avgDelay = (self._totalDelay / self._samples
+                        if self._samples else 0.0)
+            return {'workers': self._numWorkers,
+                    'scheduled': pending,
+                    'samples': self._samples,
+                    'avgDelay': avgDelay,
+                    'maxDelay': self._maxDelay}
+
+    def _startThread(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _push(self, call):
+        heapq.heappush(self._calls, (call.deadline, next(self._seq), call))
+
+    def _dispatch(self):
+        self._log.debug("Sample dispatcher started")
+        while True:
+            with self._cond:
+                while self._running:
+                    if not self._calls:
+                        self._cond.wait()
+                        continue
+                    now = self._timefn()
+                    wait = self._calls[0][0] - now
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                else:
+                    break
+
+                batch = []
+                while self._calls and self._calls[0][0] <= now:
+                    _, _, call = heapq.heappop(self._calls)
+                    if not call.cancelled:
+                        batch.append(call)
+
+            for call in batch:
+                self._queue.put(call)
+        self._log.debug("Sample dispatcher finished")
+
+    def _work(self):
+        while True:
+            call = self._queue.get()
+            if call is None:
+                break
+            try:
+                self._run(call)
+            except:
+                self._log.error("Unhandled error running %s", call,
+                                exc_info=True)
+
+    def _run(self, call):
+        start = self._timefn()
+        call.delay = max(0.0, start - call.deadline)
+        call.statsFunction.recordJitter(call.delay)
+        interval = call.statsFunction.interval
+        if call.delay > interval:
+            self._log.warning("%s is running %.2f seconds behind its "
+                              "deadline", call.statsFunction, call.delay)
+
+        try:
+            call.group.runStatsFunction(call.statsFunction)
+        finally:
+            now = self._timefn()
+            with self._cond:
+                self._samples += 1
+                self._totalDelay += call.delay
+                self._maxDelay = max(self._maxDelay, call.delay)
+                if not call.cancelled:
+                    # Keep the original phase and skip the deadlines that
+                    # were missed while the function was running late.
+                    missed = max(0, int((now - call.deadline) // interval))
+                    if missed:
+                        call.statsFunction.recordSkipped(missed)
+                    call.deadline += interval * (missed + 1)
+                    self._push(call)
+                    self._cond.notify()
+
+
+# Kinds of statistics collected by BulkStatsSampler
+BULK_CPU = 'cpu'
+BULK_BALLOON = 'balloon'
+BULK_DISK = 'disk'
+BULK_DISK_LATENCY = 'diskLatency'
+BULK_NET = 'net'
+
+# Not all the libvirt bindings define the bulk stats constants
+_VIR_DOMAIN_STATS_CPU_TOTAL = getattr(
+    libvirt, 'VIR_DOMAIN_STATS_CPU_TOTAL', 2)
+_VIR_DOMAIN_STATS_BALLOON = getattr(
+    libvirt, 'VIR_DOMAIN_STATS_BALLOON', 4)
+_VIR_DOMAIN_STATS_INTERFACE = getattr(
+    libvirt, 'VIR_DOMAIN_STATS_INTERFACE', 16)
+_VIR_DOMAIN_STATS_BLOCK = getattr(
+    libvirt, 'VIR_DOMAIN_STATS_BLOCK', 32)
+_VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE = getattr(
+    libvirt, 'VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE', 1)
+
+_BULK_STATS_FLAGS = {
+    BULK_CPU: _VIR_DOMAIN_STATS_CPU_TOTAL,
+    BULK_BALLOON: _VIR_DOMAIN_STATS_BALLOON,
+    BULK_DISK: _VIR_DOMAIN_STATS_BLOCK,
+    BULK_DISK_LATENCY: _VIR_DOMAIN_STATS_BLOCK,
+    BULK_NET: _VIR_DOMAIN_STATS_INTERFACE,
+}
+
+
+def _bulkDevices(stats, prefix):
+    """
+    Yield (name, index) for every device of type 'prefix' ('block', 'net')
+    reported in the stats returned by virConnect.getAllDomainStats.
+    """
+    for i in xrange(stats.get('%s.count' % prefix, 0)):
+        name = stats.get('%s.%d.name' % (prefix, i))
+        if name is not None:
+            yield name, i
+
+
+CPU_STATS_FIELDS = ('cpu_time', 'user_time', 'system_time')
+
+
+def bulkCpuStats(stats):
+    """
+    Convert the bulk stats of a domain in the format returned by
+    virDomain.getCPUStats(True, 0)[0].
+    """
+    return {'cpu_time': stats['cpu.time'],
+            'user_time': stats['cpu.user'],
+            'system_time': stats['cpu.system']}
+
+
+def bulkBalloonStats(stats):
+    """
+    Return the current balloon size (in KiB) from the bulk stats of a
+    domain, as reported by virDomain.info()[2].
+    """
+    return stats['balloon.current']
+
+
+def bulkDiskStats(stats):
+    """
+    Convert the bulk stats of a domain in a dict mapping every drive name
+    to the tuple returned by virDomain.blockStats.
+    """
+    disks = {}
+    for name, i in _bulkDevices(stats, 'block'):
+        key = 'block.%d.' % i
+        disks[name] = (stats.get(key + 'rd.reqs', 0),
+                       stats.get(key + 'rd.bytes', 0),
+                       stats.get(key + 'wr.reqs', 0),
+                       stats.get(key + 'wr.bytes', 0),
+                       -1)
+    return disks
+
+
+def bulkDiskLatencyStats(stats):
+    """
+    Convert the bulk stats of a domain in a dict mapping every drive name
+    to the dict returned by virDomain.blockStatsFlags.
+    """
+    disks = {}
+    for name, i in _bulkDevices(stats, 'block'):
+        key = 'block.%d.' % i
+        disks[name] = {
+            'rd_bytes': stats.get(key + 'rd.bytes', 0),
+            'rd_operations': stats.get(key + 'rd.reqs', 0),
+            'rd_total_times': stats.get(key + 'rd.times', 0),
+            'wr_bytes': stats.get(key + 'wr.bytes', 0),
+            'wr_operations': stats.get(key + 'wr.reqs', 0),
+            'wr_total_times': stats.get(key + 'wr.times', 0),
+            'flush_operations': stats.get(key + 'fl.reqs', 0),
+            'flush_total_times': stats.get(key + 'fl.times', 0)}
+    return disks
+
+
+def bulkNetStats(stats):
+    """
+    Convert the bulk stats of a domain in a dict mapping every interface
+    name to the tuple returned by virDomain.interfaceStats.
+    """
+    nics = {}
+    for name, i in _bulkDevices(stats, 'net'):
+        key = 'net.%d.' % i
+        nics[name] = tuple(stats.get(key + field, 0) for field in (
+            'rx.bytes', 'rx.pkts', 'rx.errs', 'rx.drop',
+            'tx.bytes', 'tx.pkts', 'tx.errs', 'tx.drop'))
+    return nics
+
+
+class BulkStatsSampler(AdvancedStatsGroup):
+    """
+    Samples the statistics of all the running domains with a single libvirt
+    call per sampling interval.
+
+    The collectors of the vms register their AdvancedStatsFunction objects
+    for every kind of statistic (BULK_CPU, BULK_DISK, ...). When the kinds
+    sharing the same interval are due, the statistics of all the domains
+    are fetched at once with virConnect.getAllDomainStats and each function
+    is called with the slice of its own domain.
+    On libvirt versions lacking the bulk stats API the functions are called
+    without arguments, in a single pass, and they are expected to query
+    their domain directly.
+    """
+    DEFAULT_LOG = logging.getLogger("BulkStatsSampler")
+
+    def __init__(self, scheduler, connection, intervals, log=DEFAULT_LOG):
+        """
+        Initialize a BulkStatsSampler.
+
+        :param scheduler: The SampleScheduler running the sampler.
+        :param connection: The libvirt connection.
+        :param intervals: A dict mapping every kind of statistic to its
+                          sampling interval (in seconds).
+        """
+        AdvancedStatsGroup.__init__(self, scheduler, log=log)
+        self._conn = connection
+        self._bulkSupported = hasattr(connection, 'getAllDomainStats')
+        self._collectorsLock = threading.Lock()
+        self._collectors = {}
+
+        kindsByInterval = {}
+        for kind, interval in intervals.iteritems():
+            kindsByInterval.setdefault(interval, []).append(kind)
+
+        for interval, kinds in kindsByInterval.iteritems():
+            self.addStatsFunction(
+                AdvancedStatsFunction(self._makeSampleFunction(kinds),
+                                      interval))
+
+    def register(self, uuid, collector, statsFunctions):
+        """
+        Register the statistics functions of a collector.
+
+        :param uuid: The UUID of the domain sampled by the collector.
+        :param collector: An AdvancedStatsGroup, its pause state and
+                          exception handling are honoured.
+        :param statsFunctions: A dict mapping kinds of statistics to
+                               AdvancedStatsFunction objects.
+        """
+        with self._collectorsLock:
+            self._collectors[uuid] = (collector, statsFunctions)
+
+    def unregister(self, uuid):
+        with self._collectorsLock:
+            self._collectors.pop(uuid, None)
+
+    def _makeSampleFunction(self, kinds):
+        def sampleBulkStats():
+            self._sample(kinds)
+        sampleBulkStats.__name__ = 'sampleBulkStats_%s' % '_'.join(kinds)
+        return sampleBulkStats
+
+    def _getAllDomainStats(self, kinds):
+        if not self._bulkSupported:
+            return None
+
+        flags = 0
+        for kind in kinds:
+            flags |= _BULK_STATS_FLAGS[kind]
+
+        try:
+            domStats = self._conn.getAllDomainStats(
+                flags, _VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+                raise
+            self._log.info("Bulk stats not supported, falling back to "
+                           "per domain sampling")
+            self._bulkSupported = False
+            return None
+
+        return dict((dom.UUIDString(), stats) for dom, stats in domStats)
+
+    def _sample(self, kinds):
+        with self._collectorsLock:
+            collectors = self._collectors.items()
+
+        if not collectors:
+            return
+
+        allStats = self._getAllDomainStats(kinds)
+
+        for uuid, (collector, statsFunctions) in collectors:
+            if collector.isPaused():
+                continue
+
+            if allStats is None:
+                args = ()
+            elif uuid in allStats:
+                args = (allStats[uuid],)
+            else:
+                continue
+
+            sampled = False
+            for kind in kinds:
+                statsFunction = statsFunctions.get(kind)
+                if statsFunction is None:
+                    continue
+                try:
+                    statsFunction(*args)
+                except Exception as e:
+                    if not collector.handleStatsException(e):
+                        self._log.error("Stats function failed: %s",
+                                        statsFunction, exc_info=True)
+                else:
+                    sampled = True
+            if sampled:
+                self._notifySampled(collector)
 
 
 class HostStatsThread(threading.Thread):
@@ -372,7 +1153,7 @@ class HostStatsThread(threading.Thread):
         self.daemon = True
         self._log = log
         self._stopEvent = threading.Event()
-        self._samples = []
+        self._samples = SampleWindow(self.AVERAGING_WINDOW)
         self._updateIfidsIfrates()
         # in bytes-per-second
         self._lineRate = (sum(self._ifrates) or 1000) * (10 ** 6) / 8
@@ -410,10 +1191,8 @@ class HostStatsThread(threading.Thread):
             while not self._stopEvent.isSet():
                 try:
                     sample = self.sample()
-                    self._samples.append(sample)
+                    self._samples.append(sample.timestamp, sample)
                     self._lastSampleTime = sample.timestamp
-                    if len(self._samples) > self.AVERAGING_WINDOW:
-                        self._samples.pop(0)
                 except vm.TimeoutError:
                     self._log.error("Timeout while sampling stats",
                                     exc_info=True)
@@ -428,8 +1207,7 @@ class HostStatsThread(threading.Thread):
         stats['elapsedTime'] = int(time.time() - self.startTime)
         if len(self._samples) < 2:
             return stats
-        hs0, hs1 = self._samples[0], self._samples[-1]
-        interval = hs1.timestamp - hs0.timestamp
+        hs0, hs1, interval = self._samples.stats()
         jiffies = (hs1.pidcpu.user - hs0.pidcpu.user) % (2 ** 32)
         stats['cpuUserVdsmd'] = (jiffies / interval) % (2 ** 32)
         jiffies = hs1.pidcpu.sys - hs0.pidcpu.sys
@@ -466,8 +1244,7 @@ class HostStatsThread(threading.Thread):
                  'statsAge': time.time() - self._lastSampleTime}
         if len(self._samples) < 2:
             return stats
-        hs0, hs1 = self._samples[0], self._samples[-1]
-        interval = hs1.timestamp - hs0.timestamp
+        hs0, hs1, interval = self._samples.stats()
 
         rx = tx = rxDropped = txDropped = 0
         stats['network'] = {}
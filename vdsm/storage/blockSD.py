@@ -142,25 +142,226 @@ def _tellEnd(devPath):
         return f.tell()
 
 
-def _getVolsTree(sdUUID):
-    lvs = lvm.getLV(sdUUID)
-    vols = {}
-    for lv in lvs:
-        image = ""
-        parent = ""
-        for tag in lv.tags:
-            if tag.startswith(blockVolume.TAG_PREFIX_IMAGE):
-                image = tag[len(blockVolume.TAG_PREFIX_IMAGE):]
-            elif tag.startswith(blockVolume.TAG_PREFIX_PARENT):
-                parent = tag[len(blockVolume.TAG_PREFIX_PARENT):]
-            if parent and image:
-                vols[lv.name] = BlockSDVol(lv.name, image, parent)
-                break
+def _parseVolTags(lv):
+    """
+    Return the (image, parent) of the volume lv, "" for a missing tag.
+    """
+    image = ""
+    parent = ""
+    for tag in lv.tags:
+        if tag.startswith(blockVolume.TAG_PREFIX_IMAGE):
+            image = tag[len(blockVolume.TAG_PREFIX_IMAGE):]
+        elif tag.startswith(blockVolume.TAG_PREFIX_PARENT):
+            parent = tag[len(blockVolume.TAG_PREFIX_PARENT):]
+        if parent and image:
+            break
+    return image, parent
+
+
+class VolumeGraph(object):
+    """
+    The images and the parent/child relations of the volumes of a block
+    domain, as found in the tags of its LVs.
+
+    The graph is updated from the LVs of the domain, reindexing only the
+    LVs that changed since the previous update. The lookups can be done
+    from any thread, holding the lock of the graph.
+    """
+    log = logging.getLogger("Storage.VolumeGraph")
+
+    def __init__(self, sdUUID):
+        self.sdUUID = sdUUID
+        self.lock = threading.Lock()
+        # The lvm generation of the LVs of the last update
+        self.generation = None
+        # {lvName: lv}
+        self._lvs = {}
+        # {lvName: (image, parent)} of the LVs having an image or parent tag
+        self._tags = {}
+        # {volUUID: BlockSDVol} of the volumes having both tags
+        self._vols = {}
+        # {parentUUID: set(volUUIDs)}
+        self._children = {}
+        # {imgUUID: set(volUUIDs)}
+        self._images = {}
+        # {volUUID: ImgsPar} as returned by getAllVolumes
+        self._imgsPar = {}
+
+    def update(self, lvs):
+        """
+        Update the graph with lvs, the list of all the LVs of the domain.
+        """
+        lvs = dict((lv.name, lv) for lv in lvs)
+        dirty = set()
+        for name in set(self._lvs) - set(lvs):
+            del self._lvs[name]
+            dirty.update(self._reindex(name, None))
+        for name, lv in lvs.iteritems():
+            if self._lvs.get(name) != lv:
+                self._lvs[name] = lv
+                dirty.update(self._reindex(name, lv))
+
+        for volUUID in dirty:
+            if volUUID in self._vols:
+                self._imgsPar[volUUID] = self._makeImgsPar(volUUID)
+            else:
+                self._imgsPar.pop(volUUID, None)
+
+    def _reindex(self, name, lv):
+        """
+        Index the tags of lv, None for a removed LV, and return the volumes
+        whose getAllVolumes entry should be recomputed.
+        """
+        old = self._tags.get(name, ("", ""))
+        new = ("", "") if lv is None else _parseVolTags(lv)
+        if lv is not None and not all(new) and name not in SPECIAL_LVS:
+            self.log.warning("Ignoring Volume %s that lacks minimal tag set"
+                             "tags %s", name, lv.tags)
+        if new == old:
+            return ()
+
+        oldImage, oldParent = old
+        if oldImage:
+            _discard(self._images, oldImage, name)
+        if oldParent:
+            _discard(self._children, oldParent, name)
+        self._vols.pop(name, None)
+
+        image, parent = new
+        if image:
+            self._images.setdefault(image, set()).add(name)
+        if parent:
+            self._children.setdefault(parent, set()).add(name)
+        if image and parent:
+            self._vols[name] = BlockSDVol(name, image, parent)
+        if image or parent:
+            self._tags[name] = new
+        else:
+            self._tags.pop(name, None)
+
+        return (name, oldParent, parent)
+
+    def _makeImgsPar(self, volUUID):
+        vol = self._vols[volUUID]
+        if vol.parent != sd.BLANK_UUID and vol.parent not in self._vols:
+            self.log.warning("Found broken image %s, orphan volume %s/%s, "
+                             "parent %s", vol.image, self.sdUUID, volUUID,
+                             vol.parent)
+        # Template self image is the first image
+        imgs = set(self._vols[child].image
+                   for child in self._children.get(volUUID, ())
+                   if child in self._vols)
+        imgs.discard(vol.image)
+        return sd.ImgsPar((vol.image,) + tuple(sorted(imgs)), vol.parent)
+
+    def getAllVolumes(self):
+        """
+        Return dict {volUUID: ((imgUUIDs,), parentUUID)} of the domain, see
+        getAllVolumes().
+        """
+        with self.lock:
+            return dict(self._imgsPar)
+
+    def getVolume(self, volUUID):
+        """
+        Return the BlockSDVol of volUUID, or None if it is not a volume.
+        """
+        with self.lock:
+            return self._vols.get(volUUID)
+
+    def children(self, volUUID):
+        """
+        Return the names of the LVs tagged with volUUID as their parent.
+        """
+        with self.lock:
+            return tuple(self._children.get(volUUID, ()))
+
+    def imageVolumes(self, imgUUID):
+        """
+        Return the names of the LVs tagged with imgUUID as their image.
+        """
+        with self.lock:
+            return list(self._images.get(imgUUID, ()))
+
+    def chain(self, volUUID, imgUUID=None):
+        """
+        Return the list of the volumes from the base volume of volUUID up
+        to volUUID. If imgUUID is specified the chain stops at the volumes
+        of other images, e.g. a template.
+        """
+        chain = []
+        with self.lock:
+            vol = self._vols.get(volUUID)
+            while vol is not None and vol.name not in chain:
+                if imgUUID is not None and vol.image != imgUUID:
+                    break
+                chain.insert(0, vol.name)
+                vol = self._vols.get(vol.parent)
+        return chain
+
+    def leaves(self, imgUUID):
+        """
+        Return the volumes of imgUUID having no children in imgUUID.
+        """
+        with self.lock:
+            leaves = []
+            for volUUID in self._images.get(imgUUID, ()):
+                if volUUID not in self._vols:
+                    continue
+                if not any(self._vols[child].image == imgUUID
+                           for child in self._children.get(volUUID, ())
+                           if child in self._vols):
+                    leaves.append(volUUID)
+            return sorted(leaves)
+
+
+def _discard(index, key, name):
+    names = index.get(key)
+    if names is not None:
+        names.discard(name)
+        if not names:
+            del index[key]
+
+
+_volumeGraphs = {}
+_volumeGraphsLock = threading.Lock()
+
+
+def getVolumeGraph(sdUUID):
+    """
+    Return the up to date VolumeGraph of the domain.
+
+    The graph is updated only when the lvm generation of the LVs of the
+    domain changed, since its LVs could not change otherwise.
+    """
+    with _volumeGraphsLock:
+        graph = _volumeGraphs.get(sdUUID)
+        if graph is None:
+            graph = _volumeGraphs[sdUUID] = VolumeGraph(sdUUID)
+
+    with graph.lock:
+        generation = lvm.getLvGeneration(sdUUID)
+        if graph.generation is None or graph.generation != generation:
+            graph.update(lvm.getLV(sdUUID))
+            # The LVs may have been reloaded or invalidated while getting
+            # them, update again on the next call.
+            if lvm.getLvGeneration(sdUUID) == generation:
+                graph.generation = generation
+            else:
+                graph.generation = None
+        return graph
+
+
+def dropVolumeGraph(sdUUID=None):
+    """
+    Forget the VolumeGraph of the domain, or of all the domains if sdUUID
+    is None, when they are dropped from the domain cache.
+    """
+    with _volumeGraphsLock:
+        if sdUUID is None:
+            _volumeGraphs.clear()
         else:
-            if lv.name not in SPECIAL_LVS:
-                log.warning("Ignoring Volume %s that lacks minimal tag set"
-                            "tags %s" % (lv.name, lv.tags))
-    return vols
+            _volumeGraphs.pop(sdUUID, None)
 
 
 def getAllVolumes(sdUUID):
@@ -172,27 +373,7 @@ def getAllVolumes(sdUUID):
     For other volumes, there is just a single imageUUID.
     Template self image is the 1st term in template volume entry images.
     """
-    vols = _getVolsTree(sdUUID)
-    res = {}
-    for volName in vols.iterkeys():
-        res[volName] = {'imgs': [], 'parent': None}
-
-    for volName, vImg, parentVol in vols.itervalues():
-        res[volName]['parent'] = parentVol
-        if vImg not in res[volName]['imgs']:
-            res[volName]['imgs'].insert(0, vImg)
-        if parentVol != sd.BLANK_UUID:
-            try:
-                imgIsUnknown = vImg not in res[parentVol]['imgs']
-            except KeyError:
-                log.warning("Found broken image %s, orphan volume %s/%s, "
-                            "parent %s", vImg, sdUUID, volName, parentVol)
-            else:
-                if imgIsUnknown:
-                    res[parentVol]['imgs'].append(vImg)
-
-    return dict((k, sd.ImgsPar(tuple(v['imgs']), v['parent']))
-                for k, v in res.iteritems())
+    return getVolumeGraph(sdUUID).getAllVolumes()
 
 
 def deleteVolumes(sdUUID, vols):
@@ -1021,6 +1202,9 @@ class BlockStorageDomain(sd.StorageDomain):
         volUUIDs = self._getImgExclusiveVols(imgUUID, allVols)
         lvm.deactivateLVs(self.sdUUID, volUUIDs)
 
+    def getVolumeGraph(self):
+        return getVolumeGraph(self.sdUUID)
+
     def getAllVolumesImages(self):
         """
         Return all the images that depend on a volume.
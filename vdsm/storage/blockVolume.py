@@ -492,17 +492,16 @@ class BlockVolume(volume.Volume):
         Fetch the list of the Volumes UUIDs, not including the shared base
         (template)
         """
-        lvs = lvm.lvsByTag(sdUUID, "%s%s" % (TAG_PREFIX_IMAGE, imgUUID))
-        return [lv.name for lv in lvs]
+        graph = sdCache.produce(sdUUID).getVolumeGraph()
+        return graph.imageVolumes(imgUUID)
 
     def getChildren(self):
         """ Return children volume UUIDs.
 
         Children can be found in any image of the volume SD.
         """
-        lvs = lvm.lvsByTag(self.sdUUID,
-                           "%s%s" % (TAG_PREFIX_PARENT, self.volUUID))
-        return tuple(lv.name for lv in lvs)
+        graph = sdCache.produce(self.sdUUID).getVolumeGraph()
+        return graph.children(self.volUUID)
 
     def removeMetadata(self, metaId):
         """
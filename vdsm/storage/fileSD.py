@@ -24,6 +24,9 @@ import logging
 import glob
 import fnmatch
 import re
+import stat
+import threading
+import time
 
 import sd
 import storage_exception as se
@@ -132,6 +135,82 @@ FileSDMetadata = lambda metafile: DictValidator(
     PersistentDict(FileMetadataRW(metafile)), FILE_SD_MD_FIELDS)
 
 
+# An image directory modified in the last RECENT_CHANGE seconds is listed
+# again on every update: the timestamps of some file systems have a coarse
+# resolution, and a change made in the same tick of the last listing does
+# not change the stat of the directory.
+RECENT_CHANGE = 2
+
+
+class VolumeIndex(object):
+    """
+    The volumes found in the image directories of a file domain.
+
+    The volumes of an image directory are listed again only when the
+    directory changed since it was last listed, as seen in its stat, or
+    when it was modified recently. The directory stat is taken before
+    listing it, so a change made while listing it is found on the next
+    update.
+    """
+    def __init__(self, timefn=time.time):
+        self.lock = threading.Lock()
+        self._timefn = timefn
+        # {imgUUID: (dirKey, (volUUIDs,))}
+        self._images = {}
+
+    def update(self, oop, imagesDir):
+        """
+        Update the index using oop and return the list of the (imgUUID,
+        (volUUIDs,)) tuples of the images in imagesDir.
+        """
+        with self.lock:
+            keys = {}
+            recent = set()
+            now = self._timefn()
+            for path, st, err in oop.globStat(os.path.join(imagesDir, "*")):
+                if err is None and stat.S_ISDIR(st.st_mode):
+                    imgUUID = os.path.basename(path)
+                    keys[imgUUID] = _dirKey(st)
+                    if now - st.st_mtime < RECENT_CHANGE:
+                        recent.add(imgUUID)
+
+            for imgUUID in set(self._images) - set(keys):
+                del self._images[imgUUID]
+
+            changed = [imgUUID for imgUUID, key in keys.iteritems()
+                       if imgUUID in recent or
+                       self._images.get(imgUUID, (None,))[0] != key]
+            if changed:
+                patterns = [os.path.join(imagesDir, imgUUID, "*.meta")
+                            for imgUUID in changed]
+                for imgUUID, (paths, err) in zip(changed,
+                                                 oop.globMany(patterns)):
+                    if err is not None:
+                        raise err
+                    vols = tuple(os.path.splitext(os.path.basename(path))[0]
+                                 for path in paths)
+                    self._images[imgUUID] = (keys[imgUUID], vols)
+
+            return sorted((imgUUID, vols)
+                          for imgUUID, (key, vols) in self._images.iteritems())
+
+
+def _dirKey(st):
+    return st.st_ino, st.st_mtime, st.st_ctime, st.st_size
+
+
+_volumeIndexes = {}
+_volumeIndexesLock = threading.Lock()
+
+
+def getVolumeIndex(sdUUID):
+    with _volumeIndexesLock:
+        index = _volumeIndexes.get(sdUUID)
+        if index is None:
+            index = _volumeIndexes[sdUUID] = VolumeIndex()
+        return index
+
+
 class FileStorageDomain(sd.StorageDomain):
     def __init__(self, domainPath):
         # Using glob might look like the simplest thing to do but it isn't
@@ -243,12 +322,15 @@ class FileStorageDomain(sd.StorageDomain):
 
         filesDict = {}
         filePrefixLen = len(basedir) + 1
-        for entry in filesList:
-            st = self.oop.os.stat(entry)
+        for entry, (st, err) in zip(filesList,
+                                    self.oop.statMany(filesList)):
+            if err is not None:
+                raise err
+
             stats = {'size': str(st.st_size), 'ctime': str(st.st_ctime)}
 
             try:
-                self.oop.fileUtils.validateQemuReadable(entry)
+                fileUtils.validateQemuReadableStat(st)
                 stats['status'] = 0  # Status OK
             except OSError as e:
                 if e.errno != errno.EACCES:
@@ -283,9 +365,9 @@ class FileStorageDomain(sd.StorageDomain):
         """ Returns file volume allocated size in bytes. """
         volPath = os.path.join(self.mountpoint, self.sdUUID, 'images',
                                imgUUID, volUUID)
-        stat = self.oop.os.stat(volPath)
+        st = self.oop.os.stat(volPath)
 
-        return stat.st_blocks * ST_BYTES_PER_BLOCK
+        return st.st_blocks * ST_BYTES_PER_BLOCK
 
     @classmethod
     def validateCreateVolumeParams(cls, volFormat, preallocate, srcVolUUID):
@@ -332,11 +414,10 @@ class FileStorageDomain(sd.StorageDomain):
                                self.getPools()[0],
                                self.sdUUID, sd.DOMAIN_IMAGES)
         pattern = os.path.join(pattern, constants.UUID_GLOB_PATTERN)
-        files = self.oop.glob.glob(pattern)
         images = set()
-        for i in files:
-            if self.oop.os.path.isdir(i):
-                images.add(os.path.basename(i))
+        for path, st, err in self.oop.globStat(pattern):
+            if err is None and stat.S_ISDIR(st.st_mode):
+                images.add(os.path.basename(path))
         return images
 
     def getImagePath(self, imgUUID):
@@ -388,36 +469,33 @@ class FileStorageDomain(sd.StorageDomain):
         metadata.
         Setting parent = None for compatibility with block version.
         """
-        volMetaPattern = os.path.join(self.mountpoint, self.sdUUID,
-                                      sd.DOMAIN_IMAGES, "*", "*.meta")
-        volMetaPaths = self.oop.glob.glob(volMetaPattern)
+        imagesDir = os.path.join(self.mountpoint, self.sdUUID,
+                                 sd.DOMAIN_IMAGES)
+        images = getVolumeIndex(self.sdUUID).update(self.oop, imagesDir)
         volumes = {}
-        for metaPath in volMetaPaths:
-            head, tail = os.path.split(metaPath)
-            volUUID, volExt = os.path.splitext(tail)
-            imgUUID = os.path.basename(head)
-            if volUUID in volumes:
-                # Templates have no parents
-                volumes[volUUID]['parent'] = sd.BLANK_UUID
-                # Template volumes are hard linked in every image directory
-                # which is derived from that template, therefore:
-                # 1. a template volume which is in use will appear at least
-                # twice (in the template image dir and in the derived image
-                # dir)
-                # 2. Any volume which appears more than once in the dir tree is
-                # by definition a template volume.
-                # 3. Any image which has more than 1 volume is not a template
-                # image. Therefore if imgUUID appears in more than one path
-                # then it is not a template.
-                if len(tuple(vPath for vPath in volMetaPaths
-                             if imgUUID in vPath)) > 1:
-                    # Add template additonal image
-                    volumes[volUUID]['imgs'].append(imgUUID)
+        for imgUUID, vols in images:
+            for volUUID in vols:
+                if volUUID in volumes:
+                    # Templates have no parents
+                    volumes[volUUID]['parent'] = sd.BLANK_UUID
+                    # Template volumes are hard linked in every image
+                    # directory which is derived from that template,
+                    # therefore:
+                    # 1. a template volume which is in use will appear at
+                    # least twice (in the template image dir and in the
+                    # derived image dir)
+                    # 2. Any volume which appears more than once in the dir
+                    # tree is by definition a template volume.
+                    # 3. Any image which has more than 1 volume is not a
+                    # template image.
+                    if len(vols) > 1:
+                        # Add template additonal image
+                        volumes[volUUID]['imgs'].append(imgUUID)
+                    else:
+                        # Insert at head the template self image
+                        volumes[volUUID]['imgs'].insert(0, imgUUID)
                 else:
-                    # Insert at head the template self image
-                    volumes[volUUID]['imgs'].insert(0, imgUUID)
-            else:
-                volumes[volUUID] = {'imgs': [imgUUID], 'parent': None}
+                    volumes[volUUID] = {'imgs': [imgUUID], 'parent': None}
         return dict((k, sd.ImgsPar(tuple(v['imgs']), v['parent']))
                     for k, v in volumes.iteritems())
 
@@ -108,9 +108,15 @@ def validateQemuReadable(targetPath):
     """
     Validate that qemu process can read file
     """
+    validateQemuReadableStat(os.stat(targetPath))
+
+
+def validateQemuReadableStat(st):
+    """
+    Validate that qemu process can read the file of the stat result st
+    """
     gids = (grp.getgrnam(constants.DISKIMAGE_GROUP).gr_gid,
             grp.getgrnam(constants.METADATA_GROUP).gr_gid)
-    st = os.stat(targetPath)
     if not (st.st_gid in gids and st.st_mode & stat.S_IRGRP or
             st.st_mode & stat.S_IROTH):
         raise OSError(errno.EACCES, os.strerror(errno.EACCES))
@@ -365,6 +371,48 @@ class DirectFile(object):
                     msg = os.strerror(err)
                     raise OSError(err, msg)
 
+    def pread(self, offset, size):
+        """
+        Read size bytes at offset without changing the file position, both
+        must be multiples of 512.
+        """
+        if (offset % 512) or (size % 512):
+            raise ValueError("You can only read in 512 multiplies")
+
+        with self._createAlignedBuffer(size) as pbuff:
+            numRead = libc.pread64(self._fd, pbuff, ctypes.c_size_t(size),
+                                   ctypes.c_int64(offset))
+            if numRead < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            ptr = CharPointer.from_buffer(pbuff)
+            return ptr[:numRead]
+
+    def pwrite(self, offset, data):
+        """
+        Write data at offset without changing the file position. The offset
+        must be a multiple of 512, data is padded to a multiple of 512.
+        Return the number of bytes written.
+        """
+        if offset % 512:
+            raise ValueError("You can only write in 512 multiplies")
+
+        length = len(data)
+        padding = 512 - (length % 512)
+        if padding == 512:
+            padding = 0
+        length = length + padding
+        pdata = ctypes.c_char_p(data)
+        with self._createAlignedBuffer(length) as pbuff:
+            ctypes.memmove(pbuff, pdata, len(data))
+            numWritten = libc.pwrite64(self._fd, pbuff,
+                                       ctypes.c_size_t(length),
+                                       ctypes.c_int64(offset))
+            if numWritten < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return numWritten
+
     def seek(self, offset, whence=os.SEEK_SET):
         return os.lseek(self._fd, offset, whence)
 
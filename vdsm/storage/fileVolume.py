@@ -20,10 +20,11 @@
 
 import errno
 import os
+import re
 import sanlock
 
 import storage_exception as se
-from vdsm.utils import ActionStopped, grepCmd
+from vdsm.utils import ActionStopped
 from sdc import sdCache
 import outOfProcess as oop
 import volume
@@ -38,6 +39,10 @@ META_FILEEXT = ".meta"
 LEASE_FILEEXT = ".lease"
 LEASE_FILEOFFSET = 0
 
+# The number of metadata files read by a single out of process call, each
+# call must complete within the timeout of the process pool.
+META_READ_BATCH = 64
+
 BLOCK_SIZE = volume.BLOCK_SIZE
 
 
@@ -376,16 +381,18 @@ class FileVolume(volume.Volume):
         """
         domPath = self.imagePath.split('images')[0]
         metaPattern = os.path.join(domPath, 'images', '*', '*.meta')
-        metaPaths = oop.getProcessPool(self.sdUUID).glob.glob(metaPattern)
-        pattern = "%s.*%s" % (volume.PUUID, self.volUUID)
-        matches = grepCmd(pattern, metaPaths)
-        if matches:
-            children = []
-            for line in matches:
-                volMeta = os.path.basename(line.split(':')[0])
-                children.append(os.path.splitext(volMeta)[0])  # volUUID
-        else:
-            children = tuple()
+        procPool = oop.getProcessPool(self.sdUUID)
+        metaPaths = procPool.glob.glob(metaPattern)
+        pattern = re.compile("%s.*%s" % (volume.PUUID, self.volUUID))
+        children = []
+        for i in xrange(0, len(metaPaths), META_READ_BATCH):
+            batch = metaPaths[i:i + META_READ_BATCH]
+            # Volumes removed since the glob are skipped
+            for metaPath, (lines, err) in zip(
+                    batch, procPool.readLinesMany(batch, direct=True)):
+                if err is None and any(pattern.search(l) for l in lines):
+                    volMeta = os.path.basename(metaPath)
+                    children.append(os.path.splitext(volMeta)[0])  # volUUID
 
         return tuple(children)
 
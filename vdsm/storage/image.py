@@ -30,6 +30,7 @@ from sdc import sdCache
 import sd
 import misc
 import fileUtils
+import imageCopy
 import imageSharing
 from vdsm.config import config
 from vdsm.utils import ActionStopped
@@ -163,8 +164,12 @@ class Image:
         Return the chain of volumes of image as a sorted list
         (not including a shared base (template) if any)
         """
+        dom = sdCache.produce(sdUUID)
+        if dom.getStorageType() in sd.BLOCK_DOMAIN_TYPES:
+            return self._getBlockChain(dom, imgUUID, volUUID)
+
         chain = []
-        volclass = sdCache.produce(sdUUID).getVolumeClass()
+        volclass = dom.getVolumeClass()
 
         # Use volUUID when provided
         if volUUID:
@@ -215,6 +220,35 @@ class Image:
         self.log.info("sdUUID=%s imgUUID=%s chain=%s ", sdUUID, imgUUID, chain)
         return chain
 
+    def _getBlockChain(self, dom, imgUUID, volUUID=None):
+        """
+        Return the chain of volumes of image, see getChain, looking up the
+        relations of the volumes in the volume graph of the block domain
+        instead of reading the metadata of every volume.
+        """
+        graph = dom.getVolumeGraph()
+        if not volUUID:
+            if not graph.imageVolumes(imgUUID):
+                raise se.ImageDoesNotExistInSD(imgUUID, dom.sdUUID)
+            leaves = graph.leaves(imgUUID)
+            if not leaves:
+                self.log.error("There is no leaf in the image %s", imgUUID)
+                raise se.ImageIsNotLegalChain(imgUUID)
+            volUUID = leaves[0]
+
+        volclass = dom.getVolumeClass()
+        # A template is not part of the chain of the images based on it,
+        # unless it is the requested volume.
+        chain = [volclass(self.repoPath, dom.sdUUID, imgUUID, uuid)
+                 for uuid in graph.chain(volUUID, imgUUID)]
+        if not chain:
+            # Not a volume of the image, fail as the volume lookup would
+            chain = [volclass(self.repoPath, dom.sdUUID, imgUUID, volUUID)]
+
+        self.log.info("sdUUID=%s imgUUID=%s chain=%s ", dom.sdUUID, imgUUID,
+                      chain)
+        return chain
+
     def getTemplate(self, sdUUID, imgUUID):
         """
         Return template of the image
@@ -413,36 +447,30 @@ class Image:
             raise
 
         try:
-            for srcVol in chains['srcChain']:
-                # Do the actual copy
-                try:
+            # The volumes have the same format on both domains and are copied
+            # as is. They are independent files, so the whole chain is copied
+            # at once.
+            try:
+                jobs = []
+                for srcVol in chains['srcChain']:
                     dstVol = destDom.produceVolume(imgUUID=imgUUID,
                                                    volUUID=srcVol.volUUID)
-                    srcFmt = srcVol.getFormat()
-                    if srcFmt == volume.RAW_FORMAT:
-                        srcFmtStr = volume.fmt2str(srcFmt)
-                        dstFmtStr = volume.fmt2str(dstVol.getFormat())
-                        self.log.debug("start qemu convert")
-                        qemuImg.convert(srcVol.getVolumePath(),
-                                        dstVol.getVolumePath(),
-                                        vars.task.aborting,
-                                        srcFmtStr, dstFmtStr)
-                    else:
-                        srcSize = srcVol.getVolumeSize(bs=1)
-                        misc.ddWatchCopy(srcVol.getVolumePath(),
-                                         dstVol.getVolumePath(),
-                                         vars.task.aborting,
-                                         size=srcSize)
-                except ActionStopped:
-                    raise
-                except se.StorageException:
-                    self.log.error("Unexpected error", exc_info=True)
-                    raise
-                except Exception:
-                    self.log.error("Copy image error: image=%s, src domain=%s,"
-                                   " dst domain=%s", imgUUID, srcSdUUID,
-                                   destDom.sdUUID, exc_info=True)
-                    raise se.CopyImageError()
+                    jobs.append(imageCopy.CopyJob(
+                        srcVol.getVolumePath(), dstVol.getVolumePath(),
+                        srcVol.getVolumeSize(bs=1),
+                        destDom.supportsSparseness))
+                imageCopy.copyVolumes(jobs, vars.task.aborting,
+                                      vars.task.reportProgress)
+            except ActionStopped:
+                raise
+            except se.StorageException:
+                self.log.error("Unexpected error", exc_info=True)
+                raise
+            except Exception:
+                self.log.error("Copy image error: image=%s, src domain=%s,"
+                               " dst domain=%s", imgUUID, srcSdUUID,
+                               destDom.sdUUID, exc_info=True)
+                raise se.CopyImageError()
         finally:
             # teardown volumes
             self.__cleanupMove(srcLeafVol, dstLeafVol)
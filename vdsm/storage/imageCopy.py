@@ -0,0 +1,272 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+"""
+Byte for byte copy of volumes, split in extents copied by several threads.
+
+The ranges of the source reported as zero by "qemu-img map" are not read,
+and the zero ranges are not written when the destination already reads as
+zeros, e.g. a new volume of a file domain. All the copies of the host share
+a bandwidth and an IOPS throttle.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import Queue
+from collections import namedtuple
+
+from vdsm import qemuImg
+from vdsm import utils
+from vdsm.config import config
+import fileUtils
+import storage_exception as se
+
+MiB = 1 << 20
+
+# The unit of work of the copy threads
+EXTENT_SIZE = 64 * MiB
+
+# The size of the reads and writes
+CHUNK_SIZE = MiB
+
+# How often the stop condition of a copy is checked, in seconds
+STOP_POLL_INTERVAL = 1
+
+_ZEROS = "\0" * CHUNK_SIZE
+
+log = logging.getLogger("Storage.ImageCopy")
+
+# A copy of the size bytes of src to dst. skipZeros tells that dst already
+# reads as zeros, so the zero ranges need not be written.
+CopyJob = namedtuple("CopyJob", "src, dst, size, skipZeros")
+
+Extent = namedtuple("Extent", "job, start, length, zero")
+
+
+class Throttle(object):
+    """
+    Limit the rate at which several threads consume some resource to rate
+    units per second, 0 meaning no limit.
+    """
+    def __init__(self, rate, clock=utils.monotonic_time, sleep=time.sleep):
+        self._rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # The time at which the next units are available
+        self._next = 0
+
+    def consume(self, amount):
+        """
+        Wait until amount units can be consumed without exceeding the rate.
+        """
+        if not self._rate:
+            return
+
+        with self._lock:
+            now = self._clock()
+            start = max(now, self._next)
+            self._next = start + float(amount) / self._rate
+
+        if start > now:
+            self._sleep(start - now)
+
+
+_bandwidth = Throttle(config.getint('irs', 'copy_max_bandwidth') * MiB)
+_iops = Throttle(config.getint('irs', 'copy_max_iops'))
+
+
+def copyVolumes(jobs, stop=None, progress=None, workers=None):
+    """
+    Copy the volumes of jobs, a list of CopyJobs. The extents of all the
+    volumes are copied concurrently by the workers threads.
+
+    stop is checked while copying and utils.ActionStopped is raised once it
+    returns True. progress is called with the number of bytes done and the
+    total number of bytes as the copy goes.
+    """
+    if workers is None:
+        workers = config.getint('irs', 'copy_workers')
+    copier = _Copier(jobs, progress)
+    copier.run(stop, workers)
+
+
+class _Copier(object):
+    def __init__(self, jobs, progress):
+        self._jobs = jobs
+        self._progress = progress
+        self._lock = threading.Lock()
+        self._done = 0
+        self._total = sum(job.size for job in jobs)
+        self._queue = Queue.Queue()
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+        self._running = 0
+        self._error = None
+
+    def run(self, stop, workers):
+        if stop is not None and stop():
+            raise utils.ActionStopped()
+
+        skipped = 0
+        for job in self._jobs:
+            for extent in _extents(job):
+                if extent.zero and job.skipZeros:
+                    skipped += extent.length
+                else:
+                    self._queue.put(extent)
+        self._advance(skipped)
+
+        workers = max(1, min(workers, self._queue.qsize()))
+        threads = []
+        self._running = workers
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name="copy-%d" % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        try:
+            while not self._finished.isSet():
+                self._finished.wait(None if stop is None
+                                    else STOP_POLL_INTERVAL)
+                if not self._finished.isSet() and stop():
+                    raise utils.ActionStopped()
+        finally:
+            # The threads stop after their current chunk, the files must be
+            # closed before the volumes can be torn down.
+            self._cancelled.set()
+            for t in threads:
+                t.join()
+
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def _work(self):
+        try:
+            while not self._cancelled.isSet():
+                try:
+                    extent = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                _copyExtent(extent, self._cancelled, self._advance)
+        except Exception:
+            log.error("Error copying volumes", exc_info=True)
+            with self._lock:
+                if self._error is None:
+                    self._error = sys.exc_info()
+            self._cancelled.set()
+        finally:
+            with self._lock:
+                self._running -= 1
+                if self._running == 0:
+                    self._finished.set()
+
+    def _advance(self, nbytes):
+        with self._lock:
+            self._done += nbytes
+            done = self._done
+        if self._progress is not None and nbytes:
+            self._progress(done, self._total)
+
+
+def _extents(job):
+    """
+    Split the copy of job in extents of up to EXTENT_SIZE, flagging those
+    reading as zeros.
+    """
+    try:
+        ranges = qemuImg.map(job.src, qemuImg.FORMAT.RAW)
+    except qemuImg.QImgError:
+        log.warning("Cannot map %s, copying all of it", job.src,
+                    exc_info=True)
+        ranges = []
+
+    pos = 0
+    for r in ranges:
+        end = min(r['start'] + r['length'], job.size)
+        if r['start'] != pos or end <= pos:
+            break
+        zero = r.get('zero', False) or not r.get('data', True)
+        for extent in _split(job, pos, end, zero):
+            yield extent
+        pos = end
+
+    # Copy whatever the map did not cover
+    for extent in _split(job, pos, job.size, False):
+        yield extent
+
+
+def _split(job, start, end, zero):
+    while start < end:
+        length = min(end, (start // EXTENT_SIZE + 1) * EXTENT_SIZE) - start
+        yield Extent(job, start, length, zero)
+        start += length
+
+
+def _copyExtent(extent, cancelled, advance):
+    job = extent.job
+    src = None
+    dstDirect = None
+    dstFile = None
+    try:
+        if not extent.zero:
+            src = fileUtils.open_ex(job.src, "dr")
+
+        pos = extent.start
+        end = extent.start + extent.length
+        while pos < end and not cancelled.isSet():
+            n = min(CHUNK_SIZE, end - pos)
+            if src is None:
+                data = _ZEROS[:n]
+            else:
+                _iops.consume(1)
+                _bandwidth.consume(n)
+                data = src.pread(pos, (n + 511) & ~511)[:n]
+                if len(data) < n:
+                    raise se.MiscBlockReadIncomplete(job.src, pos, n)
+
+            if not (job.skipZeros and data == _ZEROS[:n]):
+                _iops.consume(1)
+                if src is None:
+                    _bandwidth.consume(n)
+                if pos % 512 == 0 and n % 512 == 0:
+                    if dstDirect is None:
+                        dstDirect = fileUtils.open_ex(job.dst, "r+d")
+                    dstDirect.pwrite(pos, data)
+                else:
+                    # The unaligned tail of a file
+                    if dstFile is None:
+                        dstFile = open(job.dst, "r+b", 0)
+                    dstFile.seek(pos)
+                    dstFile.write(data)
+
+            advance(n)
+            pos += n
+
+        if dstFile is not None:
+            os.fdatasync(dstFile.fileno())
+    finally:
+        for f in (src, dstDirect, dstFile):
+            if f is not None:
+                f.close()
@@ -43,6 +43,8 @@ import multipath
 import storage_exception as se
 from vdsm.config import config
 import devicemapper
+import lvmHelper
+import udevMonitor
 
 log = logging.getLogger("Storage.LVM")
 
@@ -238,6 +240,116 @@ def makeLV(*args):
     return LV(*args)
 
 
+class _Reload(object):
+    """
+    A reload of the cache, shared by all the threads waiting for it.
+    """
+    def __init__(self):
+        # The names to reload, None for all
+        self.names = set()
+        # The generation of the entries when the reload started
+        self.generation = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def add(self, names):
+        if not names:
+            self.names = None
+        elif self.names is not None:
+            self.names.update(names)
+
+    def covers(self, names):
+        return self.names is None or bool(names) and \
+            self.names.issuperset(names)
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return dict(self.result)
+
+
+class ReloadCoalescer(object):
+    """
+    Merge the concurrent reloads of the cache into a single lvm command.
+
+    Reloads are identified by a key (e.g. the VG of the reloaded LVs) and
+    the names to reload. At most one reload per key is running, a thread
+    asking for names the running reload covers just waits for its result,
+    unless the entries were invalidated since the reload started. The other
+    requests arriving meanwhile are merged into one pending reload, started
+    as soon as the running one is done.
+    """
+
+    def __init__(self, reload, generation=None):
+        # reload(key, names) -> dict of the reloaded entries
+        self._reload = reload
+        # generation(key) -> a value changing when the entries of key are
+        # invalidated, None if the running reloads are always joined.
+        self._generation = generation
+        self._lock = threading.Lock()
+        self._running = {}
+        self._pending = {}
+
+    def reload(self, key, names=None):
+        names = _normalizeargs(names)
+        with self._lock:
+            shared = self._running.get(key)
+            if (shared is None or not shared.covers(names) or
+                    not self._isFresh(key, shared)):
+                shared = self._pending.get(key)
+                if shared is None:
+                    mine = self._pending[key] = _Reload()
+                    mine.add(names)
+                else:
+                    shared.add(names)
+
+        if shared is not None:
+            return shared.wait()
+
+        # Wait for the running reload, the requests arriving meanwhile are
+        # merged into ours.
+        while True:
+            with self._lock:
+                running = self._running.get(key)
+                if running is None:
+                    del self._pending[key]
+                    if self._generation is not None:
+                        mine.generation = self._generation(key)
+                    self._running[key] = mine
+                    break
+            running.done.wait()
+
+        names = None if mine.names is None else sorted(mine.names)
+        result = error = None
+        try:
+            result = self._reload(key, names)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with self._lock:
+                del self._running[key]
+            mine.finish(result, error)
+
+        return dict(result)
+
+    def _isFresh(self, key, reload):
+        """
+        Return True if nothing was invalidated since reload started, so its
+        result is fresh enough for a caller asking now.
+        """
+        if self._generation is None:
+            return True
+        return reload.generation == self._generation(key)
+
+
 class LVMCache(object):
     """
     Keep all the LVM information.
@@ -257,14 +369,15 @@ class LVMCache(object):
 
             return self._extraCfg
 
-    def _addExtraCfg(self, cmd, devices=tuple()):
-        newcmd = [constants.EXT_LVM, cmd[0]]
+    def _getConfig(self, devices=tuple()):
         if devices:
-            conf = _buildConfig(devices)
+            return _buildConfig(devices)
         else:
-            conf = self._getCachedExtraCfg()
+            return self._getCachedExtraCfg()
 
-        newcmd += ["--config", conf]
+    def _addExtraCfg(self, cmd, devices=tuple()):
+        newcmd = [constants.EXT_LVM, cmd[0]]
+        newcmd += ["--config", self._getConfig(devices)]
 
         if len(cmd) > 1:
             newcmd += cmd[1:]
@@ -289,6 +402,19 @@ class LVMCache(object):
         self._pvs = {}
         self._vgs = {}
         self._lvs = {}
+        # Bumped when all the LVs are dropped from the cache
+        self._lvEpoch = 0
+        # {vgName: generation}, bumped when the LVs of the VG change
+        self._lvGenerations = {}
+        self._vgReloads = ReloadCoalescer(
+            lambda key, vgNames: self._reloadvgs(vgNames))
+        # A thread invalidating LVs, e.g. after lvcreate, must not get the
+        # result of a reload started before the invalidation.
+        self._lvReloads = ReloadCoalescer(self._reloadlvs, self.lvGeneration)
+        if config.getboolean('irs', 'lvm_helper'):
+            self._helper = lvmHelper.LVMHelper()
+        else:
+            self._helper = None
 
     def cmd(self, cmd, devices=tuple()):
         finalCmd = self._addExtraCfg(cmd, devices)
@@ -306,6 +432,50 @@ class LVMCache(object):
 
         return rc, out, err
 
+    def report(self, cmd, devices=tuple()):
+        """
+        Run a pvs, vgs or lvs report for the cache. The reports go through
+        the lvm helper when it is enabled, falling back to running lvm
+        directly if the helper fails.
+        """
+        return self.reportMany([(cmd, devices)])[0]
+
+    def reportMany(self, reports):
+        """
+        Run the reports given as a list of (cmd, devices) tuples, see
+        report. When the lvm helper is enabled they are sent in a single
+        request. Return the list of their (rc, out, err) results.
+        """
+        if self._helper is None:
+            return [self.cmd(cmd, devices) for cmd, devices in reports]
+
+        try:
+            return self._helperReport(reports)
+        except Exception:
+            log.warning("lvm helper failed, running %s directly",
+                        ", ".join(cmd[0] for cmd, devices in reports),
+                        exc_info=True)
+            return [self.cmd(cmd, devices) for cmd, devices in reports]
+
+    def _helperReport(self, reports):
+        confs = [self._getConfig(devices) for cmd, devices in reports]
+        results = self._helper.report(
+            [(cmd, conf) for (cmd, devices), conf in zip(reports, confs)])
+
+        failed = [i for i, (rc, out, err) in enumerate(results) if rc != 0]
+        if failed:
+            # Filter might be stale, see cmd
+            self.invalidateFilter()
+            newConf = self._getConfig()
+            retry = [i for i in failed if confs[i] != newConf]
+            if retry:
+                retried = self._helper.report(
+                    [(reports[i][0], newConf) for i in retry])
+                for i, res in zip(retry, retried):
+                    results[i] = res
+
+        return results
+
     def __str__(self):
         return ("PVS:\n%s\n\nVGS:\n%s\n\nLVS:\n%s" %
                 (pp.pformat(self._pvs),
@@ -313,40 +483,54 @@ class LVMCache(object):
                  pp.pformat(self._lvs)))
 
     def bootstrap(self):
-        self._reloadpvs()
-        self._reloadvgs()
-        self._reloadAllLvs()
+        self._reloadAll()
+
+    def _reloadAll(self):
+        """
+        Reload all the PVs, VGs and LVs, running their reports at once.
+        Return the reloaded VGs.
+        """
+        reports = [(list(PVS_CMD), ()), (list(VGS_CMD), ()),
+                   (list(LVS_CMD), ())]
+        with self._oplock.acquireContext(LVM_OP_RELOAD):
+            pvsRes, vgsRes, lvsRes = self.reportMany(reports)
+            self._updatepvs([], pvsRes)
+            vgs = self._updatevgs([], vgsRes)
+            self._updateAllLvs(lvsRes)
+        return vgs
 
     def _reloadpvs(self, pvName=None):
         cmd = list(PVS_CMD)
         pvNames = _normalizeargs(pvName)
         cmd.extend(pvNames)
         with self._oplock.acquireContext(LVM_OP_RELOAD):
-            rc, out, err = self.cmd(cmd)
-            if rc != 0:
-                log.warning("lvm pvs failed: %s %s %s", str(rc), str(out),
-                            str(err))
-                pvNames = pvNames if pvNames else self._pvs.keys()
-                for p in pvNames:
-                    if isinstance(self._pvs.get(p), Stub):
-                        self._pvs[p] = Unreadable(self._pvs[p].name, True)
-                return dict(self._pvs)
+            return self._updatepvs(pvNames, self.report(cmd))
 
-            updatedPVs = {}
-            for line in out:
-                fields = [field.strip() for field in line.split(SEPARATOR)]
-                pv = makePV(*fields)
-                self._pvs[pv.name] = pv
-                updatedPVs[pv.name] = pv
-            # If we updated all the PVs drop stale flag
-            if not pvName:
-                self._stalepv = False
-                # Remove stalePVs
-                stalePVs = [staleName for staleName in self._pvs.keys()
-                            if staleName not in updatedPVs.iterkeys()]
-                for staleName in stalePVs:
-                    log.warning("Removing stale PV: %s", staleName)
-                    self._pvs.pop((staleName), None)
+    def _updatepvs(self, pvNames, result):
+        rc, out, err = result
+        if rc != 0:
+            log.warning("lvm pvs failed: %s %s %s", str(rc), str(out),
+                        str(err))
+            for p in (pvNames if pvNames else self._pvs.keys()):
+                if isinstance(self._pvs.get(p), Stub):
+                    self._pvs[p] = Unreadable(self._pvs[p].name, True)
+            return dict(self._pvs)
+
+        updatedPVs = {}
+        for line in out:
+            fields = [field.strip() for field in line.split(SEPARATOR)]
+            pv = makePV(*fields)
+            self._pvs[pv.name] = pv
+            updatedPVs[pv.name] = pv
+        # If we updated all the PVs drop stale flag
+        if not pvNames:
+            self._stalepv = False
+            # Remove stalePVs
+            stalePVs = [staleName for staleName in self._pvs.keys()
+                        if staleName not in updatedPVs.iterkeys()]
+            for staleName in stalePVs:
+                log.warning("Removing stale PV: %s", staleName)
+                self._pvs.pop((staleName), None)
 
         return updatedPVs
 
@@ -370,48 +554,50 @@ class LVMCache(object):
         cmd.extend(vgNames)
 
         with self._oplock.acquireContext(LVM_OP_RELOAD):
-            rc, out, err = self.cmd(cmd, self._getVGDevs(vgNames))
+            return self._updatevgs(
+                vgNames, self.report(cmd, self._getVGDevs(vgNames)))
 
-            if rc != 0:
-                log.warning("lvm vgs failed: %s %s %s", str(rc), str(out),
-                            str(err))
-                vgNames = vgNames if vgNames else self._vgs.keys()
-                for v in vgNames:
-                    if isinstance(self._vgs.get(v), Stub):
-                        self._vgs[v] = Unreadable(self._vgs[v].name, True)
-
-            if not len(out):
-                return dict(self._vgs)
-
-            updatedVGs = {}
-            vgsFields = {}
-            for line in out:
-                fields = [field.strip() for field in line.split(SEPARATOR)]
-                uuid = fields[VG._fields.index("uuid")]
-                pvNameIdx = VG._fields.index("pv_name")
-                pv_name = fields[pvNameIdx]
-                if uuid not in vgsFields:
-                    fields[pvNameIdx] = [pv_name]  # Make a pv_names list
-                    vgsFields[uuid] = fields
-                else:
-                    vgsFields[uuid][pvNameIdx].append(pv_name)
-            for fields in vgsFields.itervalues():
-                vg = makeVG(*fields)
-                if int(vg.pv_count) != len(vg.pv_name):
-                    log.error("vg %s has pv_count %s but pv_names %s",
-                              vg.name, vg.pv_count, vg.pv_name)
-                self._vgs[vg.name] = vg
-                updatedVGs[vg.name] = vg
-            # If we updated all the VGs drop stale flag
-            if not vgName:
-                self._stalevg = False
-                # Remove stale VGs
-                staleVGs = [staleName for staleName in self._vgs.keys()
-                            if staleName not in updatedVGs.iterkeys()]
-                for staleName in staleVGs:
-                    removeVgMapping(staleName)
-                    log.warning("Removing stale VG: %s", staleName)
-                    self._vgs.pop((staleName), None)
+    def _updatevgs(self, vgNames, result):
+        rc, out, err = result
+        if rc != 0:
+            log.warning("lvm vgs failed: %s %s %s", str(rc), str(out),
+                        str(err))
+            for v in (vgNames if vgNames else self._vgs.keys()):
+                if isinstance(self._vgs.get(v), Stub):
+                    self._vgs[v] = Unreadable(self._vgs[v].name, True)
+
+        if not len(out):
+            return dict(self._vgs)
+
+        updatedVGs = {}
+        vgsFields = {}
+        for line in out:
+            fields = [field.strip() for field in line.split(SEPARATOR)]
+            uuid = fields[VG._fields.index("uuid")]
+            pvNameIdx = VG._fields.index("pv_name")
+            pv_name = fields[pvNameIdx]
+            if uuid not in vgsFields:
+                fields[pvNameIdx] = [pv_name]  # Make a pv_names list
+                vgsFields[uuid] = fields
+            else:
+                vgsFields[uuid][pvNameIdx].append(pv_name)
+        for fields in vgsFields.itervalues():
+            vg = makeVG(*fields)
+            if int(vg.pv_count) != len(vg.pv_name):
+                log.error("vg %s has pv_count %s but pv_names %s",
+                          vg.name, vg.pv_count, vg.pv_name)
+            self._vgs[vg.name] = vg
+            updatedVGs[vg.name] = vg
+        # If we updated all the VGs drop stale flag
+        if not vgNames:
+            self._stalevg = False
+            # Remove stale VGs
+            staleVGs = [staleName for staleName in self._vgs.keys()
+                        if staleName not in updatedVGs.iterkeys()]
+            for staleName in staleVGs:
+                removeVgMapping(staleName)
+                log.warning("Removing stale VG: %s", staleName)
+                self._vgs.pop((staleName), None)
 
         return updatedVGs
 
@@ -424,7 +610,7 @@ class LVMCache(object):
             cmd.append(vgName)
 
         with self._oplock.acquireContext(LVM_OP_RELOAD):
-            rc, out, err = self.cmd(cmd, self._getVGDevs((vgName, )))
+            rc, out, err = self.report(cmd, self._getVGDevs((vgName, )))
 
             if rc != 0:
                 log.warning("lvm lvs failed: %s %s %s", str(rc), str(out),
@@ -433,14 +619,20 @@ class LVMCache(object):
                 for l in lvNames:
                     if isinstance(self._lvs.get(l), Stub):
                         self._lvs[l] = Unreadable(self._lvs[l].name, True)
+                self._bumpLvGeneration(vgName)
                 return dict(self._lvs)
 
             updatedLVs = {}
+            # The stubs were counted when they were invalidated
+            changed = False
             for line in out:
                 fields = [field.strip() for field in line.split(SEPARATOR)]
                 lv = makeLV(*fields)
                 # For LV we are only interested in its first extent
                 if lv.seg_start_pe == "0":
+                    old = self._lvs.get((lv.vg_name, lv.name))
+                    if not isinstance(old, Stub) and old != lv:
+                        changed = True
                     self._lvs[(lv.vg_name, lv.name)] = lv
                     updatedLVs[(lv.vg_name, lv.name)] = lv
 
@@ -456,18 +648,22 @@ class LVMCache(object):
 
             for lvName in staleLVs:
                 log.warning("Removing stale lv: %s/%s", vgName, lvName)
-                self._lvs.pop((vgName, lvName), None)
+                if not isinstance(self._lvs.pop((vgName, lvName), None),
+                                  Stub):
+                    changed = True
+
+            if changed:
+                self._bumpLvGeneration(vgName)
 
             log.debug("lvs reloaded")
 
         return updatedLVs
 
     def _reloadAllLvs(self):
-        """
-        Used only during bootstrap.
-        """
-        cmd = list(LVS_CMD)
-        rc, out, err = self.cmd(cmd)
+        return self._updateAllLvs(self.report(list(LVS_CMD)))
+
+    def _updateAllLvs(self, result):
+        rc, out, err = result
         if rc == 0:
             updatedLVs = set()
             for line in out:
@@ -484,8 +680,19 @@ class LVMCache(object):
                     self._lvs.pop((vgName, lvName), None)
                     log.error("Removing stale lv: %s/%s", vgName, lvName)
             self._stalelv = False
+            self._lvEpoch += 1
         return dict(self._lvs)
 
+    def _bumpLvGeneration(self, vgName):
+        self._lvGenerations[vgName] = self._lvGenerations.get(vgName, 0) + 1
+
+    def lvGeneration(self, vgName):
+        """
+        Return the generation of the LVs of the VG in the cache, changing
+        when the LVs are invalidated, or found changed when reloaded.
+        """
+        return self._lvEpoch, self._lvGenerations.get(vgName, 0)
+
     def _invalidatepvs(self, pvNames):
         with self._oplock.acquireContext(LVM_OP_INVALIDATE):
             pvNames = _normalizeargs(pvNames)
@@ -510,6 +717,7 @@ class LVMCache(object):
 
     def _invalidatelvs(self, vgName, lvNames=None):
         with self._oplock.acquireContext(LVM_OP_INVALIDATE):
+            self._bumpLvGeneration(vgName)
             lvNames = _normalizeargs(lvNames)
             # Invalidate LVs in a specific VG
             if lvNames:
@@ -527,6 +735,50 @@ class LVMCache(object):
         with self._oplock.acquireContext(LVM_OP_INVALIDATE):
             self._stalelv = True
             self._lvs.clear()
+            self._lvEpoch += 1
+
+    def _devicesAdded(self):
+        """
+        Invalidate the filter and the lists of the PVs and the VGs, keeping
+        the entries already cached.
+        """
+        with self._oplock.acquireContext(LVM_OP_INVALIDATE):
+            self.invalidateFilter()
+            self._stalepv = True
+            self._stalevg = True
+
+    def deviceChanged(self, event):
+        """
+        Invalidate the entries affected by the udev event of a device mapper
+        device: the LV of a LV device, or the PV of a multipath device and
+        the VGs holding it. Devices of unknown VGs are ignored, unknown
+        multipath devices may be new PVs and invalidate the PVs and VGs
+        lists.
+        """
+        vgName = event.get("DM_VG_NAME")
+        lvName = event.get("DM_LV_NAME")
+        if vgName and lvName:
+            if vgName in self._vgs and not event.get("DM_LV_LAYER"):
+                log.debug("lv %s/%s changed (%s)", vgName, lvName,
+                          event.get("ACTION"))
+                self._invalidatelvs(vgName, lvName)
+            return
+
+        if event.get("DM_UUID", "").startswith("mpath-"):
+            pvName = os.path.join(PV_PREFIX, event.get("DM_NAME", ""))
+            if pvName not in self._pvs:
+                if event.get("ACTION") in ("add", "change"):
+                    log.debug("new device %s (%s)", pvName,
+                              event.get("ACTION"))
+                    self._devicesAdded()
+                return
+
+            log.debug("pv %s changed (%s)", pvName, event.get("ACTION"))
+            self._invalidatepvs(pvName)
+            vgNames = [vg.name for vg in self._vgs.values()
+                       if not isinstance(vg, Stub) and pvName in vg.pv_name]
+            if vgNames:
+                self._invalidatevgs(vgNames)
 
     def flush(self):
         self._invalidateAllPvs()
@@ -558,7 +810,7 @@ class LVMCache(object):
         # Get specific VG
         vg = self._vgs.get(vgName)
         if not vg or isinstance(vg, Stub):
-            vgs = self._reloadvgs(vgName)
+            vgs = self._vgReloads.reload(None, vgName)
             vg = vgs.get(vgName)
         return vg
 
@@ -574,8 +826,11 @@ class LVMCache(object):
 
     def getAllVgs(self):
         # Get everything we have
-        if self._stalevg:
-            vgs = self._reloadvgs()
+        if self._stalevg and self._stalepv and self._stalelv:
+            # Nothing is cached, e.g. after a flush
+            vgs = self._reloadAll()
+        elif self._stalevg:
+            vgs = self._vgReloads.reload(None)
         else:
             vgs = dict(self._vgs)
             stalevgs = [vg.name for vg in vgs.itervalues()
@@ -600,7 +855,7 @@ class LVMCache(object):
             lv = self._lvs.get((vgName, lvName))
             if not lv or isinstance(lv, Stub):
                 # while we here reload all the LVs in the VG
-                lvs = self._reloadlvs(vgName)
+                lvs = self._lvReloads.reload(vgName)
                 lv = lvs.get((vgName, lvName))
                 if not lv:
                     log.warning("lv: %s not found in lvs vg: %s response",
@@ -614,8 +869,9 @@ class LVMCache(object):
             # Will be better when the pvs dict will be part of the vg.
             # Fix me: should not be more stubs
             if self._stalelv or any(isinstance(lv, Stub)
-                                    for lv in self._lvs.values()):
-                lvs = self._reloadlvs(vgName)
+                                    for (v, l), lv in self._lvs.items()
+                                    if v == vgName):
+                lvs = self._lvReloads.reload(vgName)
             else:
                 lvs = dict(self._lvs)
             # lvs = self._reloadlvs()
@@ -635,6 +891,27 @@ class LVMCache(object):
 
 _lvminfo = LVMCache()
 
+_udevMonitor = None
+
+
+def startEventMonitor(source=None):
+    """
+    Keep the cache fresh using the udev events of the LV and PV devices,
+    source defaults to udevMonitor.UdevEventSource.
+    """
+    global _udevMonitor
+    if _udevMonitor is None:
+        _udevMonitor = udevMonitor.UdevMonitor(
+            _lvminfo.deviceChanged, source, resync=_lvminfo.invalidateCache)
+        _udevMonitor.start()
+
+
+def stopEventMonitor():
+    global _udevMonitor
+    if _udevMonitor is not None:
+        _udevMonitor.stop()
+        _udevMonitor = None
+
 
 def bootstrap(refreshlvs=()):
     """
@@ -644,6 +921,8 @@ def bootstrap(refreshlvs=()):
     deactivated, expect lvs matching refreshlvs, which are refreshed instead.
     """
     _lvminfo.bootstrap()
+    if config.getboolean('irs', 'lvm_udev_events'):
+        startEventMonitor()
 
     refreshlvs = set(refreshlvs)
 
@@ -684,6 +963,23 @@ def invalidateCache():
     _lvminfo.invalidateCache()
 
 
+def invalidateDevices(vgNames=()):
+    """
+    Invalidate the cache after rescanning the devices. When the cache is
+    kept fresh by the udev events only the filter, the lists of the PVs and
+    the VGs, and the VGs vgNames are invalidated, otherwise everything.
+    """
+    if _udevMonitor is None or not _udevMonitor.connected:
+        _lvminfo.invalidateCache()
+        return
+
+    _lvminfo._devicesAdded()
+    for vgName in vgNames:
+        # The VGs not cached are looked up anyway
+        if vgName in _lvminfo._vgs:
+            invalidateVG(vgName)
+
+
 def _fqpvname(pv):
     if pv and not pv.startswith(PV_PREFIX):
         pv = os.path.join(PV_PREFIX, pv)
@@ -1340,6 +1636,14 @@ def setrwLV(vg, lv, rw=True):
         raise se.CannotSetRWLogicalVolume(vg, lv, permission)
 
 
+def getLvGeneration(vgName):
+    """
+    Return the generation of the cached LVs of vgName. The LVs returned by
+    getLV(vgName) didn't change as long as the generation doesn't change.
+    """
+    return _lvminfo.lvGeneration(vgName)
+
+
 def lvsByTag(vgName, tag):
     return [lv for lv in getLV(vgName) if tag in lv.tags]
 
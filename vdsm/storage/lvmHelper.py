@@ -0,0 +1,199 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+"""
+A persistent privileged helper running the lvm reports of the LVM cache.
+
+The helper is started once through sudo and then serves the pvs, vgs and
+lvs reports over its standard input and output using the CrabRPC protocol,
+sparing a sudo process for every reload. The helper remembers the lvm
+configuration of the last report so it is sent again only when it changes,
+and a single request can carry several reports.
+"""
+
+import logging
+import os
+import signal
+import sys
+import threading
+
+if __name__ != "__main__":
+    # Not used by the helper process itself
+    from cpopen import CPopen
+else:
+    # We add the parent directory so that imports that import the storage
+    # package would work even though CWD is inside the storage package.
+    sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), "../"))
+    # Path for the vdsm module
+    sys.path.append(os.path.join(os.path.dirname(sys.argv[0]),
+                                 "../../lib"))
+
+from vdsm import constants
+from vdsm import utils
+import zombiereaper
+from remoteFileHandler import CrabRPCProxy, CrabRPCServer
+
+HELPER_PATH = os.path.join(constants.P_VDSM, "storage", "lvmHelper.py")
+
+# The helper is restarted when a request takes longer than this
+HELPER_TIMEOUT = 300
+
+REPORT_COMMANDS = frozenset(("pvs", "vgs", "lvs"))
+
+
+class Reporter(object):
+    """
+    The server side of the helper, running the reports as root.
+    """
+    def __init__(self, lvm=constants.EXT_LVM):
+        self._lvm = lvm
+        self._config = None
+
+    def report(self, reports):
+        """
+        Run the report commands given as a list of (cmd, config) tuples
+        and return the list of their (rc, out, err) results. A config of
+        None reuses the config of the previous report.
+        """
+        results = []
+        for cmd, config in reports:
+            if config is not None:
+                self._config = config
+            results.append(self._run(cmd))
+        return results
+
+    def _run(self, cmd):
+        if cmd[0] not in REPORT_COMMANDS:
+            raise ValueError("Not an lvm report command: %s" % cmd[0])
+
+        finalCmd = [self._lvm, cmd[0]]
+        if self._config is not None:
+            finalCmd += ["--config", self._config]
+        finalCmd += cmd[1:]
+        return utils.execCmd(finalCmd, sudo=False)
+
+
+class LVMHelper(object):
+    """
+    The client side of the helper. The helper process is started on the
+    first report and restarted after a failure.
+    """
+    log = logging.getLogger("Storage.LVMHelper")
+
+    def __init__(self, timeout=HELPER_TIMEOUT):
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._process = None
+        self._proxy = None
+        # The config last sent to the running helper
+        self._config = None
+
+    def report(self, reports):
+        """
+        Run the lvm report commands given as a list of (cmd, config)
+        tuples, cmd holding the command name and its arguments and config
+        being the value of its --config option. Return the list of the
+        (rc, out, err) results of the commands, as misc.execCmd does.
+        """
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+
+            request = []
+            config = self._config
+            for cmd, conf in reports:
+                if conf == config:
+                    conf = None
+                else:
+                    config = conf
+                request.append((list(cmd), conf))
+
+            try:
+                res = self._proxy.callCrabRPCFunction(self._timeout,
+                                                      "report", request)
+            except:
+                self._stop()
+                raise
+
+            self._config = config
+            return res
+
+    def close(self):
+        with self._lock:
+            if self._process is not None:
+                self._stop()
+
+    def _start(self):
+        if self._process is not None:
+            self._stop()
+
+        cmd = [constants.EXT_PYTHON, HELPER_PATH]
+        if os.geteuid() != 0:
+            cmd = [constants.EXT_SUDO, utils.SUDO_NON_INTERACTIVE_FLAG] + cmd
+
+        self.log.debug("Starting lvm helper: %s", cmd)
+        self._process = CPopen(cmd, close_fds=True,
+                               deathSignal=signal.SIGTERM)
+        self._proxy = CrabRPCProxy(os.dup(self._process.stdout.fileno()),
+                                   os.dup(self._process.stdin.fileno()))
+        self._config = None
+
+    def _stop(self):
+        process, proxy = self._process, self._proxy
+        self._process = self._proxy = None
+        self._config = None
+
+        # The helper exits when its input is closed, sudo relays the signal
+        # if it is still busy running a report.
+        proxy.close()
+        for f in (process.stdin, process.stdout, process.stderr):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        try:
+            os.kill(process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+        try:
+            zombiereaper.autoReapPID(process.pid)
+        except AttributeError:
+            if zombiereaper is not None:
+                raise
+
+
+def main():
+    # lvm and the helper itself may write to stdout, keep a private copy of
+    # it for the responses and send everything else to stderr.
+    myWrite = os.dup(1)
+    os.dup2(2, 1)
+
+    server = CrabRPCServer(0, myWrite)
+    server.registerFunction(Reporter().report, "report")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BaseException:
+        logging.root.error("Error in lvm helper", exc_info=True)
+        sys.exit(1)
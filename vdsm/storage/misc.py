@@ -39,11 +39,12 @@ import os
 import Queue
 import random
 import re
-import signal
 import select
 import string
 import struct
+import sys
 import threading
+import time
 import types
 import weakref
 import fcntl
@@ -63,6 +64,14 @@ STR_UUID_SIZE = 36
 UUID_HYPHENS = [8, 13, 18, 23]
 MEGA = 1 << 20
 UNLIMITED_THREADS = -1
+ZERO_DEVICE = "/dev/zero"
+# Size of the reads and writes of readblock, readspeed and ddWatchCopy
+IO_CHUNK_SIZE = MEGA
+# The threads doing the I/O of readblock and readspeed for the files of a
+# directory, e.g. the metadata of a storage domain
+MAX_IO_THREADS = 4
+# How often the stop condition of a copy is checked, in seconds
+STOP_POLL_INTERVAL = 1
 
 log = logging.getLogger('Storage.Misc')
 
@@ -214,38 +223,21 @@ def readfile(name, buffersize=None):
     return out
 
 
-_readspeed_regex = re.compile(
-    "(?P<bytes>\d+) bytes? \([\de\-.]+ [kMGT]*B\) copied, "
-    "(?P<seconds>[\de\-.]+) s, "
-    "[\de\-.]+ [kMGT]*B/s"
-)
-
-
 def readspeed(path, buffersize=None):
     """
     Measures the amount of bytes transferred and the time elapsed
     reading the content of the file/device
     """
-    rc, _, err = _readfile(path, buffersize)
-
-    if rc != 0:
-        log.error("Unable to read file '%s'", path)
-        raise se.MiscFileReadException(path)
-
     try:
-        # The statistics are located in the last line:
-        m = _readspeed_regex.match(err[-1])
-    except IndexError:
-        log.error("Unable to find dd statistics to parse")
-        raise se.MiscFileReadException(path)
-
-    if m is None:
-        log.error("Unable to parse dd output: '%s'", err[-1])
+        nbytes, seconds = _getIOPool(path).submit(
+            _timedRead, path, buffersize).wait()
+    except (OSError, IOError, ValueError):
+        log.error("Unable to read file '%s'", path, exc_info=True)
         raise se.MiscFileReadException(path)
 
     return {
-        'bytes': int(m.group('bytes')),
-        'seconds': float(m.group('seconds')),
+        'bytes': nbytes,
+        'seconds': seconds,
     }
 
 
@@ -258,49 +250,55 @@ def readblock(name, offset, size):
     if (size % 512) or (offset % 512):
         raise se.MiscBlockReadException(name, offset, size)
 
-    left = size
-    ret = ""
-    baseoffset = offset
-
-    while left > 0:
-        (iounit, count, iooffset) = _alignData(left, offset)
-
-        cmd = [constants.EXT_DD]
-        if fileUtils.pathRequiresFlagForDirectIO(name):
-            cmd.append("iflag=%s" % DIRECTFLAG)
-        cmd.extend(["skip=%d" % iooffset, "bs=%d" % iounit, "if=%s" % name,
-                    "count=%s" % count])
-
-        (rc, out, err) = execCmd(cmd, raw=True)
-        if rc:
-            raise se.MiscBlockReadException(name, offset, size)
-        if not validateDDBytes(err.splitlines(), iounit * count):
-            raise se.MiscBlockReadIncomplete(name, offset, size)
-
-        ret += out
-        left = left % iounit
-        offset = baseoffset + size - left
-    return ret.splitlines()
-
-
-def validateDDBytes(ddstderr, size):
-    log.debug("err: %s, size: %s" % (ddstderr, size))
     try:
-        size = int(size)
-    except (ValueError, ):
-        raise se.InvalidParameterException("size", str(size))
+        data = _getIOPool(name).submit(_readData, name, offset, size).wait()
+    except (OSError, IOError):
+        log.error("Unable to read %s", name, exc_info=True)
+        raise se.MiscBlockReadException(name, offset, size)
 
-    if len(ddstderr) != 3:
-        raise se.InvalidParameterException("len(ddstderr)", ddstderr)
+    if len(data) != size:
+        raise se.MiscBlockReadIncomplete(name, offset, size)
 
-    try:
-        xferred = int(ddstderr[2].split()[0])
-    except (ValueError, ):
-        raise se.InvalidParameterException("ddstderr", ddstderr[2])
+    return data.splitlines()
 
-    if xferred != size:
-        return False
-    return True
+
+def _readData(path, offset, size):
+    """
+    Read size bytes of path at offset using direct I/O, returning less
+    data only at the end of the file.
+    """
+    chunks = []
+    with fileUtils.open_ex(path, "dr") as f:
+        end = offset + size
+        while offset < end:
+            n = min(IO_CHUNK_SIZE, end - offset)
+            chunk = f.pread(offset, n)
+            chunks.append(chunk)
+            offset += len(chunk)
+            if len(chunk) < n:
+                break
+    return "".join(chunks)
+
+
+def _timedRead(path, buffersize=None):
+    """
+    Read buffersize bytes of path, or all of it if buffersize is None,
+    using direct I/O. Return the number of bytes read and the time it took.
+    """
+    nbytes = 0
+    with fileUtils.open_ex(path, "dr") as f:
+        # monotonic_time is too coarse for the latency of a single read
+        start = time.time()
+        if buffersize:
+            nbytes = len(f.pread(0, buffersize))
+        else:
+            while True:
+                n = len(f.pread(nbytes, IO_CHUNK_SIZE))
+                nbytes += n
+                if n < IO_CHUNK_SIZE:
+                    break
+        seconds = max(0.0, time.time() - start)
+    return nbytes, seconds
 
 
 def _alignData(length, offset):
@@ -333,7 +331,15 @@ def randomStr(strLen):
 
 def ddWatchCopy(src, dst, stop, size, offset=0, recoveryCallback=None):
     """
-    Copy src to dst using dd command with stop abilities
+    Copy size bytes of src at offset to the same offset of dst with stop
+    abilities. dst is created if needed and is never truncated.
+
+    The copy runs on its own thread, since it may take a long time, stop is
+    checked while waiting for it and raises utils.ActionStopped when it
+    returns True. recoveryCallback is not used since no process is left
+    behind by the copy.
+
+    Return the (rc, out, err) of the copy, as the dd based copy did.
     """
     try:
         size = int(size)
@@ -344,53 +350,251 @@ def ddWatchCopy(src, dst, stop, size, offset=0, recoveryCallback=None):
     except ValueError:
         raise se.InvalidParameterException("offset", "offset = %s" % (offset,))
 
-    left = size
-    baseoffset = offset
+    if stop is not None and stop():
+        raise utils.ActionStopped()
 
-    while left > 0:
-        (iounit, count, iooffset) = _alignData(left, offset)
-        oflag = None
-        conv = "notrunc"
-        if (iounit % 512) == 0:
-            if fileUtils.pathRequiresFlagForDirectIO(dst):
-                oflag = DIRECTFLAG
-        else:
-            conv += ",%s" % DATASYNCFLAG
+    cancelled = threading.Event()
+    req = _IORequest(_copyData, (src, dst, offset, size, cancelled))
+    t = threading.Thread(target=req.run, name="io-copy")
+    t.daemon = True
+    t.start()
+    try:
+        copied = req.wait(stop)
+    except utils.ActionStopped:
+        # The copy stops after its current chunk
+        cancelled.set()
+        raise
+    except (OSError, IOError):
+        log.error("Unable to copy %s to %s", src, dst, exc_info=True)
+        raise se.MiscBlockWriteException(dst, offset, size)
+
+    if copied != size:
+        raise se.MiscBlockWriteIncomplete(dst, offset, size)
+
+    return (0, [], [])
 
-        cmd = [constants.EXT_DD, "if=%s" % src, "of=%s" % dst,
-               "bs=%d" % iounit, "seek=%s" % iooffset, "skip=%s" % iooffset,
-               "conv=%s" % conv, 'count=%s' % count]
 
-        if oflag:
-            cmd.append("oflag=%s" % oflag)
+def ddCopy(src, dst, size):
+    """
+    Copy src to dst
+    """
+    return ddWatchCopy(src, dst, None, size=size)
+
 
-        if not stop:
-            (rc, out, err) = execCmd(cmd, sudo=False, nice=utils.NICENESS.HIGH,
-                                     ioclass=utils.IOCLASS.IDLE,
-                                     deathSignal=signal.SIGKILL)
+def _copyData(src, dst, offset, size, cancelled):
+    """
+    Copy size bytes of src at offset to dst, writing the blocks aligned to
+    512 bytes with direct I/O and syncing the others. Return the number of
+    bytes copied, which is less than size if src is too short or if
+    cancelled was set.
+    """
+    if src == ZERO_DEVICE:
+        srcFile = None
+    else:
+        srcFile = open(src, "rb", 0)
+    try:
+        # Like dd, create dst if needed but never truncate it
+        os.close(os.open(dst, os.O_WRONLY | os.O_CREAT, 0o666))
+        copied = 0
+        left = size
+        baseoffset = offset
+        while left > 0:
+            (iounit, count, iooffset) = _alignData(left, offset)
+            length = iounit * count
+            n = _copySegment(srcFile, dst, offset, length,
+                             iounit % 512 == 0, cancelled)
+            copied += n
+            if n < length:
+                break
+            left = left % iounit
+            offset = baseoffset + size - left
+        return copied
+    finally:
+        if srcFile is not None:
+            srcFile.close()
+
+
+def _copySegment(srcFile, dst, offset, length, aligned, cancelled):
+    if aligned:
+        dstFile = fileUtils.open_ex(dst, "r+d")
+    else:
+        dstFile = open(dst, "r+b", 0)
+
+    with contextlib.closing(dstFile):
+        if srcFile is not None:
+            srcFile.seek(offset)
         else:
-            (rc, out, err) = watchCmd(cmd, stop=stop,
-                                      recoveryCallback=recoveryCallback,
-                                      nice=utils.NICENESS.HIGH,
-                                      ioclass=utils.IOCLASS.IDLE)
+            zeros = "\0" * min(length, IO_CHUNK_SIZE)
+
+        pos = offset
+        end = offset + length
+        while pos < end and not cancelled.isSet():
+            n = min(IO_CHUNK_SIZE, end - pos)
+            if srcFile is None:
+                data = zeros[:n]
+            else:
+                data = _readFull(srcFile, n)
+                if len(data) < n:
+                    break
+            if aligned:
+                dstFile.pwrite(pos, data)
+            else:
+                dstFile.seek(pos)
+                dstFile.write(data)
+            pos += n
 
-        if rc:
-            raise se.MiscBlockWriteException(dst, offset, size)
+        if not aligned:
+            os.fdatasync(dstFile.fileno())
 
-        if not validateDDBytes(err, iounit * count):
-            raise se.MiscBlockWriteIncomplete(dst, offset, size)
+    return pos - offset
 
-        left = left % iounit
-        offset = baseoffset + size - left
 
-    return (rc, out, err)
+def _readFull(f, size):
+    chunks = []
+    while size > 0:
+        chunk = f.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
 
 
-def ddCopy(src, dst, size):
+class _IORequest(object):
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+        self._done = threading.Event()
+        self._result = None
+        self._excInfo = None
+
+    def run(self):
+        try:
+            self._result = self._func(*self._args)
+        except Exception:
+            self._excInfo = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def wait(self, stop=None):
+        """
+        Wait for the request and return its result or raise its error. If
+        stop returns True while waiting raise utils.ActionStopped, leaving
+        the request running.
+        """
+        while not self._done.isSet():
+            self._done.wait(None if stop is None else STOP_POLL_INTERVAL)
+            if not self._done.isSet() and stop():
+                raise utils.ActionStopped()
+
+        if self._excInfo is not None:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+        return self._result
+
+
+class IOThreadPool(object):
     """
-    Copy src to dst using dd command
+    A bounded pool of threads running blocking I/O calls.
+
+    The threads are started on demand, up to maxThreads. A thread blocked
+    on unresponsive storage keeps its slot until the I/O returns, so the
+    number of threads stuck in the kernel is bounded, and once all the
+    threads are busy the requests wait in the queue.
     """
-    return ddWatchCopy(src, dst, None, size=size)
+    def __init__(self, maxThreads):
+        self._maxThreads = maxThreads
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._threads = 0
+        self._idle = 0
+        # Requests queued while all the threads were busy
+        self._backlog = 0
+        self._closed = False
+
+    def submit(self, func, *args):
+        """
+        Run func(*args) on one of the threads and return the request,
+        whose wait() returns the result of the call.
+        """
+        req = _IORequest(func, args)
+        with self._lock:
+            if self._closed:
+                # Submitted while the pool was dropped
+                t = threading.Thread(target=req.run, name="io-closed")
+                t.daemon = True
+                t.start()
+                return req
+            if self._idle > 0:
+                self._idle -= 1
+            elif self._threads < self._maxThreads:
+                self._threads += 1
+                t = threading.Thread(target=self._run,
+                                     name="io-%d" % self._threads)
+                t.daemon = True
+                t.start()
+            else:
+                self._backlog += 1
+        self._queue.put(req)
+        return req
+
+    def closeIfIdle(self):
+        """
+        Stop the threads if none of them is busy, and return True. A pool
+        having threads blocked on the storage is left as is, so dropping
+        and creating its pool again does not add more blocked threads.
+        """
+        with self._lock:
+            if self._closed:
+                return True
+            if self._idle < self._threads or self._backlog > 0:
+                return False
+            self._closed = True
+            for i in range(self._threads):
+                self._queue.put(None)
+            return True
+
+    def _run(self):
+        while True:
+            req = self._queue.get()
+            if req is None:
+                break
+            req.run()
+            with self._lock:
+                if self._backlog > 0:
+                    self._backlog -= 1
+                else:
+                    self._idle += 1
+
+
+_ioPools = {}
+_ioPoolsLock = threading.Lock()
+
+
+def _getIOPool(path):
+    """
+    Return the IOThreadPool running the I/O of path. The files of every
+    directory, e.g. the metadata of every storage domain, have their own
+    pool, so the I/O stuck on a domain does not delay the other domains.
+    """
+    key = os.path.dirname(path)
+    with _ioPoolsLock:
+        pool = _ioPools.get(key)
+        if pool is None:
+            pool = _ioPools[key] = IOThreadPool(MAX_IO_THREADS)
+        return pool
+
+
+def dropIOPools(sdUUID=None):
+    """
+    Drop the idle pools of the directories of the domain sdUUID, or of all
+    the domains if sdUUID is None, when the domain leaves the cache.
+    """
+    with _ioPoolsLock:
+        for key, pool in _ioPools.items():
+            if sdUUID is not None and sdUUID not in key.split(os.sep):
+                continue
+            if pool.closeIfIdle():
+                del _ioPools[key]
 
 
 def parseBool(var):
@@ -29,6 +29,9 @@ from remoteFileHandler import RemoteFileHandlerPool
 # GRACE_PERIOD = config.getint("irs", "process_pool_grace_period")
 DEFAULT_TIMEOUT = config.getint("irs", "process_pool_timeout")
 HELPERS_PER_DOMAIN = config.getint("irs", "process_pool_max_slots_per_domain")
+MIN_HELPERS_PER_DOMAIN = config.getint("irs",
+                                       "process_pool_min_slots_per_domain")
+THREADS_PER_HELPER = config.getint("irs", "process_pool_threads_per_slot")
 
 _poolsLock = threading.Lock()
 _pools = {}
@@ -41,7 +44,9 @@ def getProcessPool(clientName):
         with _poolsLock:
             if not clientName in _pools:
                 _pools[clientName] = OopWrapper(
-                    RemoteFileHandlerPool(HELPERS_PER_DOMAIN))
+                    RemoteFileHandlerPool(HELPERS_PER_DOMAIN,
+                                          THREADS_PER_HELPER,
+                                          minHandlers=MIN_HELPERS_PER_DOMAIN))
 
             return _pools[clientName]
 
@@ -50,6 +55,18 @@ def getGlobalProcPool():
     return getProcessPool("Global")
 
 
+def getPoolsStats():
+    """
+    Return a dict mapping the client names to the statistics of their
+    process pools.
+    """
+    with _poolsLock:
+        pools = _pools.items()
+
+    return dict((clientName, wrapper._procPool.getStats())
+                for clientName, wrapper in pools)
+
+
 class _ModuleWrapper(types.ModuleType):
     def __init__(self, modName, procPool, timeout, subModNames=()):
         self._modName = modName
@@ -19,17 +19,19 @@
 #
 
 from struct import unpack, pack, calcsize
-from threading import Lock
+from threading import Condition, Lock, Thread
 from time import time, sleep
+from itertools import count
+import Queue
+import cPickle as pickle
 import errno
 import glob
+import io
 import logging
 import os
-import pickle
 import signal
 import sys
 import select
-from contextlib import contextmanager
 
 if __name__ != "__main__":
     # The following modules are not used by the newly spawned child porcess.
@@ -54,19 +56,79 @@ from vdsm import utils
 LENGTH_STRUCT_FMT = "Q"
 LENGTH_STRUCT_LENGTH = calcsize(LENGTH_STRUCT_FMT)
 
+# A response that started to arrive must be read whole within this time
+RESPONSE_TIMEOUT = 60
+
+# The protocols of the message bodies. The proxy starts talking the pickle
+# protocol and switches to the highest protocol the server knows.
+PROTOCOL_PICKLE = 1
+PROTOCOL_BINARY = 2
+PROTOCOLS = (PROTOCOL_PICKLE, PROTOCOL_BINARY)
+NEGOTIATE = "_negotiateProtocol"
+
+# The binary messages start with the request id and the payload type
+BINARY_HEADER_FMT = "!QB"
+BINARY_HEADER_LENGTH = calcsize(BINARY_HEADER_FMT)
+PAYLOAD_PICKLE = 0
+PAYLOAD_ERROR = 1
+PAYLOAD_STRING = 2
+PAYLOAD_LINES = 3
+
+# Pool handlers above the minimum are stopped after being idle that long
+HANDLER_IDLE_TIMEOUT = 60
+
+# Larger receive buffers are not kept between the responses
+MAX_BUFFER_SIZE = 1024 * 1024
+
+try:
+    memoryview
+except NameError:
+    # Python 2.6, the data received is copied into the receive buffer
+    memoryview = None
+
+
+def _isLines(value):
+    """
+    Return True if value is a list of lines, as returned by readlines, that
+    can be sent joined.
+    """
+    if not isinstance(value, list) or not value:
+        return False
+
+    last = len(value) - 1
+    for i, line in enumerate(value):
+        if not isinstance(line, str) or not line:
+            return False
+        newline = line.find("\n")
+        if newline != len(line) - 1 and (newline != -1 or i != last):
+            return False
+
+    return True
+
 
 class Timeout(RuntimeError):
     pass
 
 
 class CrabRPCServer(object):
+    """
+    Serve the calls of a CrabRPCProxy. Requests are read by the serving
+    thread and run by a pool of worker threads, so a call blocked on a
+    file does not delay the others. Responses carry the id of their request
+    and may be sent in any order.
+    """
     log = logging.getLogger("Storage.CrabRPCServer")
 
-    def __init__(self, myRead, myWrite):
+    def __init__(self, myRead, myWrite, threads=1):
         self.rfile = os.fdopen(myRead, "r")
         self.wfile = os.fdopen(myWrite, "wa")
         self.registeredFunctions = {}
         self.registeredModules = {}
+        self._threads = threads
+        self._requests = Queue.Queue()
+        self._writeLock = Lock()
+        self._protocol = PROTOCOL_PICKLE
+        self.protocols = PROTOCOLS
 
     def registerFunction(self, func, name=None):
         if name is None:
@@ -81,6 +143,11 @@ class CrabRPCServer(object):
         self.registeredModules[name] = mod
 
     def serve_forever(self):
+        for i in xrange(self._threads):
+            worker = Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+
         while True:
             try:
                 self.serve_once()
@@ -91,21 +158,85 @@ class CrabRPCServer(object):
     def serve_once(self):
         rawLength = self.rfile.read(LENGTH_STRUCT_LENGTH)
         length = unpack(LENGTH_STRUCT_FMT, rawLength)[0]
-        pickledCall = self.rfile.read(length)
-        if len(pickledCall) < length:
+        body = self.rfile.read(length)
+        if len(body) < length:
             raise Exception("Pipe broke")
 
-        name, args, kwargs = pickle.loads(pickledCall)
-        err = res = None
-        try:
-            res = self.callRegisteredFunction(name, args, kwargs)
-        except Exception as ex:
-            err = ex
+        if self._protocol == PROTOCOL_PICKLE:
+            reqId, name, args, kwargs = pickle.loads(body)
+        else:
+            reqId = unpack(BINARY_HEADER_FMT, body[:BINARY_HEADER_LENGTH])[0]
+            name, args, kwargs = pickle.loads(body[BINARY_HEADER_LENGTH:])
+
+        if name == NEGOTIATE:
+            # Answered before reading the next request, which is sent using
+            # the new protocol
+            self._negotiate(reqId, *args)
+        else:
+            self._requests.put((reqId, name, args, kwargs))
+
+    def _negotiate(self, reqId, protocols):
+        common = set(protocols) & set(self.protocols)
+        if not common:
+            self._sendResponse(reqId, None,
+                               ValueError("No common protocol in %s" %
+                                          (protocols,)))
+            return
+
+        protocol = max(common)
+        self._sendResponse(reqId, protocol, None)
+        self._protocol = protocol
+
+    def _work(self):
+        while True:
+            reqId, name, args, kwargs = self._requests.get()
+            err = res = None
+            try:
+                res = self.callRegisteredFunction(name, args, kwargs)
+            except Exception as ex:
+                err = ex
 
-        resp = pickle.dumps((res, err))
-        self.wfile.write(pack(LENGTH_STRUCT_FMT, len(resp)))
-        self.wfile.write(resp)
-        self.wfile.flush()
+            try:
+                self._sendResponse(reqId, res, err)
+            except Exception:
+                self.log.warn("Could not send response", exc_info=True)
+                return
+
+    def _sendResponse(self, reqId, res, err):
+        if self._protocol == PROTOCOL_PICKLE:
+            try:
+                payload = pickle.dumps((reqId, res, err))
+            except Exception as ex:
+                payload = pickle.dumps((reqId, None, ex))
+            header = ""
+        else:
+            payloadType, payload = self._encode(res, err)
+            header = pack(BINARY_HEADER_FMT, reqId, payloadType)
+
+        with self._writeLock:
+            self.wfile.write(pack(LENGTH_STRUCT_FMT,
+                                  len(header) + len(payload)))
+            self.wfile.write(header)
+            self.wfile.write(payload)
+            self.wfile.flush()
+
+    def _encode(self, res, err):
+        """
+        Return the payload type and the payload of a binary response. The
+        strings and the lists of lines are sent as they are.
+        """
+        if err is None:
+            if isinstance(res, str):
+                return PAYLOAD_STRING, res
+            if _isLines(res):
+                return PAYLOAD_LINES, "".join(res)
+            try:
+                return PAYLOAD_PICKLE, pickle.dumps(res,
+                                                    pickle.HIGHEST_PROTOCOL)
+            except Exception as ex:
+                err = ex
+
+        return PAYLOAD_ERROR, pickle.dumps(err, pickle.HIGHEST_PROTOCOL)
 
     def callRegisteredFunction(self, name, args, kwargs):
         if "." not in name:
@@ -121,6 +252,14 @@ class CrabRPCServer(object):
 
 
 class CrabRPCProxy(object):
+    """
+    Call the functions of a CrabRPCServer. Many threads may have calls in
+    flight at the same time, the thread waiting for a response reads the
+    responses of all the others while it is waiting.
+
+    The protocol is negotiated on the first call, falling back to the
+    pickle protocol with the servers not knowing about protocols.
+    """
     log = logging.getLogger("Storage.CrabRPCProxy")
 
     def __init__(self, myRead, myWrite):
@@ -128,23 +267,58 @@ class CrabRPCProxy(object):
         self._myRead = myRead
         misc.setNonBlocking(self._myWrite)
         misc.setNonBlocking(self._myRead)
-        self._poller = select.poll()
+        self._reader = io.FileIO(self._myRead, "r", closefd=False)
+        self._buffer = bytearray()
+        self._protocol = None
+        self._negotiateLock = Lock()
+        self._sendLock = Lock()
+        self._cond = Condition(Lock())
+        self._ids = count()
+        self._reading = False
+        self._broken = False
+        # Calls waiting for their response
+        self._waiting = set()
+        self._responses = {}
+        # Calls whose caller gave up waiting for the response
+        self._abandoned = set()
+
+    @property
+    def broken(self):
+        """
+        True if the connection got out of sync, no call can complete.
+        """
+        return self._broken
+
+    @property
+    def abandoned(self):
+        """
+        The number of calls timed out and still running in the server.
+        """
+        return len(self._abandoned)
 
-    @contextmanager
     def _poll(self, fd, events, timeout):
-        self._poller.register(fd, events)
-        try:
-            res = misc.NoIntrPoll(self._poller.poll, timeout)
-            for fd, event in res:
-                if event & (select.POLLERR | select.POLLHUP):
-                    raise Timeout()
-        finally:
-            self._poller.unregister(fd)
+        poller = select.poll()
+        poller.register(fd, events)
+        res = misc.NoIntrPoll(lambda t: poller.poll(t * 1000), timeout)
+        for fd, event in res:
+            if event & select.POLLERR or \
+                    event & (select.POLLHUP | events) == select.POLLHUP:
+                raise Timeout()
+        return bool(res)
 
     def _recvAll(self, length, timeout):
+        """
+        Receive length bytes into the receive buffer and return it. The
+        buffer is reused by the next receive.
+        """
+        if len(self._buffer) < length or len(self._buffer) > MAX_BUFFER_SIZE:
+            self._buffer = bytearray(length)
+        buf = self._buffer
+        view = memoryview(buf) if memoryview is not None else None
+
         startTime = time()
-        rawResponse = ""
-        while len(rawResponse) < length:
+        pos = 0
+        while pos < length:
             timeLeft = timeout - (time() - startTime)
             if timeLeft <= 0:
                 raise Timeout()
@@ -154,51 +328,187 @@ class CrabRPCProxy(object):
                 raise Timeout()
 
             try:
-                rawResponse += os.read(self._myRead, length - len(rawResponse))
-            except OSError as e:
+                if view is not None:
+                    n = self._reader.readinto(view[pos:length])
+                else:
+                    data = os.read(self._myRead, length - pos)
+                    n = len(data)
+                    buf[pos:pos + n] = data
+            except (IOError, OSError) as e:
                 if e.errno not in (errno.EAGAIN, errno.EINTR):
                     raise
+            else:
+                if n is None:
+                    continue
+                if n == 0:
+                    raise Timeout()
+                pos += n
 
-        return rawResponse
+        return buf
 
     def _sendAll(self, data, timeout):
         startTime = time()
         l = 0
-        while l < len(data):
-            timeLeft = timeout - (time() - startTime)
-            if timeLeft <= 0:
-                raise Timeout()
+        try:
+            while l < len(data):
+                timeLeft = timeout - (time() - startTime)
+                if timeLeft <= 0:
+                    raise Timeout()
 
-            if not self._poll(self._myWrite, select.POLLOUT,
-                              timeLeft):
-                raise Timeout()
+                if not self._poll(self._myWrite, select.POLLOUT,
+                                  timeLeft):
+                    raise Timeout()
 
-            l += os.write(self._myWrite, data[l:])
+                l += os.write(self._myWrite, data[l:])
+        except:
+            # A partly sent request leaves the stream out of sync
+            if l > 0:
+                self._setBroken()
+            raise
+
+    def _setBroken(self):
+        with self._cond:
+            self._broken = True
+            self._cond.notifyAll()
 
     def callCrabRPCFunction(self, timeout, name, *args, **kwargs):
-        request = pickle.dumps((name, args, kwargs))
-        self._sendAll(pack(LENGTH_STRUCT_FMT, len(request)), timeout)
-        self._sendAll(request, timeout)
+        deadline = time() + timeout
+        if self._protocol is None:
+            with self._negotiateLock:
+                if self._protocol is None:
+                    self._negotiate(deadline)
 
-        try:
-            rawLength = self._recvAll(LENGTH_STRUCT_LENGTH, timeout)
+        return self._call(deadline, self._protocol, name, args, kwargs)
 
-            length = unpack(LENGTH_STRUCT_FMT, rawLength)[0]
-            rawResponse = self._recvAll(length, timeout)
+    def _negotiate(self, deadline):
+        try:
+            protocol = self._call(deadline, PROTOCOL_PICKLE, NEGOTIATE,
+                                  (PROTOCOLS,), {})
         except Timeout:
+            # The server may have switched protocols already
+            self._setBroken()
             raise
+        except Exception:
+            self.log.debug("Protocol negotiation failed, using the pickle "
+                           "protocol", exc_info=True)
+            protocol = PROTOCOL_PICKLE
+
+        self._protocol = protocol
+
+    def _call(self, deadline, protocol, name, args, kwargs):
+        with self._cond:
+            if self._broken:
+                raise Timeout()
+            reqId = next(self._ids)
+            self._waiting.add(reqId)
+
+        sent = False
+        try:
+            if protocol == PROTOCOL_PICKLE:
+                request = pickle.dumps((reqId, name, args, kwargs))
+            else:
+                request = (pack(BINARY_HEADER_FMT, reqId, PAYLOAD_PICKLE) +
+                           pickle.dumps((name, args, kwargs),
+                                        pickle.HIGHEST_PROTOCOL))
+            with self._sendLock:
+                self._sendAll(pack(LENGTH_STRUCT_FMT, len(request)) +
+                              request, deadline - time())
+            sent = True
+
+            res, err = self._waitResponse(reqId, deadline)
+        except:
+            with self._cond:
+                self._waiting.discard(reqId)
+                if self._responses.pop(reqId, None) is None and sent:
+                    self._abandoned.add(reqId)
+            raise
+
+        if err is not None:
+            raise err
+
+        return res
+
+    def _waitResponse(self, reqId, deadline):
+        while True:
+            with self._cond:
+                while True:
+                    if reqId in self._responses:
+                        self._waiting.discard(reqId)
+                        return self._responses.pop(reqId)
+
+                    timeLeft = deadline - time()
+                    if self._broken or timeLeft <= 0:
+                        raise Timeout()
+
+                    if not self._reading:
+                        self._reading = True
+                        break
+
+                    self._cond.wait(timeLeft)
+
+            try:
+                self._recvResponse(timeLeft)
+            finally:
+                with self._cond:
+                    self._reading = False
+                    self._cond.notifyAll()
+
+    def _recvResponse(self, timeout):
+        """
+        Read the next response if one arrives before timeout. Once a
+        response started to arrive it is read whole, not to leave the stream
+        out of sync.
+        """
+        try:
+            if not self._poll(self._myRead, select.POLLIN | select.POLLPRI,
+                              timeout):
+                return
+
+            rawLength = self._recvAll(LENGTH_STRUCT_LENGTH, RESPONSE_TIMEOUT)
+            length = unpack(LENGTH_STRUCT_FMT,
+                            str(rawLength[:LENGTH_STRUCT_LENGTH]))[0]
+            respId, res, err = self._decode(
+                self._recvAll(length, RESPONSE_TIMEOUT), length)
         except:
             # If for some reason the connection drops\gets out of sync we treat
             # it as a timeout so we only have one error path
             self.log.error("Problem with handler, treating as timeout",
                            exc_info=True)
+            self._setBroken()
             raise Timeout()
 
-        res, err = pickle.loads(rawResponse)
-        if err is not None:
-            raise err
+        with self._cond:
+            if respId in self._waiting:
+                self._responses[respId] = (res, err)
+            else:
+                # Late response of a call that timed out
+                self._abandoned.discard(respId)
+
+    def _decode(self, buf, length):
+        """
+        Return the (id, result, error) of the response in the first length
+        bytes of buf.
+        """
+        if self._protocol in (None, PROTOCOL_PICKLE):
+            return pickle.loads(str(buffer(buf, 0, length)))
+
+        respId, payloadType = unpack(BINARY_HEADER_FMT,
+                                     str(buf[:BINARY_HEADER_LENGTH]))
+        payload = str(buffer(buf, BINARY_HEADER_LENGTH,
+                             length - BINARY_HEADER_LENGTH))
+        res = err = None
+        if payloadType == PAYLOAD_STRING:
+            res = payload
+        elif payloadType == PAYLOAD_LINES:
+            res = io.BytesIO(payload).readlines()
+        elif payloadType == PAYLOAD_PICKLE:
+            res = pickle.loads(payload)
+        elif payloadType == PAYLOAD_ERROR:
+            err = pickle.loads(payload)
+        else:
+            raise ValueError("Unknown payload type %s" % payloadType)
 
-        return res
+        return respId, res, err
 
     def close(self):
         if not os:
@@ -219,7 +529,7 @@ class CrabRPCProxy(object):
 class PoolHandler(object):
     log = logging.getLogger("RepoFileHelper.PoolHandler")
 
-    def __init__(self):
+    def __init__(self, threads=1):
         myRead, hisWrite = os.pipe()
         hisRead, myWrite = os.pipe()
 
@@ -231,7 +541,7 @@ class PoolHandler(object):
             env['PYTHONPATH'] = ":".join(map(os.path.abspath,
                                              env['PYTHONPATH'].split(":")))
             self.process = CPopen([constants.EXT_PYTHON, __file__,
-                                  str(hisRead), str(hisWrite)],
+                                  str(hisRead), str(hisWrite), str(threads)],
                                   close_fds=False, env=env)
 
             self.proxy = CrabRPCProxy(myRead, myWrite)
@@ -270,12 +580,47 @@ class PoolHandler(object):
 
 
 class RemoteFileHandlerPool(object):
+    """
+    A pool of helper processes, each running up to threadsPerHandler calls
+    at the same time. Calls wait up to their timeout for a free slot, at
+    most maxQueued of them; a helper is replaced only when its connection
+    broke or when all of its threads are stuck in calls that timed out.
+
+    The pool keeps minHandlers helpers running and starts another helper in
+    the background once the running ones have no free thread left, so the
+    calls rarely wait for a helper to start. The helpers above minHandlers
+    are stopped after being idle for idleTimeout seconds.
+    """
     log = logging.getLogger("Storage.RemoteFileHandler")
 
-    def __init__(self, numOfHandlers):
+    def __init__(self, numOfHandlers, threadsPerHandler=1, maxQueued=None,
+                 minHandlers=0, idleTimeout=HANDLER_IDLE_TIMEOUT):
         self._numOfHandlers = numOfHandlers
+        self._threadsPerHandler = threadsPerHandler
+        if maxQueued is None:
+            maxQueued = numOfHandlers * threadsPerHandler
+        self._maxQueued = maxQueued
+        self._minHandlers = min(minHandlers, numOfHandlers)
+        self._idleTimeout = idleTimeout
         self.handlers = [None] * numOfHandlers
-        self.occupied = [Lock() for i in xrange(numOfHandlers)]
+        self._handlerLocks = [Lock() for i in xrange(numOfHandlers)]
+        # The number of calls in flight on each handler
+        self._inFlight = [0] * numOfHandlers
+        self._lastUsed = [0] * numOfHandlers
+        # The handlers being started in the background
+        self._starting = set()
+        self._queued = 0
+        self._closed = False
+        self._cond = Condition(Lock())
+        self._calls = 0
+        self._waits = 0
+        self._waitTime = 0.0
+        self._maxWaitTime = 0.0
+        self._started = 0
+        self._killed = 0
+
+        with self._cond:
+            self._replenish()
 
     def _isHandlerAvailable(self, poolHandler):
         if poolHandler is None:
@@ -283,40 +628,205 @@ class RemoteFileHandlerPool(object):
 
         return True
 
-    def callCrabRPCFunction(self, timeout, name, *args, **kwargs):
-        for i, isOccupied in enumerate(self.occupied):
-            if not isOccupied.acquire(False):
-                continue
-
+    def _acquireSlot(self, deadline):
+        start = time()
+        with self._cond:
+            queued = False
             try:
-                handler = self.handlers[i]
-                if not self._isHandlerAvailable(handler):
-                    handler = self.handlers[i] = PoolHandler()
+                while True:
+                    # Prefer the running handlers, then the least busy ones
+                    free = [(self.handlers[i] is None, self._inFlight[i], i)
+                            for i in xrange(self._numOfHandlers)
+                            if self._inFlight[i] < self._threadsPerHandler]
+                    if free:
+                        i = min(free)[2]
+                        self._inFlight[i] += 1
+                        self._calls += 1
+                        self._replenish()
+                        return i
+
+                    timeLeft = deadline - time()
+                    if timeLeft <= 0:
+                        raise Exception("No free file handlers in pool")
+
+                    if not queued:
+                        if self._queued >= self._maxQueued:
+                            raise Exception("No free file handlers in pool")
+                        self._queued += 1
+                        self._waits += 1
+                        queued = True
+
+                    self._cond.wait(timeLeft)
+            finally:
+                if queued:
+                    self._queued -= 1
+                    waitTime = time() - start
+                    self._waitTime += waitTime
+                    self._maxWaitTime = max(self._maxWaitTime, waitTime)
+
+    def _releaseSlot(self, i):
+        with self._cond:
+            self._inFlight[i] -= 1
+            self._lastUsed[i] = time()
+            self._cond.notify()
+            idle = self._idleHandlers()
+
+        for i in idle:
+            self._reapHandler(i)
+
+    def _replenish(self):
+        """
+        Start handlers in the background up to minHandlers, or one more
+        handler if the running handlers have no free thread left. Must be
+        called with the pool condition held.
+        """
+        if self._closed:
+            return
 
-                return handler.proxy.callCrabRPCFunction(timeout, name,
-                                                         *args, **kwargs)
-            except Timeout:
-                try:
-                    self.handlers[i] = None
-                    handler.stop()
-                except:
-                    self.log.error("Could not signal stuck handler (PID:%d)",
-                                   handler.process.pid, exc_info=True)
+        running = [i for i in xrange(self._numOfHandlers)
+                   if self.handlers[i] is not None or i in self._starting]
+        freeThreads = sum(self._threadsPerHandler - self._inFlight[i]
+                          for i in running)
+        needed = self._minHandlers - len(running)
+        if freeThreads == 0 and running:
+            needed = max(needed, 1)
+
+        for i in xrange(self._numOfHandlers):
+            if needed <= 0:
+                break
+            if i in running or self._inFlight[i] > 0:
+                continue
+
+            self._starting.add(i)
+            t = Thread(target=self._startHandler, args=(i,),
+                       name="oop-warmup-%d" % i)
+            t.setDaemon(True)
+            t.start()
+            needed -= 1
 
+    def _startHandler(self, i):
+        try:
+            with self._handlerLocks[i]:
+                if self.handlers[i] is None and not self._closed:
+                    handler = self.handlers[i] = PoolHandler(
+                        self._threadsPerHandler)
+                    with self._cond:
+                        self._started += 1
+                    if self._closed:
+                        self._stopHandler(i, handler)
+        except Exception:
+            self.log.error("Could not start a standby handler", exc_info=True)
+        finally:
+            with self._cond:
+                self._starting.discard(i)
+                self._lastUsed[i] = time()
+
+    def _idleHandlers(self):
+        """
+        Return the handlers above minHandlers idle for more than
+        idleTimeout. Must be called with the pool condition held.
+        """
+        now = time()
+        running = [i for i in xrange(self._numOfHandlers)
+                   if self.handlers[i] is not None]
+        idle = [i for i in running
+                if self._inFlight[i] == 0 and i not in self._starting and
+                now - self._lastUsed[i] > self._idleTimeout]
+        return idle[:max(0, len(running) - self._minHandlers)]
+
+    def _reapHandler(self, i):
+        with self._handlerLocks[i]:
+            with self._cond:
+                handler = self.handlers[i]
+                if handler is None or self._inFlight[i] > 0:
+                    return
                 self.handlers[i] = None
-                raise
 
-            finally:
-                isOccupied.release()
+            self.log.debug("Stopping idle handler (PID:%d)",
+                           handler.process.pid)
+            self._stopHandler(i, handler)
 
-        raise Exception("No free file handlers in pool")
+    def _getHandler(self, i):
+        with self._handlerLocks[i]:
+            handler = self.handlers[i]
+            if self._isHandlerAvailable(handler) and handler.proxy.broken:
+                self._stopHandler(i, handler)
+                handler = None
 
-    def close(self):
-        for handler in self.handlers:
             if not self._isHandlerAvailable(handler):
-                continue
+                handler = self.handlers[i] = PoolHandler(
+                    self._threadsPerHandler)
+                with self._cond:
+                    self._started += 1
+
+            return handler
 
+    def _stopHandler(self, i, handler):
+        try:
+            self.handlers[i] = None
             handler.stop()
+        except:
+            self.log.error("Could not signal stuck handler (PID:%d)",
+                           handler.process.pid, exc_info=True)
+
+    def callCrabRPCFunction(self, timeout, name, *args, **kwargs):
+        deadline = time() + timeout
+        i = self._acquireSlot(deadline)
+        try:
+            handler = self._getHandler(i)
+            try:
+                return handler.proxy.callCrabRPCFunction(
+                    max(0, deadline - time()), name, *args, **kwargs)
+            except Timeout:
+                proxy = handler.proxy
+                if (proxy.broken or
+                        proxy.abandoned >= self._threadsPerHandler):
+                    with self._handlerLocks[i]:
+                        if self.handlers[i] is handler:
+                            self._stopHandler(i, handler)
+                    with self._cond:
+                        self._killed += 1
+                        self._replenish()
+                raise
+        finally:
+            self._releaseSlot(i)
+
+    def getStats(self):
+        """
+        Return a dict of the pool statistics: the running handlers, the
+        calls in flight and waiting for a free slot, the utilization of the
+        running handlers and the total and maximal time waited for a slot.
+        """
+        with self._cond:
+            running = sum(1 for h in self.handlers if h is not None)
+            inFlight = sum(self._inFlight)
+            capacity = running * self._threadsPerHandler
+            return {
+                'handlers': running,
+                'maxHandlers': self._numOfHandlers,
+                'threadsPerHandler': self._threadsPerHandler,
+                'inFlight': inFlight,
+                'queued': self._queued,
+                'utilization': float(inFlight) / capacity if capacity else 0.0,
+                'calls': self._calls,
+                'waits': self._waits,
+                'waitTime': self._waitTime,
+                'maxWaitTime': self._maxWaitTime,
+                'handlersStarted': self._started,
+                'handlersKilled': self._killed,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+
+        for i in xrange(self._numOfHandlers):
+            with self._handlerLocks[i]:
+                handler = self.handlers[i]
+                if not self._isHandlerAvailable(handler):
+                    continue
+
+                self._stopHandler(i, handler)
 
     def __del__(self):
         self.close()
@@ -332,6 +842,52 @@ def simpleWalk(top, topdown=True, onerror=None, followlinks=False):
     return filesList
 
 
+def _callMany(func, args):
+    """
+    Call func for each of args, returning a list of (result, error) tuples
+    so a failing call does not fail the others.
+    """
+    results = []
+    for arg in args:
+        try:
+            results.append((func(arg), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+def statMany(paths):
+    """
+    Return the list of the (stat, error) tuples of paths.
+    """
+    return _callMany(os.stat, paths)
+
+
+def readLinesMany(paths, direct=False):
+    """
+    Return the list of the (lines, error) tuples of paths, read using
+    direct I/O if direct is true.
+    """
+    return _callMany(directReadLines if direct else readLines, paths)
+
+
+def globMany(patterns):
+    """
+    Return the list of the (paths, error) tuples of patterns.
+    """
+    return _callMany(glob.glob, patterns)
+
+
+def globStat(pattern):
+    """
+    Return the list of the (path, stat, error) tuples of the paths matching
+    pattern.
+    """
+    paths = glob.glob(pattern)
+    return [(path, st, err)
+            for path, (st, err) in zip(paths, statMany(paths))]
+
+
 def directReadLines(path):
     with fileUtils.open_ex(path, "dr") as f:
         return f.readlines()
@@ -384,14 +940,15 @@ def echo(data):
 
 def parseArgs():
     try:
-        myRead, myWrite = sys.argv[1:]
+        myRead, myWrite = sys.argv[1:3]
         myRead = int(myRead)
         myWrite = int(myWrite)
+        threads = int(sys.argv[3]) if len(sys.argv) > 3 else 1
     except ValueError as ex:
         sys.stderr.write("Error parsing args %s\n" % ex)
         sys.exit(errno.EINVAL)
 
-    return myRead, myWrite
+    return myRead, myWrite, threads
 
 
 def closeFDs(whitelist):
@@ -416,17 +973,18 @@ def closeFDs(whitelist):
 if __name__ == "__main__":
     try:
         try:
-            myRead, myWrite = parseArgs()
+            myRead, myWrite, threads = parseArgs()
             closeFDs((myRead, myWrite, 2))
         except:
             logging.root.error("Error in prexecution", exc_info=True)
             raise
 
         try:
-            server = CrabRPCServer(myRead, myWrite)
+            server = CrabRPCServer(myRead, myWrite, threads)
             for func in (writeLines, readLines, truncateFile, echo, sleep,
                          directWriteLines, directReadLines, simpleWalk,
-                         directTouch):
+                         directTouch, statMany, readLinesMany, globStat,
+                         globMany):
 
                 server.registerFunction(func)
 
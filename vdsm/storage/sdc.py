@@ -22,9 +22,11 @@
 Cache module provides general purpose (more or less) cache infrastructure
 for keeping storage related data that is expensive to harvest, but needed often
 """
+import itertools
 import logging
 import threading
 from vdsm.config import config
+from vdsm import utils
 
 import multipath
 import lvm
@@ -34,6 +36,13 @@ import storage_exception as se
 # Default cache age until forcibly refreshed
 DEFAULT_REFRESH_INTERVAL = 300
 
+# How long a domain not found is reported missing without looking for it
+# again, unless the storage is refreshed in the meantime.
+MISSING_DOMAIN_TTL = 60
+
+# The maximal number of missing domains remembered
+MAX_MISSING_DOMAINS = 1000
+
 
 class DomainProxy(object):
     """
@@ -44,12 +53,18 @@ class DomainProxy(object):
     def __init__(self, cache, sdUUID):
         self._sdUUID = sdUUID
         self._cache = cache
+        # The (generation, domain) last produced
+        self._produced = (None, None)
 
     def __getattr__(self, attrName):
         return getattr(self.getRealDomain(), attrName)
 
     def getRealDomain(self):
-        return self._cache._realProduce(self._sdUUID)
+        generation, domain = self._produced
+        if self._cache.generation(self._sdUUID) != generation:
+            self._produced = generation, domain = \
+                self._cache._produce(self._sdUUID)
+        return domain
 
 
 class StorageDomainCache:
@@ -71,15 +86,31 @@ class StorageDomainCache:
         self.__staleStatus = self.STORAGE_STALE
         self.storage_repo = storage_repo
         self.knownSDs = {}  # {sdUUID: mod.findDomain}
+        # Bumped when all the domains are dropped from the cache
+        self.__epoch = 0
+        # {sdUUID: generation}, bumped when the domain changes in the cache
+        self.__generations = {}
+        # The VGs of the domains to look up after the next devices refresh
+        self.__pendingVGs = set()
+        # {sdUUID: (expiration time, sequence)} of the domains recently not
+        # found, the sequence orders the domains added at the same time
+        self.__missing = {}
+        self.__missingSeq = itertools.count()
+        # Bumped when the missing domains are forgotten
+        self.__missingGeneration = 0
 
     def invalidateStorage(self):
         with self._syncroot:
             self.__staleStatus = self.STORAGE_STALE
+            self._forgetMissing()
 
     @misc.samplingmethod
     def refreshStorage(self):
         self.__staleStatus = self.STORAGE_REFRESHING
 
+        with self._syncroot:
+            self._forgetMissing()
+
         multipath.rescan()
         lvm.invalidateCache()
 
@@ -90,6 +121,41 @@ class StorageDomainCache:
             if self.__staleStatus == self.STORAGE_REFRESHING:
                 self.__staleStatus = self.STORAGE_UPDATED
 
+    def _refreshDevices(self, sdUUID):
+        """
+        Refresh the storage when looking up the domain sdUUID, rescanning
+        the devices but keeping the LVM cache, when it is kept fresh by the
+        udev events, except for the VG of the domain.
+        """
+        with self._syncroot:
+            self.__pendingVGs.add(sdUUID)
+        self._refreshPendingDevices()
+
+    @misc.samplingmethod
+    def _refreshPendingDevices(self):
+        self.__staleStatus = self.STORAGE_REFRESHING
+
+        with self._syncroot:
+            vgNames, self.__pendingVGs = self.__pendingVGs, set()
+            self._forgetMissing()
+
+        multipath.rescan()
+        lvm.invalidateDevices(vgNames)
+
+        with self._syncroot:
+            if self.__staleStatus == self.STORAGE_REFRESHING:
+                self.__staleStatus = self.STORAGE_UPDATED
+
+    def generation(self, sdUUID):
+        """
+        Return the generation of the domain in the cache, changing when the
+        domain is added, replaced or removed.
+        """
+        return self.__epoch, self.__generations.get(sdUUID, 0)
+
+    def _bumpGeneration(self, sdUUID):
+        self.__generations[sdUUID] = self.__generations.get(sdUUID, 0) + 1
+
     def produce(self, sdUUID):
         domain = DomainProxy(self, sdUUID)
         # This is needed to preserve the semantic where if the domain
@@ -99,12 +165,19 @@ class StorageDomainCache:
         return domain
 
     def _realProduce(self, sdUUID):
+        generation, domain = self._produce(sdUUID)
+        return domain
+
+    def _produce(self, sdUUID):
+        """
+        Return the domain sdUUID and its generation in the cache.
+        """
         with self._syncroot:
             while True:
                 domain = self.__domainCache.get(sdUUID)
 
                 if domain is not None:
-                    return domain
+                    return self.generation(sdUUID), domain
 
                 if sdUUID not in self.__inProgress:
                     self.__inProgress.add(sdUUID)
@@ -114,16 +187,17 @@ class StorageDomainCache:
 
         try:
             # If multiple calls reach this point and the storage is not
-            # updated the refreshStorage() sampling method is called
+            # updated the _refreshPendingDevices() sampling method is called
             # serializing (and eventually grouping) the requests.
             if self.__staleStatus != self.STORAGE_UPDATED:
-                self.refreshStorage()
+                self._refreshDevices(sdUUID)
 
             domain = self._findDomain(sdUUID)
 
             with self._syncroot:
                 self.__domainCache[sdUUID] = domain
-                return domain
+                self._bumpGeneration(sdUUID)
+                return self.generation(sdUUID), domain
 
         finally:
             with self._syncroot:
@@ -145,31 +219,76 @@ class StorageDomainCache:
         else:
             return dom
 
-    def _findUnfetchedDomain(self, sdUUID):
+    def _findMethods(self):
         import blockSD
         import glusterSD
         import localFsSD
         import nfsSD
 
+        return [mod.findDomain
+                for mod in (blockSD, glusterSD, localFsSD, nfsSD)]
+
+    def _findUnfetchedDomain(self, sdUUID):
+        with self._syncroot:
+            if self._isMissing(sdUUID):
+                self.log.debug("domain %s was recently not found", sdUUID)
+                raise se.StorageDomainDoesNotExist(sdUUID)
+            generation = self.__missingGeneration
+
         self.log.error("looking for domain %s", sdUUID)
 
-        # The order is somewhat important, it's ordered
-        # by how quickly get can find the domain. For instance
-        # if an nfs mount is unavailable we will get stuck
-        # until it times out, this should affect fetching
-        # of block\local domains. If for any case in the future
-        # this changes, please update the order.
-        for mod in (blockSD, glusterSD, localFsSD, nfsSD):
+        failed = object()
+
+        def find(findMethod):
             try:
-                return mod.findDomain(sdUUID)
+                return findMethod(sdUUID)
             except se.StorageDomainDoesNotExist:
-                pass
+                return None
             except Exception:
                 self.log.error("Error while looking for domain `%s`", sdUUID,
                                exc_info=True)
+                return failed
+
+        # All the domain types are looked up at once, so an unavailable nfs
+        # mount doesn't delay finding the domains of the other types. A
+        # domain is remembered as missing only if all the lookups succeeded.
+        confirmed = True
+        for dom in misc.itmap(find, self._findMethods()):
+            if dom is failed:
+                confirmed = False
+            elif dom is not None:
+                return dom
+
+        if confirmed:
+            with self._syncroot:
+                if generation == self.__missingGeneration:
+                    self._addMissing(sdUUID)
 
         raise se.StorageDomainDoesNotExist(sdUUID)
 
+    def _isMissing(self, sdUUID):
+        entry = self.__missing.get(sdUUID)
+        if entry is None:
+            return False
+
+        expiration, seq = entry
+        if expiration < utils.monotonic_time():
+            del self.__missing[sdUUID]
+            return False
+
+        return True
+
+    def _addMissing(self, sdUUID):
+        self.__missing[sdUUID] = (utils.monotonic_time() + MISSING_DOMAIN_TTL,
+                                  next(self.__missingSeq))
+        if len(self.__missing) > MAX_MISSING_DOMAINS:
+            oldest = min(self.__missing, key=self.__missing.get)
+            del self.__missing[oldest]
+
+    def _forgetMissing(self):
+        self.__missing.clear()
+        self.__missingGeneration += 1
+
     def getUUIDs(self):
         import blockSD
         import fileSD
@@ -184,10 +303,15 @@ class StorageDomainCache:
         with self._syncroot:
             lvm.invalidateCache()
             self.__domainCache.clear()
+            self._dropDomainState()
+            self.__epoch += 1
+            self._forgetMissing()
 
     def manuallyAddDomain(self, domain):
         with self._syncroot:
             self.__domainCache[domain.sdUUID] = domain
+            self._bumpGeneration(domain.sdUUID)
+            self.__missing.pop(domain.sdUUID, None)
 
     def manuallyRemoveDomain(self, sdUUID):
         with self._syncroot:
@@ -195,6 +319,13 @@ class StorageDomainCache:
                 del self.__domainCache[sdUUID]
             except KeyError:
                 pass
+            self._dropDomainState(sdUUID)
+            self._bumpGeneration(sdUUID)
+
+    def _dropDomainState(self, sdUUID=None):
+        import blockSD
+        blockSD.dropVolumeGraph(sdUUID)
+        misc.dropIOPools(sdUUID)
 
 
 storage_repository = config.get('irs', 'repository')
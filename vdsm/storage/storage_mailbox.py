@@ -25,18 +25,17 @@ import time
 import threading
 import Queue
 import struct
-import signal
 import logging
 
 import uuid
 from vdsm.config import config
 import sd
 import misc
+import fileUtils
 import task
 from threadLocal import vars
 from threadPool import ThreadPool
 from storage_exception import InvalidParameterException
-from vdsm import constants
 
 __author__ = "ayalb"
 __date__ = "$Mar 9, 2009 5:25:07 PM$"
@@ -60,6 +59,10 @@ SLOTS_PER_MAILBOX = int(MAILBOX_SIZE / MESSAGE_SIZE)
 # etc)
 MESSAGES_PER_MAILBOX = SLOTS_PER_MAILBOX - 1
 
+# The SPM polls the inbox at the minimum interval for this long after a
+# request arrived, then backs off to monitorInterval
+SPM_BUSY_PERIOD = 10
+
 _zeroCheck = misc.checksum(EMPTYMAILBOX, CHECKSUM_BYTES)
 # Assumes CHECKSUM_BYTES equals 4!!!
 pZeroChecksum = struct.pack('<l', _zeroCheck)
@@ -81,9 +84,87 @@ def runTask(args):
     ctask.prepare(cmd, *args)
 
 
-def _mboxExecCmd(*args, **kwargs):
-    kwargs['deathSignal'] = signal.SIGKILL
-    return misc.execCmd(*args, **kwargs)
+def _blockRanges(blocks):
+    """
+    Merge the sorted block numbers into (first, last + 1) ranges of
+    consecutive blocks.
+    """
+    ranges = []
+    for block in blocks:
+        if ranges and ranges[-1][1] == block:
+            ranges[-1][1] = block + 1
+        else:
+            ranges.append([block, block + 1])
+    return ranges
+
+
+class AdaptiveInterval(object):
+    """
+    A polling interval kept at minimum for busyPeriod seconds after some
+    activity, then doubled on each poll up to maximum.
+    """
+    def __init__(self, minimum, maximum, busyPeriod, timefn=time.time):
+        self.minimum = min(minimum, maximum)
+        self.maximum = maximum
+        self._busyPeriod = busyPeriod
+        self._timefn = timefn
+        self._lastActivity = None
+        self._current = maximum
+
+    def activity(self):
+        self._lastActivity = self._timefn()
+        self._current = self.minimum
+
+    def next(self):
+        """
+        Return the time to wait before the next poll.
+        """
+        if (self._lastActivity is not None and
+                self._timefn() - self._lastActivity < self._busyPeriod):
+            self._current = self.minimum
+        else:
+            self._current = min(self._current * 2, self.maximum)
+        return self._current
+
+
+class MailboxFile(object):
+    """
+    A mailbox file accessed with direct I/O. The file is kept open and is
+    reopened on the next access after an I/O error.
+    """
+    def __init__(self, path, mode):
+        self._path = path
+        self._mode = mode
+        self._file = None
+
+    def read(self, offset, size):
+        data = self._call(lambda f: f.pread(offset, size))
+        if len(data) != size:
+            raise IOError(errno.EIO, "Could not read mailbox %s: read %d "
+                          "bytes instead of %d" % (self._path, len(data),
+                                                   size))
+        return data
+
+    def write(self, offset, data):
+        written = self._call(lambda f: f.pwrite(offset, data))
+        if written != len(data):
+            raise IOError(errno.EIO, "Could not write mailbox %s: wrote %d "
+                          "bytes instead of %d" % (self._path, written,
+                                                   len(data)))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _call(self, func):
+        if self._file is None:
+            self._file = fileUtils.DirectFile(self._path, self._mode)
+        try:
+            return func(self._file)
+        except (IOError, OSError):
+            self.close()
+            raise
 
 
 class SPM_Extend_Message:
@@ -250,21 +331,9 @@ class HSM_MailMonitor(threading.Thread):
         self._incomingMail = EMPTYMAILBOX
         # TODO: add support for multiple paths (multiple mailboxes)
         self._spmStorageDir = config.get('irs', 'repository')
-        self._inCmd = [constants.EXT_DD,
-                       'if=' + str(inbox),
-                       'iflag=direct,fullblock',
-                       'bs=' + str(BLOCK_SIZE),
-                       'count=' + str(BLOCKS_PER_MAILBOX),
-                       'skip=' + str(self._hostID * BLOCKS_PER_MAILBOX)
-                       ]
-        self._outCmd = [constants.EXT_DD,
-                        'of=' + str(outbox),
-                        'iflag=fullblock',
-                        'oflag=direct',
-                        'conv=notrunc',
-                        'bs=' + str(BLOCK_SIZE),
-                        'seek=' + str(self._hostID * BLOCKS_PER_MAILBOX)
-                        ]
+        self._inFile = MailboxFile(inbox, "rd")
+        self._outFile = MailboxFile(outbox, "r+d")
+        self._mailboxOffset = self._hostID * MAILBOX_SIZE
         self._init = False
         self._initMailbox()  # Read initial mailbox state
         self._msgCounter = 0
@@ -275,14 +344,14 @@ class HSM_MailMonitor(threading.Thread):
 
     def _initMailbox(self):
         # Sync initial incoming mail state with storage view
-        (rc, out, err) = _mboxExecCmd(self._inCmd, sudo=False, raw=True)
-        if rc == 0:
-            self._incomingMail = out
+        try:
+            self._incomingMail = self._inFile.read(self._mailboxOffset,
+                                                   MAILBOX_SIZE)
             self._init = True
-        else:
+        except (IOError, OSError):
             self.log.warning("HSM_MailboxMonitor - Could not initialize "
                              "mailbox, will not accept requests until init "
-                             "succeeds")
+                             "succeeds", exc_info=True)
 
     def immStop(self):
         self._stop = True
@@ -371,27 +440,24 @@ class HSM_MailMonitor(threading.Thread):
 
     def _checkForMail(self):
         #self.log.debug("HSM_MailMonitor - checking for mail")
-        #self.log.debug("Running command: " + str(self._inCmd))
-        (rc, in_mail, err) = misc.execCmd(self._inCmd, sudo=False, raw=True)
-        if rc:
-            raise RuntimeError("_handleResponses.Could not read mailbox - rc "
-                               "%s" % rc)
-        if (len(in_mail) != MAILBOX_SIZE):
-            raise RuntimeError("_handleResponses.Could not read mailbox - len "
-                               "%s != %s" % (len(in_mail), MAILBOX_SIZE))
+        in_mail = self._inFile.read(self._mailboxOffset, MAILBOX_SIZE)
         #self.log.debug("Parsing inbox content: %s", in_mail)
         return self._handleResponses(in_mail)
 
     def _sendMail(self):
-        self.log.info("HSM_MailMonitor sending mail to SPM - " +
-                      str(self._outCmd))
+        self.log.info("HSM_MailMonitor sending mail to SPM - mailbox %s",
+                      self._hostID)
         chk = misc.checksum(
             self._outgoingMail[0:MAILBOX_SIZE - CHECKSUM_BYTES],
             CHECKSUM_BYTES)
         pChk = struct.pack('<l', chk)  # Assumes CHECKSUM_BYTES equals 4!!!
         self._outgoingMail = \
             self._outgoingMail[0:MAILBOX_SIZE - CHECKSUM_BYTES] + pChk
-        _mboxExecCmd(self._outCmd, data=self._outgoingMail, sudo=False)
+        try:
+            self._outFile.write(self._mailboxOffset, self._outgoingMail)
+        except (IOError, OSError):
+            self.log.error("HSM_MailMonitor - Could not send mail to SPM",
+                           exc_info=True)
 
     def _handleMessage(self, message):
         # TODO: add support for multiple mailboxes
@@ -512,6 +578,8 @@ class HSM_MailMonitor(threading.Thread):
                           "thread stopped, clearing outgoing mail")
             self._outgoingMail = EMPTYMAILBOX
             self._sendMail()  # Clear outgoing mailbox
+            self._inFile.close()
+            self._outFile.close()
 
 
 class SPM_MailMonitor:
@@ -554,31 +622,25 @@ class SPM_MailMonitor:
         self._numHosts = int(maxHostID)
         self._outMailLen = MAILBOX_SIZE * self._numHosts
         self._monitorInterval = monitorInterval
+        self._pollInterval = AdaptiveInterval(
+            config.getfloat('irs', 'spm_mailbox_min_interval'),
+            monitorInterval, SPM_BUSY_PERIOD)
         # TODO: add support for multiple paths (multiple mailboxes)
         self._outgoingMail = self._outMailLen * "\0"
         self._incomingMail = self._outgoingMail
-        self._inCmd = ['dd',
-                       'if=' + str(self._inbox),
-                       'iflag=direct,fullblock',
-                       'count=1'
-                       ]
-        self._outCmd = ['dd',
-                        'of=' + str(self._outbox),
-                        'oflag=direct',
-                        'iflag=fullblock',
-                        'conv=notrunc',
-                        'count=1'
-                        ]
+        self._inFile = MailboxFile(self._inbox, "rd")
+        self._outFile = MailboxFile(self._outbox, "r+d")
+        # The blocks of the outgoing mail changed since it was last written
+        self._dirtyBlocks = set()
         self._outLock = thread.allocate_lock()
         self._inLock = thread.allocate_lock()
         # Clear outgoing mail
-        self.log.debug("SPM_MailMonitor - clearing outgoing mail, command is: "
-                       "%s", self._outCmd)
-        cmd = self._outCmd + ['bs=' + str(self._outMailLen)]
-        (rc, out, err) = _mboxExecCmd(cmd, sudo=False, data=self._outgoingMail)
-        if rc:
-            self.log.warning("SPM_MailMonitor couldn't clear outgoing mail, "
-                             "dd failed")
+        self.log.debug("SPM_MailMonitor - clearing outgoing mail")
+        try:
+            self._outFile.write(0, self._outgoingMail)
+        except (IOError, OSError):
+            self.log.warning("SPM_MailMonitor couldn't clear outgoing mail",
+                             exc_info=True)
 
         thread.start_new_thread(self.run, (self, ))
         self.log.debug('SPM_MailMonitor created for pool %s' % self._poolID)
@@ -598,6 +660,10 @@ class SPM_MailMonitor:
         diff = newMaxId - self._numHosts
         if diff > 0:
             delta = MAILBOX_SIZE * diff * "\0"
+            # Clear the new mailboxes on the next write
+            self._dirtyBlocks.update(xrange(
+                len(self._outgoingMail) / BLOCK_SIZE,
+                (len(self._outgoingMail) + len(delta)) / BLOCK_SIZE))
             self._outgoingMail += delta
             self._incomingMail += delta
         elif diff < 0:
@@ -631,6 +697,13 @@ class SPM_MailMonitor:
         for host in range(0, self._numHosts):
             # Check mailbox checksum
             mailboxStart = host * MAILBOX_SIZE
+            mailboxEnd = mailboxStart + MAILBOX_SIZE
+
+            # Most mailboxes do not change between two reads, the requests
+            # of an unchanged mailbox were already handled.
+            if (newMail[mailboxStart:mailboxEnd] ==
+                    self._incomingMail[mailboxStart:mailboxEnd]):
+                continue
 
             isMailboxValidated = False
 
@@ -671,6 +744,7 @@ class SPM_MailMonitor:
                             self._outgoingMail[0:msgOffset] + CLEAN_MESSAGE + \
                             self._outgoingMail[msgOffset + MESSAGE_SIZE:
                                                self._outMailLen]
+                        self._dirtyBlocks.add(msgOffset / BLOCK_SIZE)
                     finally:
                         self._outLock.release()
                     send = True
@@ -689,6 +763,7 @@ class SPM_MailMonitor:
                     continue
 
                 # We only get here if there is a novel request
+                self._pollInterval.activity()
                 try:
                     msgType = newMail[msgStart + 1:msgStart + 5]
                     if msgType in self._messageTypes:
@@ -727,31 +802,16 @@ class SPM_MailMonitor:
         self._inLock.acquire()
         try:
             #self.log.debug("SPM_MailMonitor -_checking for mail")
-            cmd = self._inCmd + ['bs=' + str(self._outMailLen)]
-            #self.log.debug("SPM_MailMonitor - reading incoming mail, "
-            #               "command: " + str(cmd))
-            (rc, in_mail, err) = misc.execCmd(cmd, sudo=False, raw=True)
-            if rc:
-                raise IOError(errno.EIO, "_handleRequests._checkForMail - "
-                              "Could not read mailbox: %s" % self._inbox)
-
-            if (len(in_mail) != (self._outMailLen)):
-                self.log.error('SPM_MailMonitor: _checkForMail - dd succeeded '
-                               'but read %d bytes instead of %d, cannot check '
-                               'mail.  Read mail contains: %s', len(in_mail),
-                               self._outMailLen, repr(in_mail[:80]))
-                raise RuntimeError("_handleRequests._checkForMail - Could not "
-                                   "read mailbox")
+            in_mail = self._inFile.read(0, self._outMailLen)
             #self.log.debug("Parsing inbox content: %s", in_mail)
-            if self._handleRequests(in_mail):
+            # Also retry the writes of the replies that failed
+            if self._handleRequests(in_mail) or self._dirtyBlocks:
                 self._outLock.acquire()
                 try:
-                    cmd = self._outCmd + ['bs=' + str(self._outMailLen)]
-                    (rc, out, err) = _mboxExecCmd(cmd, sudo=False,
-                                                  data=self._outgoingMail)
-                    if rc:
-                        self.log.warning("SPM_MailMonitor couldn't write "
-                                         "outgoing mail, dd failed")
+                    self._writeOutgoingMail()
+                except (IOError, OSError):
+                    self.log.warning("SPM_MailMonitor couldn't write "
+                                     "outgoing mail", exc_info=True)
                 finally:
                     self._outLock.release()
         finally:
@@ -766,20 +826,33 @@ class SPM_MailMonitor:
             self._outgoingMail = \
                 self._outgoingMail[0:msgOffset] + msg.payload + \
                 self._outgoingMail[msgOffset + MESSAGE_SIZE:self._outMailLen]
-            mailboxOffset = (msgID / SLOTS_PER_MAILBOX) * MAILBOX_SIZE
-            mailbox = self._outgoingMail[mailboxOffset:
-                                         mailboxOffset + MAILBOX_SIZE]
-            cmd = self._outCmd + ['bs=' + str(MAILBOX_SIZE),
-                                  'seek=' + str(mailboxOffset / MAILBOX_SIZE)]
-            #self.log.debug("Running command: %s, for message id: %s",
-            #               str(cmd), str(msgID))
-            (rc, out, err) = _mboxExecCmd(cmd, sudo=False, data=mailbox)
-            if rc:
+            self._dirtyBlocks.add(msgOffset / BLOCK_SIZE)
+            try:
+                self._writeOutgoingMail()
+            except (IOError, OSError):
                 self.log.error("SPM_MailMonitor: sendReply - couldn't send "
-                               "reply, dd failed")
+                               "reply", exc_info=True)
         finally:
             self._outLock.release()
 
+    def _writeOutgoingMail(self):
+        """
+        Write the blocks of the outgoing mail that changed since it was last
+        written, must be called with the outgoing mail lock held.
+        """
+        lastBlock = self._outMailLen / BLOCK_SIZE
+        blocks = sorted(b for b in self._dirtyBlocks if b < lastBlock)
+        self._dirtyBlocks.clear()
+        for first, end in _blockRanges(blocks):
+            start = first * BLOCK_SIZE
+            try:
+                self._outFile.write(start, self._outgoingMail[
+                    start:end * BLOCK_SIZE])
+            except (IOError, OSError):
+                # Keep the blocks not written for the next time
+                self._dirtyBlocks.update(b for b in blocks if b >= first)
+                raise
+
     def run(self, *args):
         try:
             while not self._stop:
@@ -789,9 +862,13 @@ class SPM_MailMonitor:
                     if (self._inLock.locked()):
                         self._inLock.release()
                     self.log.error("Error checking for mail", exc_info=True)
-                time.sleep(self._monitorInterval)
+                time.sleep(self._pollInterval.next())
         finally:
             self._stopped = True
             self.tp.joinAll(waitForTasks=False)
+            with self._inLock:
+                self._inFile.close()
+            with self._outLock:
+                self._outFile.close()
             self.log.info("SPM_MailMonitor - Incoming mail monitoring thread "
                           "stopped")
@@ -480,6 +480,8 @@ class Task:
 
         self.recoveries = []
         self.jobs = []
+        # {'done': units, 'total': units} as reported by the task verb
+        self.progress = None
         self.nrecoveries = 0    # just utility count - used by save/load
         self.njobs = 0          # just utility count - used by save/load
 
@@ -1267,7 +1269,7 @@ class Task:
         return oReturn
 
     def getDetails(self):
-        return {
+        details = {
             "id": self.id,
             "verb": self.name,
             "state": str(self.state),
@@ -1276,6 +1278,16 @@ class Task:
             "result": self.result.result,
             "tag": self.tag
         }
+        if self.progress is not None:
+            details["progress"] = self.progress
+        return details
+
+    def reportProgress(self, done, total):
+        """
+        Report that done out of total units of the work of the task were
+        done, e.g. the bytes of a copy.
+        """
+        self.progress = {'done': done, 'total': total}
 
     def getID(self):
         return self.id
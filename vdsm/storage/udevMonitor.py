@@ -0,0 +1,172 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+"""
+Monitoring of the udev events of the block devices.
+
+The events are dicts of the udev properties of the device, e.g. ACTION,
+DEVNAME, DM_NAME, DM_UUID, DM_VG_NAME and DM_LV_NAME for the device mapper
+devices.
+"""
+
+import logging
+import signal
+from threading import Event, Thread
+
+from cpopen import CPopen
+from vdsm import constants
+
+
+class UdevEventSource(object):
+    """
+    The block devices events reported by "udevadm monitor".
+    """
+    log = logging.getLogger("Storage.UdevEventSource")
+
+    def __init__(self):
+        self._proc = None
+
+    def events(self):
+        cmd = [constants.EXT_UDEVADM, "monitor", "--udev", "--property",
+               "--subsystem-match=block"]
+        self._proc = CPopen(cmd, close_fds=True, deathSignal=signal.SIGTERM)
+        try:
+            for event in parseEvents(iter(self._proc.stdout.readline, "")):
+                yield event
+        finally:
+            self.close()
+
+    def close(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+
+        try:
+            proc.kill()
+        except OSError:
+            pass
+        proc.wait()
+
+
+def parseEvents(lines):
+    """
+    Parse the output of "udevadm monitor --property", each event is a block
+    of KEY=VALUE lines ending with an empty line.
+    """
+    event = {}
+    for line in lines:
+        line = line.rstrip("\n")
+        if not line:
+            if "ACTION" in event:
+                yield event
+            event = {}
+            continue
+
+        key, sep, value = line.partition("=")
+        if sep:
+            event[key] = value
+
+
+class UdevMonitor(object):
+    """
+    Pass the events of source to handler from a thread.
+
+    If source stops reporting events the monitoring is restarted, waiting
+    longer after every failure in a row, up to MAX_RESTART_DELAY seconds.
+    The events reported meanwhile are lost, resync is called before
+    restarting so the handler can recover from them.
+    """
+    log = logging.getLogger("Storage.UdevMonitor")
+
+    RESTART_DELAY = 1
+    MAX_RESTART_DELAY = 60
+
+    def __init__(self, handler, source=None, resync=None):
+        self._handler = handler
+        self._source = source or UdevEventSource()
+        self._resync = resync
+        self._stopped = Event()
+        self._connected = False
+        self._thread = Thread(target=self._run, name="udev-monitor")
+        self._thread.setDaemon(True)
+
+    @property
+    def connected(self):
+        """
+        True while the events of source are being handled.
+        """
+        return self._connected
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._source.close()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+        self.log.debug("Start monitoring udev events")
+        delay = self.RESTART_DELAY
+        while True:
+            self._connected = True
+            handled = self._monitor()
+            self._connected = False
+            if self._stopped.isSet():
+                break
+
+            if handled:
+                delay = self.RESTART_DELAY
+            self.log.warning("udev events monitoring interrupted, restarting "
+                             "in %s seconds", delay)
+            self._stopped.wait(delay)
+            if self._stopped.isSet():
+                break
+            delay = min(delay * 2, self.MAX_RESTART_DELAY)
+
+            if self._resync is not None:
+                try:
+                    self._resync()
+                except Exception:
+                    self.log.error("Error recovering from lost events",
+                                   exc_info=True)
+        self.log.debug("Stop monitoring udev events")
+
+    def _monitor(self):
+        """
+        Handle the events of source until it stops, return the number of
+        the events handled.
+        """
+        handled = 0
+        try:
+            for event in self._source.events():
+                if self._stopped.isSet():
+                    break
+                handled += 1
+                try:
+                    self._handler(event)
+                except Exception:
+                    self.log.error("Error handling event %s", event,
+                                   exc_info=True)
+        except Exception:
+            self.log.error("Error reading udev events", exc_info=True)
+        return handled
@@ -34,6 +34,7 @@ from sdc import sdCache
 import misc
 from misc import deprecated
 import fileUtils
+import imageCopy
 import task
 from threadLocal import vars
 import resourceFactories
@@ -1090,10 +1091,10 @@ def qemuConvert(src, dst, src_fmt, dst_fmt, stop, size, dstvolType):
 
     if (src_fmt == "raw" and dst_fmt == "raw" and
             dstvolType == PREALLOCATED_VOL):
-        (rc, out, err) = misc.ddWatchCopy(
-            src=src, dst=dst,
-            stop=stop, size=size,
-            recoveryCallback=baseAsyncTasksRollback)
+        # The destination may hold stale data, the zeros must be written
+        imageCopy.copyVolumes([imageCopy.CopyJob(src, dst, size, False)],
+                              stop, vars.task.reportProgress)
+        (rc, out, err) = (0, [], [])
     else:
         cmd = [constants.EXT_QEMUIMG, "convert",
                "-t", "none", "-f", src_fmt, src,
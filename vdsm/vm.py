@@ -25,6 +25,7 @@ from copy import deepcopy
 from xml.dom import Node
 from xml.dom.minidom import parseString as _domParseStr
 import logging
+import math
 import os
 import pickle
 import tempfile
@@ -55,6 +56,7 @@ import caps
 import guestIF
 import hooks
 import kaxmlrpclib
+import migrationScheduler
 import sampling
 import supervdsm
 
@@ -102,18 +104,19 @@ class MigrationSourceThread(threading.Thread):
     """
     A thread that takes care of migration on the source vdsm.
     """
-    _ongoingMigrations = threading.BoundedSemaphore(1)
+    _scheduler = migrationScheduler.MigrationScheduler(
+        1, config.getint('vars', 'migration_host_bandwidth'),
+        config.getint('vars', 'migration_max_bandwidth'))
 
     @classmethod
     def setMaxOutgoingMigrations(cls, n):
-        """Set the initial value of the _ongoingMigrations semaphore.
-
-        must not be called after any vm has been run."""
-        cls._ongoingMigrations = threading.BoundedSemaphore(n)
+        """Set the number of outgoing migrations running at once."""
+        cls._scheduler.setMaxActive(n)
 
     def __init__(self, vm, dst='', dstparams='',
                  mode='remote', method='online',
-                 tunneled=False, dstqemu='', abortOnError=False, **kwargs):
+                 tunneled=False, dstqemu='', abortOnError=False,
+                 priority=0, **kwargs):
         self.log = vm.log
         self._vm = vm
         self._dst = dst
@@ -124,6 +127,7 @@ class MigrationSourceThread(threading.Thread):
         self._tunneled = utils.tobool(tunneled)
         self._abortOnError = utils.tobool(abortOnError)
         self._dstqemu = dstqemu
+        self._priority = int(priority)
         self._downtime = kwargs.get('downtime') or \
             config.get('vars', 'migration_downtime')
         self.status = {
@@ -135,6 +139,8 @@ class MigrationSourceThread(threading.Thread):
         self._preparingMigrationEvt = True
         self._migrationCanceledEvt = False
         self._monitorThread = None
+        self._maxBandwidth = None
+        self._migrating = False
 
     def getStat(self):
         """
@@ -145,8 +151,24 @@ class MigrationSourceThread(threading.Thread):
             self.status['progress'] = int(
                 float(self._monitorThread.data_progress +
                       self._monitorThread.mem_progress) / 2)
+        position = self._scheduler.queuePosition(self)
+        if position is not None:
+            status = self.status.copy()
+            status['queuePosition'] = position
+            return status
         return self.status
 
+    def setMaxBandwidth(self, bandwidth):
+        """
+        Set the bandwidth of the migration (in MiB per second), called by
+        the migration scheduler as migrations start and finish.
+        """
+        self._maxBandwidth = bandwidth
+        if self._migrating:
+            self.log.debug("Setting migration bandwidth to %d MiBps",
+                           bandwidth)
+            self._vm._dom.migrateSetMaxSpeed(bandwidth, 0)
+
     def _setupVdsConnection(self):
         if self._mode == 'file':
             return
@@ -294,18 +316,20 @@ class MigrationSourceThread(threading.Thread):
             self._setupVdsConnection()
             self._setupRemoteMachineParams()
             self._prepareGuest()
-            MigrationSourceThread._ongoingMigrations.acquire()
+            self._scheduler.acquire(self, self._priority,
+                                    int(self._vm.conf['memSize']),
+                                    lambda: self._migrationCanceledEvt)
             try:
                 if self._migrationCanceledEvt:
                     self._raiseAbortError()
-                self.log.debug("migration semaphore acquired")
+                self.log.debug("migration scheduled")
                 self._vm.conf['_migrationParams'] = {
                     'dst': self._dst,
                     'mode': self._mode,
                     'method': self._method,
                     'dstparams': self._dstparams,
                     'dstqemu': self._dstqemu}
-                self._vm.saveState()
+                self._vm.saveState(sync=True)
                 self._startUnderlyingMigration(startTime)
                 self._finishSuccessfully()
             except libvirt.libvirtError as e:
@@ -317,7 +341,8 @@ class MigrationSourceThread(threading.Thread):
             finally:
                 if '_migrationParams' in self._vm.conf:
                     del self._vm.conf['_migrationParams']
-                MigrationSourceThread._ongoingMigrations.release()
+                self._migrating = False
+                self._scheduler.release(self)
         except Exception as e:
             self._recover(str(e))
             self.log.error("Failed to migrate", exc_info=True)
@@ -373,7 +398,9 @@ class MigrationSourceThread(threading.Thread):
                     SPICE_MIGRATION_HANDOVER_TIME = 120
                     self._vm._reviveTicket(SPICE_MIGRATION_HANDOVER_TIME)
 
-                maxBandwidth = config.getint('vars', 'migration_max_bandwidth')
+                # The bandwidth is adjusted by the scheduler from now on
+                self._migrating = True
+                maxBandwidth = self._maxBandwidth
                 #FIXME: there still a race here with libvirt,
                 # if we call stop() and libvirt migrateToURI2 didn't start
                 # we may return migration stop but it will start at libvirt
@@ -402,6 +429,8 @@ class MigrationSourceThread(threading.Thread):
         # call so no need to abortJob()
         try:
             self._migrationCanceledEvt = True
+            # Canceled while waiting in the queue
+            self._scheduler.wakeup()
             self._vm._dom.abortJob()
         except libvirt.libvirtError:
             if not self._preparingMigrationEvt:
@@ -469,17 +498,14 @@ class UpdatePortMirroringError(Exception):
     pass
 
 
-class VmStatsThread(sampling.AdvancedStatsThread):
+class VmStatsCollector(sampling.AdvancedStatsGroup):
     MBPS_TO_BPS = 10 ** 6 / 8
 
     def __init__(self, vm):
-        sampling.AdvancedStatsThread.__init__(self, log=vm.log, daemon=True)
+        sampling.AdvancedStatsGroup.__init__(
+            self, vm.cif.statsScheduler, log=vm.log)
         self._vm = vm
 
-        self.highWrite = (
-            sampling.AdvancedStatsFunction(
-                self._highWrite,
-                config.getint('vars', 'vm_watermark_interval')))
         self.updateVolumes = (
             sampling.AdvancedStatsFunction(
                 self._updateVolumes,
@@ -489,7 +515,8 @@ class VmStatsThread(sampling.AdvancedStatsThread):
             sampling.AdvancedStatsFunction(
                 self._sampleCpu,
                 config.getint('vars', 'vm_sample_cpu_interval'),
-                config.getint('vars', 'vm_sample_cpu_window')))
+                config.getint('vars', 'vm_sample_cpu_window'),
+                fields=sampling.CPU_STATS_FIELDS))
         self.sampleDisk = (
             sampling.AdvancedStatsFunction(
                 self._sampleDisk,
@@ -506,15 +533,31 @@ class VmStatsThread(sampling.AdvancedStatsThread):
                 config.getint('vars', 'vm_sample_net_interval'),
                 config.getint('vars', 'vm_sample_net_window')))
 
-        self.addStatsFunction(
-            self.highWrite, self.updateVolumes, self.sampleCpu,
-            self.sampleDisk, self.sampleDiskLatency, self.sampleNet)
+        self.sampleBalloon = (
+            sampling.AdvancedStatsFunction(
+                self._sampleBalloon,
+                config.getint('vars', 'vm_sample_cpu_interval'), 1))
 
-    def _highWrite(self):
-        if not self._vm.isDisksStatsCollectionEnabled():
-            # Avoid queries from storage during recovery process
-            return
-        self._vm.extendDrivesIfNeeded()
+        self.addStatsFunction(self.updateVolumes)
+
+        # Sampled by the host-wide BulkStatsSampler
+        self._bulkStatsFunctions = {
+            sampling.BULK_CPU: self.sampleCpu,
+            sampling.BULK_BALLOON: self.sampleBalloon,
+            sampling.BULK_DISK: self.sampleDisk,
+            sampling.BULK_DISK_LATENCY: self.sampleDiskLatency,
+            sampling.BULK_NET: self.sampleNet}
+
+    def start(self):
+        sampling.AdvancedStatsGroup.start(self)
+        self._vm.cif.bulkSampler.register(self._vm.id, self,
+                                          self._bulkStatsFunctions)
+        self._vm.cif.watermarkMonitor.register(self._vm.id, self._vm)
+
+    def stop(self):
+        self._vm.cif.watermarkMonitor.unregister(self._vm.id)
+        self._vm.cif.bulkSampler.unregister(self._vm.id)
+        sampling.AdvancedStatsGroup.stop(self)
 
     def _updateVolumes(self):
         if not self._vm.isDisksStatsCollectionEnabled():
@@ -524,25 +567,39 @@ class VmStatsThread(sampling.AdvancedStatsThread):
         for vmDrive in self._vm._devices[DISK_DEVICES]:
             self._vm.updateDriveVolume(vmDrive)
 
-    def _sampleCpu(self):
+    def _sampleCpu(self, bulkStats=None):
+        if bulkStats is not None:
+            return sampling.bulkCpuStats(bulkStats)
         cpuStats = self._vm._dom.getCPUStats(True, 0)
         return cpuStats[0]
 
-    def _sampleDisk(self):
+    def _sampleBalloon(self, bulkStats=None):
+        if bulkStats is not None:
+            return sampling.bulkBalloonStats(bulkStats)
+        return self._vm._dom.info()[2]
+
+    def _sampleDisk(self, bulkStats=None):
         if not self._vm.isDisksStatsCollectionEnabled():
             # Avoid queries from storage during recovery process
             return
 
+        if bulkStats is not None:
+            return sampling.bulkDiskStats(bulkStats)
+
         diskSamples = {}
         for vmDrive in self._vm._devices[DISK_DEVICES]:
             diskSamples[vmDrive.name] = self._vm._dom.blockStats(vmDrive.name)
 
         return diskSamples
 
-    def _sampleDiskLatency(self):
+    def _sampleDiskLatency(self, bulkStats=None):
         if not self._vm.isDisksStatsCollectionEnabled():
             # Avoid queries from storage during recovery process
             return
+
+        if bulkStats is not None:
+            return sampling.bulkDiskLatencyStats(bulkStats)
+
         #{'wr_total_times': 0L, 'rd_operations': 9638L,
         # 'flush_total_times': 0L,'rd_total_times': 7622718001L,
         # 'rd_bytes': 85172430L, 'flush_operations': 0L,
@@ -553,7 +610,10 @@ class VmStatsThread(sampling.AdvancedStatsThread):
                 vmDrive.name, flags=libvirt.VIR_TYPED_PARAM_STRING_OKAY)
         return diskLatency
 
-    def _sampleNet(self):
+    def _sampleNet(self, bulkStats=None):
+        if bulkStats is not None:
+            return sampling.bulkNetStats(bulkStats)
+
         netSamples = {}
         for nic in self._vm._devices[NIC_DEVICES]:
             netSamples[nic.name] = self._vm._dom.interfaceStats(nic.name)
@@ -565,8 +625,9 @@ class VmStatsThread(sampling.AdvancedStatsThread):
     def _usagePercentage(self, val, sampleInterval):
         return 100 * val / sampleInterval / 1000 ** 3
 
-    def _getCpuStats(self, stats):
-        sInfo, eInfo, sampleInterval = self.sampleCpu.getStats()
+    def _getCpuStats(self, stats, averagingWindow=None):
+        sInfo, eInfo, sampleInterval = self._windowStats(
+            self.sampleCpu, averagingWindow)
 
         try:
             stats['cpuSys'] = self._usagePercentage(
@@ -584,9 +645,10 @@ class VmStatsThread(sampling.AdvancedStatsThread):
             stats['cpuUser'] = 0.0
             stats['cpuSys'] = 0.0
 
-    def _getNetworkStats(self, stats):
+    def _getNetworkStats(self, stats, averagingWindow=None):
         stats['network'] = {}
-        sInfo, eInfo, sampleInterval = self.sampleNet.getStats()
+        sInfo, eInfo, sampleInterval = self._windowStats(
+            self.sampleNet, averagingWindow)
 
         for nic in self._vm._devices[NIC_DEVICES]:
             if nic.name.startswith('hostdev'):
@@ -618,8 +680,9 @@ class VmStatsThread(sampling.AdvancedStatsThread):
 
             stats['network'][nic.name] = ifStats
 
-    def _getDiskStats(self, stats):
-        sInfo, eInfo, sampleInterval = self.sampleDisk.getStats()
+    def _getDiskStats(self, stats, averagingWindow=None):
+        sInfo, eInfo, sampleInterval = self._windowStats(
+            self.sampleDisk, averagingWindow)
 
         for vmDrive in self._vm._devices[DISK_DEVICES]:
             dName = vmDrive.name
@@ -629,6 +692,8 @@ class VmStatsThread(sampling.AdvancedStatsThread):
                           'apparentsize': str(vmDrive.apparentsize)}
                 if isVdsmImage(vmDrive):
                     dStats['imageID'] = vmDrive.imageID
+                if vmDrive.blockDev and vmDrive.format == 'cow':
+                    dStats['allocRate'] = int(vmDrive.allocRate)
                 dStats['readRate'] = ((eInfo[dName][1] - sInfo[dName][1]) /
                                       sampleInterval)
                 dStats['writeRate'] = ((eInfo[dName][3] - sInfo[dName][3]) /
@@ -638,8 +703,9 @@ class VmStatsThread(sampling.AdvancedStatsThread):
 
             stats[dName] = dStats
 
-    def _getDiskLatency(self, stats):
-        sInfo, eInfo, sampleInterval = self.sampleDiskLatency.getStats()
+    def _getDiskLatency(self, stats, averagingWindow=None):
+        sInfo, eInfo, sampleInterval = self._windowStats(
+            self.sampleDiskLatency, averagingWindow)
 
         def _avgLatencyCalc(sData, eData):
             readLatency = (0 if not (eData['rd_operations'] -
@@ -677,19 +743,38 @@ class VmStatsThread(sampling.AdvancedStatsThread):
             else:
                 stats[dName].update(dLatency)
 
-    def get(self):
-        stats = {}
+    def _windowStats(self, statsFunction, averagingWindow):
+        """
+        Return the stats of statsFunction over the last averagingWindow
+        seconds, or over the whole window if averagingWindow is not
+        specified or is shorter than the sampling interval.
+        """
+        if averagingWindow:
+            sInfo, eInfo, sampleInterval = statsFunction.getStats(
+                averagingWindow)
+            if sampleInterval is not None:
+                return sInfo, eInfo, sampleInterval
+        return statsFunction.getStats()
 
+    def getStatsAge(self):
         try:
-            stats['statsAge'] = time.time() - self.getLastSampleTime()
+            return time.time() - self.getLastSampleTime()
         except TypeError:
             self._log.debug("Stats age not available")
-            stats['statsAge'] = -1.0
+            return -1.0
 
-        self._getCpuStats(stats)
-        self._getNetworkStats(stats)
-        self._getDiskStats(stats)
-        self._getDiskLatency(stats)
+    def statsSampled(self):
+        self._vm.updateStatsCache()
+
+    def get(self, averagingWindow=None):
+        stats = {}
+
+        stats['statsAge'] = self.getStatsAge()
+
+        self._getCpuStats(stats, averagingWindow)
+        self._getNetworkStats(stats, averagingWindow)
+        self._getDiskStats(stats, averagingWindow)
+        self._getDiskLatency(stats, averagingWindow)
 
         return stats
 
@@ -1433,6 +1518,9 @@ class Drive(VmDevice):
     VOLWM_CHUNK_MB = config.getint('irs', 'volume_utilization_chunk_mb')
     VOLWM_FREE_PCT = 100 - config.getint('irs', 'volume_utilization_percent')
     VOLWM_CHUNK_REPLICATE_MULT = 2  # Chunk multiplier during replication
+    VOLWM_CHUNK_MAX_MB = config.getint('irs',
+                                       'volume_utilization_chunk_max_mb')
+    VOLWM_EXTEND_TIME = config.getint('irs', 'volume_extension_time')
 
     def __init__(self, conf, log, **kwargs):
         if not kwargs.get('serial'):
@@ -1442,6 +1530,9 @@ class Drive(VmDevice):
         self.reqsize = int(kwargs.get('reqsize', '0'))  # Backward compatible
         self.truesize = int(kwargs.get('truesize', '0'))
         self.apparentsize = int(kwargs.get('apparentsize', '0'))
+        # The recent growth of the allocation (bytes per second) measured
+        # by the watermark monitor
+        self.allocRate = 0
         self.name = self._makeName()
         self.cache = config.get('vars', 'qemu_drive_cache')
 
@@ -1502,11 +1593,21 @@ class Drive(VmDevice):
         Returns the volume extension chunks (used for the thin provisioning
         on block devices). The value is based on the vdsm configuration but
         can also dynamically change according to the VM needs (e.g. increase
-        during a live storage migration).
+        during a live storage migration, or when the guest writes fast).
         """
         if self.isDiskReplicationInProgress():
-            return self.VOLWM_CHUNK_MB * self.VOLWM_CHUNK_REPLICATE_MULT
-        return self.VOLWM_CHUNK_MB
+            chunk = self.VOLWM_CHUNK_MB * self.VOLWM_CHUNK_REPLICATE_MULT
+        else:
+            chunk = self.VOLWM_CHUNK_MB
+
+        # The free space left when reaching the watermark must last for an
+        # extension at the current allocation rate.
+        rateChunk = (self.allocRate * self.VOLWM_EXTEND_TIME * 100 /
+                     self.VOLWM_FREE_PCT / constants.MEGAB)
+        if rateChunk > chunk:
+            chunk = min(int(math.ceil(rateChunk)),
+                        max(chunk, self.VOLWM_CHUNK_MAX_MB))
+        return chunk
 
     @property
     def watermarkLimit(self):
@@ -2283,19 +2384,33 @@ class Vm(object):
         return self._volumesPrepared
 
     def preparePaths(self, drives):
-        domains = []
         for drive in drives:
-            with self._volPrepareLock:
-                if self.destroyed:
-                    # A destroy request has been issued, exit early
-                    break
-                drive['path'] = self.cif.prepareVolumePath(drive, self.id)
-            if drive['device'] == 'disk' and isVdsmImage(drive):
-                domains.append(drive['domainID'])
+            if not self.prepareDrivePath(drive):
+                break
         else:
-            self.sdIds.extend(domains)
-            # Now we got all the resources we needed
-            self.startDisksStatsCollection()
+            self.pathsPrepared(drives)
+
+    def prepareDrivePath(self, drive):
+        """
+        Prepare the path of drive, return False if the vm is being
+        destroyed.
+        """
+        with self._volPrepareLock:
+            if self.destroyed:
+                # A destroy request has been issued, exit early
+                return False
+            drive['path'] = self.cif.prepareVolumePath(drive, self.id)
+        return True
+
+    def pathsPrepared(self, drives):
+        """
+        Called once the paths of all the drives have been prepared.
+        """
+        for drive in drives:
+            if drive['device'] == 'disk' and isVdsmImage(drive):
+                self.sdIds.append(drive['domainID'])
+        # Now we got all the resources we needed
+        self.startDisksStatsCollection()
 
     def _prepareTransientDisks(self, drives):
         for drive in drives:
@@ -2327,17 +2442,22 @@ class Vm(object):
             load = len(self.cif.vmContainer)
         return base * (doubler + load) / doubler
 
-    def saveState(self):
-        self._saveStateInternal()
+    def saveState(self, sync=False):
+        """
+        Save the state of the vm in its recovery file, by the recovery store
+        thread or before returning if sync is True.
+        """
+        self.cif.recoveryStore.update(self.id, self._recoveryFile,
+                                      self._recoveryState, sync)
         try:
             self._getUnderlyingVmInfo()
         except Exception:
             # we do not care if _dom suddenly died now
             pass
 
-    def _saveStateInternal(self):
+    def _recoveryState(self):
         if self.destroyed:
-            return
+            return None
         with self._confLock:
             toSave = deepcopy(self.status())
         toSave['startTime'] = self._startTime
@@ -2358,12 +2478,7 @@ class Vm(object):
                 if isVdsmImage(d) and drive.get('volumeID') == d.volumeID:
                     drive['truesize'] = str(d.truesize)
                     drive['apparentsize'] = str(d.apparentsize)
-
-        with tempfile.NamedTemporaryFile(dir=constants.P_VDSM_RUN,
-                                         delete=False) as f:
-            pickle.dump(toSave, f)
-
-        os.rename(f.name, self._recoveryFile)
+        return toSave
 
     def onReboot(self):
         try:
@@ -2414,6 +2529,29 @@ class Vm(object):
         with self._confLock:
             self.conf['timeOffset'] = timeOffset
 
+    def getChunkedDrives(self):
+        """
+        Return the thin provisioned drives extended by chunks, or None if
+        they cannot be checked now.
+        """
+        if not self.isDisksStatsCollectionEnabled():
+            # Avoid queries from storage during recovery process
+            return None
+        if self._vmStats is None or self._vmStats.isPaused():
+            return None
+        return [drive for drive in self._devices[DISK_DEVICES]
+                if drive.blockDev and drive.format == 'cow']
+
+    def getDriveBlockInfo(self, drive):
+        return self._dom.blockInfo(drive.path, 0)
+
+    def setDriveThreshold(self, drive, threshold):
+        """
+        Request a block threshold event once the allocation of drive
+        exceeds threshold bytes.
+        """
+        self._dom.setBlockThreshold(drive.name, threshold, 0)
+
     def extendDrivesIfNeeded(self):
         extend = []
 
@@ -2421,34 +2559,9 @@ class Vm(object):
             if not drive.blockDev or drive.format != 'cow':
                 continue
 
-            capacity, alloc, physical = self._dom.blockInfo(drive.path, 0)
-
-            # Since the check based on nextPhysSize is extremly risky (it
-            # may result in the VM being paused) we can't use the regular
-            # getNextVolumeSize call as it relies on a cached value of the
-            # drive apparentsize.
-            nextPhysSize = physical + drive.VOLWM_CHUNK_MB * constants.MEGAB
-
-            # NOTE: the intent of this check is to prevent faulty images to
-            # trick qemu in requesting extremely large extensions (BZ#998443).
-            # Probably the definitive check would be comparing the allocated
-            # space with capacity + format_overhead. Anyway given that:
-            #
-            # - format_overhead is tricky to be computed (it depends on few
-            #   assumptions that may change in the future e.g. cluster size)
-            # - currently we allow only to extend by one chunk at time
-            #
-            # the current check compares alloc with the next volume size.
-            # It should be noted that alloc cannot be directly compared with
-            # the volume physical size as it includes also the clusters not
-            # written yet (pending).
-            if alloc > nextPhysSize:
-                self.log.error(
-                    "Improbable extension request for volume %s on domain "
-                    "%s, pausing the VM to avoid corruptions (capacity: %s, "
-                    "allocated: %s, physical: %s, next physical size: %s)",
-                    drive.volumeID, drive.domainID, capacity, alloc,
-                    physical, nextPhysSize)
+            capacity, alloc, physical = self.getDriveBlockInfo(drive)
+
+            if self._isImprobableExtension(drive, capacity, alloc, physical):
                 self.pause(pauseCode='EOTHER')
                 return False
 
@@ -2456,15 +2569,68 @@ class Vm(object):
                 extend.append((drive, capacity, alloc, physical))
 
         for drive, capacity, alloc, physical in extend:
-            self.log.info(
-                "Requesting extension for volume %s on domain %s (apparent: "
-                "%s, capacity: %s, allocated: %s, physical: %s)",
-                drive.volumeID, drive.domainID, drive.apparentsize, capacity,
-                alloc, physical)
-            self.extendDriveVolume(drive)
+            self._requestDriveExtension(drive, capacity, alloc, physical)
 
         return len(extend) > 0
 
+    def onDriveWatermark(self, drive, capacity, alloc, physical, rate):
+        """
+        Request the extension of drive if its allocation reached the
+        watermark, return True if requested. The watermark and the size of
+        the extension grow with rate, the recent growth of the allocation
+        in bytes per second.
+        """
+        drive.allocRate = rate
+
+        if self._isImprobableExtension(drive, capacity, alloc, physical):
+            self.pause(pauseCode='EOTHER')
+            return False
+
+        if physical - alloc >= drive.watermarkLimit:
+            return False
+
+        self._requestDriveExtension(drive, capacity, alloc, physical)
+        return True
+
+    def _isImprobableExtension(self, drive, capacity, alloc, physical):
+        # Since the check based on nextPhysSize is extremly risky (it
+        # may result in the VM being paused) we can't use the regular
+        # getNextVolumeSize call as it relies on a cached value of the
+        # drive apparentsize.
+        nextPhysSize = physical + drive.VOLWM_CHUNK_MB * constants.MEGAB
+
+        # NOTE: the intent of this check is to prevent faulty images to
+        # trick qemu in requesting extremely large extensions (BZ#998443).
+        # Probably the definitive check would be comparing the allocated
+        # space with capacity + format_overhead. Anyway given that:
+        #
+        # - format_overhead is tricky to be computed (it depends on few
+        #   assumptions that may change in the future e.g. cluster size)
+        # - currently we allow only to extend by one chunk at time
+        #
+        # the current check compares alloc with the next volume size.
+        # It should be noted that alloc cannot be directly compared with
+        # the volume physical size as it includes also the clusters not
+        # written yet (pending).
+        if alloc > nextPhysSize:
+            self.log.error(
+                "Improbable extension request for volume %s on domain "
+                "%s, pausing the VM to avoid corruptions (capacity: %s, "
+                "allocated: %s, physical: %s, next physical size: %s)",
+                drive.volumeID, drive.domainID, capacity, alloc,
+                physical, nextPhysSize)
+            return True
+
+        return False
+
+    def _requestDriveExtension(self, drive, capacity, alloc, physical):
+        self.log.info(
+            "Requesting extension for volume %s on domain %s (apparent: "
+            "%s, capacity: %s, allocated: %s, physical: %s, rate: %d)",
+            drive.volumeID, drive.domainID, drive.apparentsize, capacity,
+            alloc, physical, drive.allocRate)
+        self.extendDriveVolume(drive)
+
     def extendDriveVolume(self, vmDrive):
         if not vmDrive.blockDev:
             return
@@ -2737,28 +2903,78 @@ class Vm(object):
         self.conf['status'] = self.lastStatus
         return self.conf
 
-    def getStats(self):
-        stats = self._getStatsInternal()
+    def getStats(self, averagingWindow=None):
+        stats = self._getStatsInternal(averagingWindow)
         stats['hash'] = self._devXmlHash
         if self._watchdogEvent:
             stats["watchdogEvent"] = self._watchdogEvent
         return stats
 
-    def _getStatsInternal(self):
-        # used by API.Vm.getStats
+    def getVolatileStats(self):
+        """
+        Return the statistics changing between the samples, cheap enough to
+        be computed on every poll: the status, the elapsed time, the age of
+        the samples and the monitor response.
+        """
+        if self.lastStatus == 'Down':
+            return {'status': self.lastStatus}
+
+        stats = {'status': self._getReportedStatus(),
+                 'elapsedTime': str(int(time.time() - self._startTime)),
+                 'monitorResponse': str(self._monitorResponse)}
+        if self._vmStats:
+            statsAge = self._vmStats.getStatsAge()
+            stats['statsAge'] = utils.convertToStr(statsAge)
+            stats['monitorResponse'] = self._getMonitorResponse(statsAge)
+        return stats
 
-        def _getGuestStatus():
-            GUEST_WAIT_TIMEOUT = 60
-            now = time.time()
-            if now - self._guestEventTime < 5 * GUEST_WAIT_TIMEOUT and \
-                    self._guestEvent == 'Powering down':
-                return self._guestEvent
-            if self.guestAgent and self.guestAgent.isResponsive() and \
-                    self.guestAgent.getStatus():
-                return self.guestAgent.getStatus()
-            if now - self._guestEventTime < GUEST_WAIT_TIMEOUT:
-                return self._guestEvent
-            return 'Up'
+    def updateStatsCache(self):
+        """
+        Refresh the statistics of the vm cached for getAllVmStats.
+        """
+        if self._lastStatus == 'Down' or self.id not in self.cif.vmContainer:
+            # Refreshed by the polls, until the vm is destroyed
+            return
+        stats = self.getStats()
+        stats['vmId'] = self.id
+        self.cif.vmStatsCache.update(self.id, stats)
+
+    def _getMonitorResponse(self, statsAge):
+        if (not self.isMigrating() and
+                statsAge > config.getint('vars', 'vm_command_timeout')):
+            return '-1'
+        return str(self._monitorResponse)
+
+    def _getGuestStatus(self):
+        GUEST_WAIT_TIMEOUT = 60
+        now = time.time()
+        if now - self._guestEventTime < 5 * GUEST_WAIT_TIMEOUT and \
+                self._guestEvent == 'Powering down':
+            return self._guestEvent
+        if self.guestAgent and self.guestAgent.isResponsive() and \
+                self.guestAgent.getStatus():
+            return self.guestAgent.getStatus()
+        if now - self._guestEventTime < GUEST_WAIT_TIMEOUT:
+            return self._guestEvent
+        return 'Up'
+
+    def _getReportedStatus(self):
+        statuses = ('Saving State', 'Restoring state', 'Migration Source',
+                    'Migration Destination', 'Paused')
+        if self.lastStatus in statuses:
+            return self.lastStatus
+        elif self.isMigrating():
+            if self._migrationSourceThread._mode == 'file':
+                return 'Saving State'
+            else:
+                return 'Migration Source'
+        elif self.lastStatus == 'Up':
+            return self._getGuestStatus()
+        else:
+            return self.lastStatus
+
+    def _getStatsInternal(self, averagingWindow=None):
+        # used by API.Vm.getStats
 
         if self.lastStatus == 'Down':
             stats = {}
@@ -2788,11 +3004,9 @@ class Vm(object):
         decStats = {}
         try:
             if self._vmStats:
-                decStats = self._vmStats.get()
-                if (not self.isMigrating()
-                    and decStats['statsAge'] >
-                        config.getint('vars', 'vm_command_timeout')):
-                    stats['monitorResponse'] = '-1'
+                decStats = self._vmStats.get(averagingWindow)
+                stats['monitorResponse'] = self._getMonitorResponse(
+                    decStats['statsAge'])
         except Exception:
             self.log.error("Error fetching vm stats", exc_info=True)
         for var in decStats:
@@ -2810,19 +3024,7 @@ class Vm(object):
                     self.log.error("Error setting vm disk stats",
                                    exc_info=True)
 
-        statuses = ('Saving State', 'Restoring state', 'Migration Source',
-                    'Migration Destination', 'Paused')
-        if self.lastStatus in statuses:
-            stats['status'] = self.lastStatus
-        elif self.isMigrating():
-            if self._migrationSourceThread._mode == 'file':
-                stats['status'] = 'Saving State'
-            else:
-                stats['status'] = 'Migration Source'
-        elif self.lastStatus == 'Up':
-            stats['status'] = _getGuestStatus()
-        else:
-            stats['status'] = self.lastStatus
+        stats['status'] = self._getReportedStatus()
         stats['acpiEnable'] = self.conf.get('acpiEnable', 'true')
         stats['timeOffset'] = self.conf.get('timeOffset', '0')
         stats['clientIp'] = self.conf.get('clientIp', '')
@@ -2965,7 +3167,7 @@ class Vm(object):
         return domxml.toxml()
 
     def _initVmStats(self):
-        self._vmStats = VmStatsThread(self)
+        self._vmStats = VmStatsCollector(self)
         self._vmStats.start()
         self._guestEventTime = self._startTime
 
@@ -2976,6 +3178,7 @@ class Vm(object):
         self._cleanupDrives()
         self._cleanupFloppy()
         self._cleanupGuestAgent()
+        self.cif.recoveryStore.remove(self.id)
         utils.rmFile(self._recoveryFile)
         utils.rmFile(self._qemuguestSocketFile)
 
@@ -3052,7 +3255,7 @@ class Vm(object):
                         supervdsm.getProxy().setPortMirroring(network,
                                                               nic.name)
 
-        # VmStatsThread may use block devices info from libvirt.
+        # VmStatsCollector may use block devices info from libvirt.
         # So, run it after you have this info
         self._initVmStats()
         self.guestAgent = guestIF.GuestAgent(
@@ -3716,7 +3919,7 @@ class Vm(object):
             del self.conf['guestFQDN']
         if 'username' in self.conf:
             del self.conf['username']
-        self.saveState()
+        self.saveState(sync=True)
         self.log.debug("End of migration")
 
     def _underlyingCont(self):
@@ -3805,7 +4008,7 @@ class Vm(object):
             self.log.error("Unable to update the device configuration ",
                            "for: %s", driveParams["name"])
 
-        self.saveState()
+        self.saveState(sync=True)
 
     def snapshot(self, snapDrives, memoryParams):
         """Live snapshot command"""
@@ -4143,7 +4346,7 @@ class Vm(object):
                     and device.get("name") == srcDrive.name):
                 with self._confLock:
                     device['diskReplicate'] = dstDisk
-                self.saveState()
+                self.saveState(sync=True)
                 break
         else:
             raise LookupError("No such drive: '%s'" % srcDrive.name)
@@ -4160,7 +4363,7 @@ class Vm(object):
                     and device.get("name") == srcDrive.name):
                 with self._confLock:
                     del device['diskReplicate']
-                self.saveState()
+                self.saveState(sync=True)
                 break
         else:
             raise LookupError("No such drive: '%s'" % srcDrive.name)
@@ -4632,7 +4835,11 @@ class Vm(object):
                 max_mem = int(self.conf.get('memSize')) * 1024
                 min_mem = int(self.conf.get('memGuaranteedSize', '0')) * 1024
                 target_mem = dev.get('target', max_mem)
-                cur_mem = self._dom.info()[2]
+                cur_mem = None
+                if self._vmStats:
+                    cur_mem = self._vmStats.sampleBalloon.getLastSample()
+                if cur_mem is None:
+                    cur_mem = self._dom.info()[2]
                 return {'balloon_max': str(max_mem),
                         'balloon_cur': str(cur_mem),
                         'balloon_min': str(min_mem),
@@ -5085,10 +5292,15 @@ class Vm(object):
 
     def _setWriteWatermarks(self):
         """
-        Define when to receive an event about high write to guest image
-        Currently unavailable by libvirt.
+        Check the drives again, arming their block threshold events for
+        their new size.
         """
-        pass
+        self.cif.watermarkMonitor.notify(self.id)
+
+    def _onBlockThreshold(self, dev, path, threshold, excess):
+        self.log.debug("Drive %s (%s) exceeded its threshold %s by %s",
+                       dev, path, threshold, excess)
+        self.cif.watermarkMonitor.notify(self.id, dev)
 
     def _onLibvirtLifecycleEvent(self, event, detail, opaque):
         self.log.debug('event %s detail %s opaque %s',
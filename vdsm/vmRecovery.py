@@ -0,0 +1,277 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+"""
+Recovery of the vms found running when vdsm starts.
+
+The recovery files of the vms are loaded and the vms are created by a few
+threads, and every vm can be used as soon as it is created, while the other
+vms are still recovered. The paths of the drives of every vm are prepared as
+soon as the vm is created and the storage pool is connected. The drives are
+prepared in groups of the same image, so the preparations of the same image
+are not run concurrently, and every vm starts collecting its disks
+statistics once its own drives are prepared.
+"""
+
+import logging
+import threading
+import time
+
+import libvirt
+
+import vm
+
+
+class RecoveryProgress(object):
+    """
+    The counters of the recovery, reported in the host statistics.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {'total': 0, 'skipped': 0, 'created': 0,
+                          'prepared': 0, 'failed': 0}
+
+    def add(self, name, count=1):
+        with self._lock:
+            self._counters[name] += count
+
+    def getStats(self):
+        with self._lock:
+            return self._counters.copy()
+
+
+class _VmState(object):
+    __slots__ = ('drives', 'pending', 'stopped')
+
+    def __init__(self, drives):
+        self.drives = drives
+        # The number of drives not prepared yet
+        self.pending = len(drives)
+        # True once the preparation failed or was stopped
+        self.stopped = False
+
+
+class VmRecovery(object):
+    """
+    Recover the vms of the libvirt domains running when vdsm starts.
+    """
+    log = logging.getLogger("VmRecovery")
+
+    # How often the creation of a recovered vm is checked (seconds)
+    CREATION_POLL_INTERVAL = 1
+
+    def __init__(self, cif, workers):
+        self._cif = cif
+        self._workers = workers
+        self.progress = RecoveryProgress()
+
+        self._cond = threading.Condition(threading.Lock())
+        self._domains = []
+        self._creating = 0
+        # The drives waiting for preparation, grouped by (domainID,
+        # imageID), or by vm for the drives that are not vdsm images.
+        self._groups = {}
+        self._order = []
+        self._busy = set()
+        # vmId: _VmState
+        self._vms = {}
+        # The ids of the vms created so far
+        self._created = set()
+
+        self._poolLock = threading.Lock()
+        self._poolConnected = False
+
+    def run(self, domains, onCreated):
+        """
+        Recover the vms of domains, calling onCreated once all of them have
+        been created, and return once their paths are prepared.
+        """
+        self.progress.add('total', len(domains))
+        self._domains = list(domains)
+        self._creating = min(self._workers, len(self._domains))
+
+        creators = [self._startThread(self._create, "recovery-create-%d" % i)
+                    for i in range(self._creating)]
+        preparers = [self._startThread(self._prepare,
+                                       "recovery-prepare-%d" % i)
+                     for i in range(self._workers)]
+
+        for t in creators:
+            t.join()
+        onCreated()
+
+        for t in preparers:
+            t.join()
+        self.log.info("Recovery done: %s", self.progress.getStats())
+
+    def isCreated(self, vmId):
+        """
+        Return True if the vm vmId was recovered and created, and can be
+        used while the other vms are still recovered.
+        """
+        with self._cond:
+            return vmId in self._created
+
+    def _startThread(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _create(self):
+        try:
+            while True:
+                with self._cond:
+                    if not self._domains:
+                        break
+                    dom = self._domains.pop(0)
+                try:
+                    vmObj = self._recoverDomain(dom)
+                except Exception:
+                    self.log.error("Error recovering domain", exc_info=True)
+                    self.progress.add('failed')
+                    continue
+                if vmObj is not None:
+                    self._queueDrives(vmObj)
+        finally:
+            with self._cond:
+                self._creating -= 1
+                self._cond.notifyAll()
+
+    def _recoverDomain(self, dom):
+        """
+        Create the vm of dom from its recovery file, return it once created
+        or None if dom is not a vm of vdsm.
+        """
+        if not self._cif.isVDSMVm(dom):
+            self.progress.add('skipped')
+            return None
+
+        vmId = dom.UUIDString()
+        if not self._cif._recoverVm(vmId):
+            # RH qemu proc without recovery
+            self.log.info('loose qemu process with id: %s found, killing it.',
+                          vmId)
+            self.progress.add('failed')
+            try:
+                dom.destroy()
+            except libvirt.libvirtError:
+                self.log.error('failed to kill loose qemu process with id: '
+                               '%s', vmId, exc_info=True)
+            return None
+
+        vmObj = self._cif.vmContainer.get(vmId)
+        if vmObj is None:
+            return None
+        while self._cif._enabled and vmObj.lastStatus == 'WaitForLaunch':
+            time.sleep(self.CREATION_POLL_INTERVAL)
+        with self._cond:
+            self._created.add(vmId)
+        self.progress.add('created')
+        return vmObj
+
+    def _queueDrives(self, vmObj):
+        drives = vmObj.buildConfDevices()[vm.DISK_DEVICES]
+        with self._cond:
+            self._vms[vmObj.id] = _VmState(drives)
+            for drive in drives:
+                if drive['device'] == 'disk' and vm.isVdsmImage(drive):
+                    key = (drive['domainID'], drive['imageID'])
+                else:
+                    key = (None, vmObj.id)
+                if key not in self._groups:
+                    self._groups[key] = []
+                    self._order.append(key)
+                self._groups[key].append((vmObj, drive))
+            self._cond.notifyAll()
+
+        if not drives:
+            self._pathsPrepared(vmObj, drives)
+
+    def _prepare(self):
+        while True:
+            with self._cond:
+                while True:
+                    key = self._nextGroup()
+                    if key is not None:
+                        break
+                    if self._creating == 0 and not self._order:
+                        return
+                    self._cond.wait()
+                self._order.remove(key)
+                items = self._groups.pop(key)
+                self._busy.add(key)
+
+            try:
+                try:
+                    self._waitForStoragePool()
+                except Exception:
+                    self.log.error("Error waiting for the storage pool",
+                                   exc_info=True)
+                for vmObj, drive in items:
+                    self._prepareDrive(vmObj, drive)
+            finally:
+                with self._cond:
+                    self._busy.discard(key)
+                    self._cond.notifyAll()
+
+    def _nextGroup(self):
+        for key in self._order:
+            if key not in self._busy:
+                return key
+        return None
+
+    def _waitForStoragePool(self):
+        with self._poolLock:
+            if not self._poolConnected:
+                self._cif._waitForStoragePool()
+                self._poolConnected = True
+
+    def _prepareDrive(self, vmObj, drive):
+        with self._cond:
+            state = self._vms[vmObj.id]
+            # Do not prepare volumes when system goes down, nor the
+            # remaining volumes of a vm that failed.
+            stopped = state.stopped or not self._cif._enabled
+
+        error = False
+        if not stopped:
+            try:
+                # False if destroyed while recovered
+                stopped = not vmObj.prepareDrivePath(drive)
+            except Exception:
+                self.log.error("Vm %s recovery failed", vmObj.id,
+                               exc_info=True)
+                stopped = error = True
+
+        with self._cond:
+            if error and not state.stopped:
+                self.progress.add('failed')
+            state.stopped = state.stopped or stopped
+            state.pending -= 1
+            done = state.pending == 0 and not state.stopped
+
+        if done:
+            self._pathsPrepared(vmObj, state.drives)
+
+    def _pathsPrepared(self, vmObj, drives):
+        vmObj.pathsPrepared(drives)
+        self.progress.add('prepared')
+        self.log.debug("Paths of vm %s prepared", vmObj.id)
@@ -0,0 +1,228 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+"""
+A cache of the statistics reported by getAllVmStats.
+
+The statistics of a vm are updated when the vm takes a new sample, while
+every poll refreshes only the few values that change between the samples.
+Each update compares the fresh statistics of the vm with the cached ones and
+bumps a host-wide generation counter only if they changed, ignoring the
+rates computed from the samples. The entries that didn't change keep their
+encoded payload, and the clients presenting the generation token of a
+previous response can be sent only the vms that changed since then.
+"""
+
+import threading
+import uuid
+import xmlrpclib
+
+# Keys changing on every poll, they are reported but they don't mark the
+# statistics of a vm as changed.
+VOLATILE_KEYS = frozenset(('elapsedTime', 'statsAge'))
+
+# Keys of the rates computed on every sample, at any level of the
+# statistics. They are reported but they don't mark the statistics of a vm
+# as changed either.
+RATE_KEYS = frozenset(('cpuUser', 'cpuSys', 'rxRate', 'txRate', 'readRate',
+                       'writeRate', 'readLatency', 'writeLatency',
+                       'flushLatency'))
+
+# How many removed vms are remembered for the delta responses. Older
+# tokens get a full response.
+MAX_REMOVED_VMS = 1024
+
+
+_STRUCT_START = '<value><struct>\n'
+_STRUCT_END = '</struct></value>\n'
+
+
+def _withoutRates(value):
+    if not isinstance(value, dict):
+        return value
+    return dict((k, _withoutRates(v)) for k, v in value.iteritems()
+                if k not in RATE_KEYS)
+
+
+def _dumpMembers(items, encoding, allow_none):
+    out = []
+    marshaller = xmlrpclib.Marshaller(encoding, allow_none)
+    marshaller.dump_struct(items, out.append)
+    return ''.join(out[1:-1])
+
+
+class CachedVmStats(dict):
+    """
+    The statistics of a vm as returned by Vm.getStats, along with the
+    generation in which they last changed and their XML-RPC encoding.
+    """
+    def __init__(self, stats, generation):
+        dict.__init__(self, stats)
+        self.generation = generation
+        self.stable = dict((k, v) for k, v in stats.iteritems()
+                           if k not in VOLATILE_KEYS)
+        # The statistics compared to detect a change
+        self.signature = _withoutRates(self.stable)
+        self._stableXml = None
+
+    def xmlrpc(self, encoding=None, allow_none=False):
+        """
+        Return the XML-RPC <value> element encoding these statistics.
+        Only the volatile keys are encoded on every call, the encoding of
+        the others is computed once and reused until they change.
+        """
+        if self._stableXml is None:
+            self._stableXml = _dumpMembers(self.stable, encoding, allow_none)
+        volatile = dict((k, self[k]) for k in VOLATILE_KEYS if k in self)
+        return ''.join((_STRUCT_START, self._stableXml,
+                        _dumpMembers(volatile, encoding, allow_none),
+                        _STRUCT_END))
+
+    def inherit(self, other):
+        """
+        Take the generation of other, holding the same signature, and its
+        encoding if it holds the same stable statistics.
+        """
+        self.generation = other.generation
+        if self.stable == other.stable:
+            self._stableXml = other._stableXml
+
+
+class VmStatsCache(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._id = str(uuid.uuid4())
+        self._generation = 0
+        self._entries = {}
+        self._removed = {}
+        # The oldest generation for which the removed vms are known
+        self._horizon = 0
+
+    def update(self, vmId, stats):
+        """
+        Update the cached statistics of vmId with stats, the dict returned
+        by Vm.getStats.
+        """
+        with self._lock:
+            self._update(vmId, stats)
+
+    def refresh(self, volatileByVm, getStats):
+        """
+        Refresh the cache on a poll of the statistics of all the vms.
+
+        volatileByVm maps the ids of all the vms to the dicts returned by
+        Vm.getVolatileStats, the vms missing from it are removed from the
+        cache. getStats(vmId) is called for the vms which are not cached
+        yet, or whose volatile statistics are not consistent with the
+        cached ones, e.g. after a change of status, returning the dict
+        returned by Vm.getStats or None if not available.
+
+        Return the list of the cached statistics.
+        """
+        with self._lock:
+            for vmId in set(self._entries) - set(volatileByVm):
+                del self._entries[vmId]
+                self._rememberRemoved(vmId)
+
+            stale = [vmId for vmId, volatile in volatileByVm.iteritems()
+                     if not self._isFresh(vmId, volatile)]
+
+        fresh = []
+        for vmId in stale:
+            stats = getStats(vmId)
+            if stats is not None:
+                fresh.append((vmId, stats))
+
+        with self._lock:
+            for vmId, stats in fresh:
+                if vmId in volatileByVm:
+                    self._update(vmId, stats)
+
+            for vmId, volatile in volatileByVm.iteritems():
+                entry = self._entries.get(vmId)
+                if entry is not None:
+                    self._updateVolatile(vmId, entry, volatile)
+
+            return self._entries.values()
+
+    def getChangedSince(self, token):
+        """
+        Return a tuple (full, changed, removed, token):
+        full: True if token couldn't be used and changed lists all the vms
+        changed: the cached statistics of the vms changed since token
+        removed: the ids of the vms removed since token
+        token: the token identifying the current generation
+        """
+        with self._lock:
+            generation = self._parseToken(token)
+            newToken = self._token()
+            if generation is None or generation < self._horizon:
+                return True, self._entries.values(), [], newToken
+
+            changed = [entry for entry in self._entries.itervalues()
+                       if entry.generation > generation]
+            removed = [vmId for vmId, gen in self._removed.iteritems()
+                       if gen > generation]
+            return False, changed, removed, newToken
+
+    def _update(self, vmId, stats):
+        entry = self._entries.get(vmId)
+        fresh = CachedVmStats(stats, self._generation + 1)
+        if entry is not None and entry.signature == fresh.signature:
+            fresh.inherit(entry)
+        else:
+            self._generation += 1
+            self._removed.pop(vmId, None)
+        self._entries[vmId] = fresh
+
+    def _isFresh(self, vmId, volatile):
+        entry = self._entries.get(vmId)
+        if entry is None:
+            return False
+        return entry.get('status') == volatile.get('status')
+
+    def _updateVolatile(self, vmId, entry, volatile):
+        for key, value in volatile.iteritems():
+            if key not in VOLATILE_KEYS and entry.get(key) != value:
+                stats = dict(entry)
+                stats.update(volatile)
+                self._update(vmId, stats)
+                return
+        entry.update(volatile)
+
+    def _rememberRemoved(self, vmId):
+        self._generation += 1
+        self._removed[vmId] = self._generation
+        if len(self._removed) > MAX_REMOVED_VMS:
+            oldest = min(self._removed, key=self._removed.get)
+            self._horizon = self._removed.pop(oldest)
+
+    def _token(self):
+        return '%s:%d' % (self._id, self._generation)
+
+    def _parseToken(self, token):
+        try:
+            cacheId, generation = token.split(':')
+            generation = int(generation)
+        except (AttributeError, ValueError):
+            return None
+        if cacheId != self._id or generation > self._generation:
+            return None
+        return generation
@@ -0,0 +1,407 @@
+#
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+"""
+Host-wide monitoring of the allocation of the thin provisioned drives.
+
+A single thread schedules the checks of the drives of all the vms, each
+drive on its own schedule: the drives whose allocation grows fast are
+checked often enough to be extended before reaching their watermark, the
+idle ones rarely. The checks run on a small pool of worker threads, one vm
+at a time per worker, and a vm whose previous check has not returned yet,
+e.g. because its storage is not responding, is skipped until it returns, so
+it delays neither the other vms nor the workers.
+When libvirt supports the block threshold events the watermark of each
+drive is armed in libvirt and the drive is checked as soon as the event
+arrives, the periodic check being only a safety net.
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import Queue
+import re
+import threading
+
+import libvirt
+from vdsm import utils
+
+
+# The target name of a drive in the block threshold events, e.g. "vda" or
+# "vda[1]" for a volume of its backing chain.
+_DEV_NAME = re.compile(r"^([^\[]+)")
+
+# The allocation rate of a drive is measured over this window (seconds)
+RATE_WINDOW = 60
+
+
+def eventsSupported():
+    """
+    Return True if the libvirt bindings support the block threshold events.
+    """
+    return (hasattr(libvirt, 'VIR_DOMAIN_EVENT_ID_BLOCK_THRESHOLD') and
+            hasattr(libvirt.virDomain, 'setBlockThreshold'))
+
+
+class _DriveState(object):
+    __slots__ = ('deadline', 'samples', 'rate', 'threshold')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        # (time, alloc) of the checks in the last RATE_WINDOW seconds
+        self.samples = collections.deque()
+        # Recent growth of the allocation, in bytes per second
+        self.rate = 0.0
+        # The threshold armed in libvirt, None if not armed
+        self.threshold = None
+
+
+class _VmEntry(object):
+    __slots__ = ('vm', 'drives', 'deadline', 'urgent', 'busy')
+
+    def __init__(self, vm, deadline):
+        self.vm = vm
+        self.drives = {}
+        self.deadline = deadline
+        # The drives to check on the next pass regardless of their
+        # deadline, None meaning all of them.
+        self.urgent = set()
+        # True while the drives are checked by a worker
+        self.busy = False
+
+
+class WatermarkMonitor(object):
+    """
+    Checks the thin provisioned drives of the registered vms.
+
+    The vms provide:
+
+    - getChunkedDrives() returning the drives to check, or None when their
+      drives should not be checked now, e.g. during the recovery.
+    - getDriveBlockInfo(drive) returning (capacity, alloc, physical).
+    - onDriveWatermark(drive, capacity, alloc, physical, rate) requesting
+      the extension of the drive if needed, and returning True if it did.
+      rate is the recent growth of the allocation in bytes per second.
+    - setDriveThreshold(drive, threshold) arming the block threshold event
+      of the drive.
+    """
+    DEFAULT_LOG = logging.getLogger("WatermarkMonitor")
+
+    def __init__(self, minInterval, maxInterval, workers=4, events=None,
+                 log=DEFAULT_LOG, timefn=utils.monotonic_time):
+        """
+        Initialize a WatermarkMonitor.
+
+        :param minInterval: The shortest interval (in seconds) between the
+                            checks of a drive.
+        :param maxInterval: The longest interval (in seconds) between the
+                            checks of a drive.
+        :param workers: The number of threads checking the drives.
+        :param events: Whether to arm the block threshold events, by
+                       default if supported by libvirt.
+        """
+        if workers < 1:
+            raise ValueError("workers must be greater than 0")
+
+        self._minInterval = minInterval
+        self._maxInterval = maxInterval
+        self._events = eventsSupported() if events is None else events
+        self._log = log
+        self._timefn = timefn
+        self._cond = threading.Condition(threading.Lock())
+        self._vms = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._numWorkers = workers
+        self._jobs = Queue.Queue()
+        self._running = False
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                raise RuntimeError("WatermarkMonitor is started")
+            self._running = True
+        self._log.debug("Starting watermark monitor with %s workers "
+                        "(events: %s)", self._numWorkers, self._events)
+        self._startThread(self._run, "WatermarkMonitor")
+        for i in range(self._numWorkers):
+            self._startThread(self._work, "WatermarkWorker-%d" % i)
+
+    def stop(self):
+        self._log.debug("Stopping watermark monitor")
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        for i in range(self._numWorkers):
+            self._jobs.put(None)
+
+    def register(self, uuid, vm):
+        """
+        Start monitoring the drives of vm, they are first checked as soon
+        as possible.
+        """
+        with self._cond:
+            entry = _VmEntry(vm, self._timefn())
+            entry.urgent = None
+            self._vms[uuid] = entry
+            self._push(uuid, entry)
+
+    def unregister(self, uuid):
+        with self._cond:
+            self._vms.pop(uuid, None)
+
+    def notify(self, uuid, dev=None):
+        """
+        Check now the drive named dev of the vm, all of them if dev is
+        None. Called when a drive crosses its threshold, is resized or has
+        run out of space.
+        """
+        with self._cond:
+            entry = self._vms.get(uuid)
+            if entry is None:
+                return
+            if dev is None:
+                entry.urgent = None
+            elif entry.urgent is not None:
+                match = _DEV_NAME.match(dev)
+                if match:
+                    entry.urgent.add(match.group(1))
+                    drive = entry.drives.get(match.group(1))
+                    if drive is not None:
+                        # The event disarms the threshold
+                        drive.threshold = None
+            entry.deadline = self._timefn()
+            self._push(uuid, entry)
+            self._cond.notify()
+
+    def _startThread(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+
+    def _push(self, uuid, entry):
+        heapq.heappush(self._queue, (entry.deadline, next(self._seq), uuid))
+
+    def _run(self):
+        self._log.debug("Watermark monitor started")
+        while True:
+            batch = self._nextBatch()
+            if batch is None:
+                break
+            try:
+                self._checkVms(batch)
+            except Exception:
+                self._log.error("Unhandled error checking the drives",
+                                exc_info=True)
+        self._log.debug("Watermark monitor finished")
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            self._runJob(job)
+
+    def _runJob(self, job):
+        uuid, entry, due, now = job
+        try:
+            for drive, state in due:
+                try:
+                    self._checkDrive(entry.vm, drive, state, now)
+                except Exception:
+                    self._log.error("Error checking drive %s of vm %s",
+                                    drive.name, uuid, exc_info=True)
+                    state.deadline = now + self._minInterval
+        finally:
+            self._finish(uuid, entry, now)
+
+    def _nextBatch(self):
+        """
+        Wait for the vms having drives due for a check, return a list of
+        (uuid, entry, urgent) or None once stopped.
+        """
+        with self._cond:
+            while self._running:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                now = self._timefn()
+                wait = self._queue[0][0] - now
+                if wait <= 0:
+                    break
+                self._cond.wait(wait)
+            else:
+                return None
+
+            batch = []
+            while self._queue and self._queue[0][0] <= now:
+                deadline, _, uuid = heapq.heappop(self._queue)
+                entry = self._vms.get(uuid)
+                # Skip the unregistered vms and the stale queue items of
+                # the rescheduled ones.
+                if entry is None or entry.deadline != deadline:
+                    continue
+                # Still checked, queued again once the check returns
+                if entry.busy:
+                    continue
+                entry.busy = True
+                # Not queued until checked
+                entry.deadline = None
+                batch.append((uuid, entry, entry.urgent))
+                entry.urgent = set()
+            return batch
+
+    def _checkVms(self, batch):
+        """
+        Queue the checks of the drives due in batch to the workers, the
+        vms having the fastest growing drives first.
+        """
+        now = self._timefn()
+        due = []
+        for uuid, entry, urgent in batch:
+            try:
+                drives = entry.vm.getChunkedDrives()
+            except Exception:
+                self._log.error("Error getting the drives of vm %s", uuid,
+                                exc_info=True)
+                drives = []
+
+            if drives is None:
+                # Not checked now, but maybe soon
+                self._finish(uuid, entry, now, now + self._minInterval)
+                continue
+
+            states = {}
+            for drive in drives:
+                state = entry.drives.get(drive.name)
+                if state is None:
+                    state = _DriveState(now)
+                elif urgent is None or drive.name in urgent:
+                    state.deadline = now
+                states[drive.name] = state
+                if state.deadline <= now:
+                    due.append((uuid, entry, drive, state))
+            entry.drives = states
+
+        # The fastest growing drives first
+        due.sort(key=lambda item: item[3].rate, reverse=True)
+        jobs = {}
+        order = []
+        for uuid, entry, drive, state in due:
+            if uuid not in jobs:
+                jobs[uuid] = (uuid, entry, [], now)
+                order.append(uuid)
+            jobs[uuid][2].append((drive, state))
+        for uuid in order:
+            self._jobs.put(jobs[uuid])
+
+        for uuid, entry, urgent in batch:
+            if uuid not in jobs and entry.busy:
+                self._finish(uuid, entry, now)
+
+    def _finish(self, uuid, entry, now, deadline=None):
+        """
+        Queue again the vm of entry once its drives were checked, by
+        default for the earliest deadline of its drives.
+        """
+        if deadline is None:
+            deadlines = [state.deadline for state in entry.drives.values()]
+            deadline = min(deadlines or [now + self._maxInterval])
+        with self._cond:
+            entry.busy = False
+            if self._vms.get(uuid) is not entry:
+                return
+            if entry.deadline is None:
+                entry.deadline = deadline
+            # else notified while checked, the notification was skipped
+            self._push(uuid, entry)
+            self._cond.notify()
+
+    def _checkDrive(self, vm, drive, state, now):
+        capacity, alloc, physical = vm.getDriveBlockInfo(drive)
+
+        _updateRate(state, now, alloc)
+
+        if vm.onDriveWatermark(drive, capacity, alloc, physical, state.rate):
+            # Check again soon until the drive is extended
+            state.threshold = None
+            state.deadline = now + self._minInterval
+            return
+
+        threshold = physical - drive.watermarkLimit
+        if self._events and state.threshold != threshold:
+            state.threshold = self._armThreshold(vm, drive, threshold)
+
+        state.deadline = now + self._interval(state, threshold - alloc)
+
+    def _armThreshold(self, vm, drive, threshold):
+        try:
+            vm.setDriveThreshold(drive, threshold)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_SUPPORT:
+                self._log.info("Block threshold events not supported, "
+                               "polling the drives")
+                self._events = False
+            else:
+                self._log.warning("Cannot set the threshold of drive %s",
+                                  drive.name, exc_info=True)
+            return None
+        return threshold
+
+    def _interval(self, state, headroom):
+        """
+        Return the interval until the next check of a drive having
+        headroom bytes left before its watermark.
+        """
+        if state.threshold is not None or state.rate <= 0:
+            return self._maxInterval
+        # Check again before the drive may reach the watermark
+        interval = headroom / state.rate / 2
+        return min(max(interval, self._minInterval), self._maxInterval)
+
+
+def _updateRate(state, now, alloc):
+    """
+    Update the allocation rate of a drive with a new sample. The rate is
+    the highest of the rate over the window and the rate since the previous
+    check, following quickly the bursts of writes and forgetting them once
+    they leave the window.
+    """
+    samples = state.samples
+    if samples:
+        if now <= samples[-1][0]:
+            return
+        if alloc < samples[-1][1]:
+            # A new volume, e.g. after a snapshot
+            samples.clear()
+
+    samples.append((now, alloc))
+    while len(samples) > 2 and now - samples[1][0] >= RATE_WINDOW:
+        samples.popleft()
+
+    if len(samples) < 2:
+        state.rate = 0.0
+        return
+
+    firstTime, firstAlloc = samples[0]
+    prevTime, prevAlloc = samples[-2]
+    state.rate = max((alloc - firstAlloc) / float(now - firstTime),
+                     (alloc - prevAlloc) / float(now - prevTime))
@@ -216,6 +216,15 @@ def Host_getStorageRepoStats_Ret(ret):
     return ret
 
 
+def Host_getAllVmStatsDelta_Ret(ret):
+    """
+    The returned dictionary doesn't separate the stats from the status code
+    so we need to rebuild the result.
+    """
+    del ret['status']
+    return ret
+
+
 def Host_getVMList_Call(api, args):
     """
     This call is only interested in returning the VM UUIDs so pass False for
@@ -291,6 +300,7 @@ command_info = {
     'Host_getStats': {'ret': 'info'},
     'Host_getStorageDomains': {'ret': 'domlist'},
     'Host_getStorageRepoStats': {'ret': Host_getStorageRepoStats_Ret},
+    'Host_getAllVmStatsDelta': {'ret': Host_getAllVmStatsDelta_Ret},
     'Host_startMonitoringDomain': {},
     'Host_stopMonitoringDomain': {},
     'Host_getVMList': {'call': Host_getVMList_Call, 'ret': Host_getVMList_Ret},